@@ -0,0 +1,84 @@
+"""Compares two benchmark results of `benchmarks/run.py`, e.g. of two commits.
+
+Runs with the same case, parameters and threads are matched. A run is a regression if its throughput dropped
+or its kernel memory (peak above the inputs) grew by more than the tolerance, then the exit code is 1.
+
+Usage:
+
+```sh
+python benchmarks/compare.py                     # the two latest results
+python benchmarks/compare.py a1b2c3d e4f5a6b     # commits (or paths of result files)
+```
+"""
+
+from pathlib import Path
+from rich.console import Console
+from rich.table import Table
+import argparse
+import json
+import sys
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def load(name: str) -> dict:
+    path = Path(name)
+    if not path.exists():
+        path = RESULTS_DIR / f"{name}.json"
+    return json.loads(path.read_text())
+
+
+def key(result: dict) -> tuple:
+    return result["case"], json.dumps(result["params"], sort_keys=True), result["threads"]
+
+
+def memory_mb(result: dict) -> float:
+    """Kernel memory of a run, the peak RSS for results of older versions. At least 1 MB to compare small kernels."""
+    return max(result.get("kernel_rss_mb", result["peak_rss_mb"]), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", nargs="?", help="Commit or result file. Defaults to the second latest result.")
+    parser.add_argument("new", nargs="?", help="Commit or result file. Defaults to the latest result.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    if args.base is None or args.new is None:
+        latest = sorted(RESULTS_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        assert len(latest) >= 2, f"At least two results in {RESULTS_DIR} are needed"
+        args.base, args.new = args.base or str(latest[-2]), args.new or str(latest[-1])
+    base, new = load(args.base), load(args.new)
+    base_results = {key(r): r for r in base["results"] if "error" not in r}
+
+    console = Console()
+    if base["machine"] != new["machine"]:
+        console.print("[yellow]The results were measured on different machines")
+
+    table = Table("case", "params", "threads", f"{base['commit']} (s)", f"{new['commit']} (s)", "throughput", "kernel RSS")
+    regressions = 0
+    for r in new["results"]:
+        b = base_results.get(key(r))
+        if b is None or "error" in r:
+            continue
+        speed = b["seconds"] / r["seconds"]
+        memory = memory_mb(r) / memory_mb(b)
+        slower = speed < 1 - args.tolerance
+        larger = memory > 1 + args.tolerance
+        regressions += slower or larger
+        table.add_row(
+            r["case"],
+            json.dumps(r["params"]),
+            str(r["threads"]),
+            f"{b['seconds']:.3f}",
+            f"{r['seconds']:.3f}",
+            f"[{'red' if slower else 'green' if speed > 1 + args.tolerance else 'default'}]{speed:.2f}x",
+            f"[{'red' if larger else 'default'}]{memory:.2f}x",
+        )
+    console.print(table)
+    console.print(f"{regressions} regressions with a tolerance of {args.tolerance:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Benchmarks of the kernels and pipeline stages on synthetic data.
+
+Every case runs in its own subprocess, so that the peak memory (max RSS) of one case does not leak into the next
+and the number of threads of rayon (and of the BLAS used by numpy) can be set per run. The kernel RSS is the peak
+memory of the measured runs above the memory of their inputs, which is what the memory regressions are checked on. The results are written
+as JSON to `benchmarks/results/<commit>.json` and can be compared between commits with `benchmarks/compare.py`.
+
+Usage:
+
+```sh
+python benchmarks/run.py                          # quick suite with all threads
+python benchmarks/run.py --suite full --threads 1 2 4 8
+python benchmarks/run.py --cases mind lapend --suite full
+```
+"""
+
+from pathlib import Path
+from itertools import product
+from datetime import datetime
+from rich.console import Console
+from rich.table import Table
+from rich import print
+import numpy as np
+import subprocess
+import argparse
+import platform
+import resource
+import json
+import time
+import sys
+import os
+
+ROOT = Path(__file__).parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+# Columns of y in the kernel cases, i.e. the kernels compute a [v, min(v, BLOCK)] block like a tile of `xrmatrix_from_func`
+BLOCK = 2048
+
+# Parameter grids of the cases per suite, every combination is run
+SUITES = {
+    "quick": {
+        "mind": {"v": [1000, 5000], "t": [365], "bins": [32]},
+        "lapend": {"v": [1000, 5000], "t": [365], "lags": [(9, 36)]},
+        "hexgrid": {"res": [0.5], "t": [30], "hex_res": [3]},
+        "adjacency_matrix": {"v": [1000, 5000]},
+        "betweenness": {"v": [1000, 5000], "degree": [20], "k": [32]},
+    },
+    "full": {
+        "mind": {"v": [1000, 10000, 50000], "t": [365, 2920], "bins": [16, 64]},
+        "lapend": {"v": [1000, 10000, 50000], "t": [365, 2920], "lags": [(1, 10), (9, 36), (73, 292)]},
+        "hexgrid": {"res": [0.5, 0.1], "t": [30, 365], "hex_res": [3, 4]},
+        "adjacency_matrix": {"v": [1000, 10000, 20000]},
+        "betweenness": {"v": [1000, 10000, 50000], "degree": [20, 100], "k": [100]},
+    },
+}
+
+
+def proc_status_mb(field: str) -> float:
+    """A memory field (e.g. VmRSS or VmHWM) of /proc/self/status in MB, None where /proc is not available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB, since the last `reset_peak_rss` where supported.
+
+    ru_maxrss (in KB on Linux and in bytes on macOS) can not be reset, so VmHWM is used on Linux.
+    """
+    hwm = proc_status_mb("VmHWM")
+    if hwm is not None:
+        return hwm
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def rss_mb() -> float:
+    """Current resident memory of this process in MB, falls back to the peak"""
+    rss = proc_status_mb("VmRSS")
+    return rss if rss is not None else peak_rss_mb()
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident memory (VmHWM) to the current one, returns False where this is not supported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def series(t: int, v: int, seed=0) -> np.ndarray:
+    """Synthetic time series [t, v] of random walks with a shared seasonal cycle, as float32 without any larger copy"""
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((t, v), dtype=np.float32)
+    np.cumsum(x, axis=0, out=x)
+    x += 5 * np.sin(2 * np.pi * np.arange(t, dtype=np.float32) / 365)[:, None]
+    return x
+
+
+def setup_mind(v, t, bins):
+    from chaotic_carbon_networks.rust_chaotic_carbon_networks import mind
+
+    x = series(t, v)
+    y = x[:, : min(v, BLOCK)]
+    xrange = (float(x.min()), float(x.max()))
+    return lambda: mind(x, y, bins, xrange, xrange), v * y.shape[1], "pairs"
+
+
+def setup_lapend(v, t, lags):
+    from chaotic_carbon_networks.rust_chaotic_carbon_networks import lapend
+
+    x = series(t, v)
+    y = x[:, : min(v, BLOCK)]
+    return lambda: lapend(x, lags[0], lags[1], y), v * y.shape[1], "pairs"
+
+
+def setup_hexgrid(res, t, hex_res):
+    import xarray as xr
+    import pandas as pd
+    from chaotic_carbon_networks.hex import hexgrid
+
+    lats = np.arange(-90 + res / 2, 90, res)
+    lons = np.arange(-180 + res / 2, 180, res)
+    x = xr.DataArray(
+        series(t, len(lats) * len(lons)).reshape(t, len(lats), len(lons)),
+        dims=("time", "lat", "lon"),
+        coords={"time": pd.date_range("2020-01-01", periods=t), "lat": lats, "lon": lons},
+    )
+    # Build the (cached) operator outside of the measurement
+    hexgrid(x.isel(time=slice(0, 1)), method="sum", hex_res=hex_res)
+    return lambda: hexgrid(x, method="sum", hex_res=hex_res).values, x.size, "cells"
+
+
+def setup_adjacency_matrix(v):
+    import xarray as xr
+    from chaotic_carbon_networks.matrix import adjacency_matrix
+
+    rng = np.random.default_rng(0)
+    m = xr.DataArray(rng.random((v, v), dtype=np.float32), dims=("vertex", "vertex_other"))
+    return lambda: adjacency_matrix(m, rr=0.05), v * v, "pairs"
+
+
+def setup_betweenness(v, degree, k):
+    import scipy.sparse as sp
+    from chaotic_carbon_networks.matrix import betweenness, SparseMatrix
+
+    # Random undirected graph with the given mean degree
+    a = sp.random(v, v, density=degree / v / 2, format="csr", random_state=0, dtype=np.float32)
+    a = ((a + a.T) > 0).astype(np.int8)
+    a.setdiag(0)
+    a.eliminate_zeros()
+    m = SparseMatrix(sp.csr_array(a), np.arange(v), np.arange(v), 3, 3)
+    # Every source traverses all links once
+    return lambda: betweenness(m, k=k, workers=1), k * a.nnz, "link traversals"
+
+
+def run_case(case: str, params: dict, repeat: int) -> dict:
+    """Runs a case in this process and returns the best of `repeat` runs.
+
+    The memory of the kernel is the peak during the runs above the resident memory after the setup (i.e. the inputs),
+    the peak of the setup itself is excluded by resetting the peak where supported.
+    """
+    f, n, unit = globals()[f"setup_{case}"](**params)
+    setup_peak = peak_rss_mb()
+    peak_reset = reset_peak_rss()
+    base_rss = rss_mb()
+    f()  # Warm up (thread pools, caches, page faults)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return {
+        "seconds": min(times),
+        "throughput": n / min(times),
+        "unit": f"{unit}/s",
+        "setup_rss_mb": setup_peak,
+        "input_rss_mb": base_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "kernel_rss_mb": max(peak_rss_mb() - base_rss, 0),
+        "peak_reset": peak_reset,
+    }
+
+
+def spawn(case: str, params: dict, threads: int, repeat: int) -> dict:
+    """Runs a case in a subprocess with the given number of threads"""
+    env = os.environ.copy()
+    if threads:
+        for var in ("RAYON_NUM_THREADS", "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+            env[var] = str(threads)
+    cmd = [sys.executable, __file__, "--child", case, json.dumps(params), "--repeat", str(repeat)]
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True, cwd=ROOT)
+    if out.returncode != 0:
+        return {"error": out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit code {out.returncode}"}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def git_commit() -> str:
+    """Short hash of HEAD, with the suffix -dirty if tracked files are modified"""
+    git = lambda *args: subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True)
+    commit = git("rev-parse", "--short", "HEAD").stdout.strip() or "unknown"
+    if git("diff", "--quiet", "HEAD").returncode != 0:
+        commit += "-dirty"
+    return commit
+
+
+def grid(spec: dict) -> list[dict]:
+    return [dict(zip(spec, values)) for values in product(*spec.values())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", choices=list(SUITES), default="quick")
+    parser.add_argument("--cases", nargs="+", choices=list(SUITES["quick"]), default=list(SUITES["quick"]))
+    parser.add_argument("--threads", nargs="+", type=int, default=[0], help="Numbers of threads, 0 for all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, default=None, help="Defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--child", nargs=2, metavar=("CASE", "PARAMS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, str(ROOT))
+        case, params = args.child
+        # The result is the last line of stdout, written without the formatting of rich
+        sys.stdout.write(json.dumps(run_case(case, json.loads(params), args.repeat)) + "\n")
+        return
+
+    results = []
+    table = Table("case", "params", "threads", "seconds", "throughput", "speedup", "peak RSS (MB)", "kernel RSS (MB)")
+    for case in args.cases:
+        for params in grid(SUITES[args.suite][case]):
+            base = None
+            for threads in args.threads:
+                r = {"case": case, "params": params, "threads": threads, **spawn(case, params, threads, args.repeat)}
+                results.append(r)
+                if "error" in r:
+                    print(f"[red]{case} {params} failed: {r['error']}")
+                    continue
+                # Speedup relative to the first thread count of the same case
+                base = base or r["seconds"]
+                table.add_row(
+                    case,
+                    json.dumps(params),
+                    str(threads or os.cpu_count()),
+                    f"{r['seconds']:.3f}",
+                    f"{r['throughput']:.3g} {r['unit']}",
+                    f"{base / r['seconds']:.2f}x",
+                    f"{r['peak_rss_mb']:.0f}",
+                    f"{r['kernel_rss_mb']:.0f}",
+                )
+    Console().print(table)
+
+    commit = git_commit()
+    output = args.output or RESULTS_DIR / f"{commit}.json"
+    output.parent.mkdir(exist_ok=True, parents=True)
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "suite": args.suite,
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=1))
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
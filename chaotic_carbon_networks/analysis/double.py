@@ -10,11 +10,12 @@ from chaotic_carbon_networks.matrix import (
     laged_pearson_similarity_matrix,
     mutual_information_matrix,
     adjacency_matrix,
-    link_lengths_like,
     degrees,
     average_link_length,
+    node_measures,
 )
 from chaotic_carbon_networks.viz import plot_matrix_to_axis, plot_world_to_axis
+from chaotic_carbon_networks.profiling import stage
 from chaotic_carbon_networks import ROOT
 
 
@@ -47,50 +48,71 @@ def double_dataset(
     rr=0.05,
     saveto: str = None,
     svg=False,
+    fused=False,
 ):
-    """Expects dataset to be already aligned and corrected"""
+    """Expects dataset to be already aligned and corrected
 
-    x_is_hex = len(x.dims) == 2
-    y_is_hex = len(x.dims) == 2
-
-    if adj_method == "lagged_similarity":
-        m = laged_pearson_similarity_matrix(x, y)
-    elif adj_method == "mutual_information":
-        m = mutual_information_matrix(x, y)
-    else:
-        raise ValueError(f"adj_method must be one of {ADJ_METHODS}")
-
-    a = adjacency_matrix(m, rr)
-    ll = link_lengths_like(a)
-    avgll = average_link_length(a, ll)
-    deg = degrees(a)
-    dego = degrees(a, dim="vertex")
-    fig = plt.figure(layout="constrained", figsize=(40, 20))
-    gs = GridSpec(4, 4, figure=fig)
-
-    ax1 = fig.add_subplot(gs[:2, :2], projection=ccrs.PlateCarree())
-    plot_world_to_axis(deg, ax1, "plasma")
+    With `fused` the degrees and average link lengths are streamed by `node_measures` without storing any matrix,
+    the matrix plots are skipped then.
 
-    ax2 = fig.add_subplot(gs[2:, 2:], projection=ccrs.PlateCarree())
-    plot_world_to_axis(avgll, ax2, "cividis")
+    Every step is a profiled stage, see `chaotic_carbon_networks.profiling`.
+    """
 
-    ax3 = fig.add_subplot(gs[2:, :2], projection=ccrs.PlateCarree())
-    plot_world_to_axis(dego, ax3, "viridis")
-
-    ax4 = fig.add_subplot(gs[0, 2:])
-    plot_meanovertime(x, y, ax4)
-
-    ax5 = fig.add_subplot(gs[1, 2])
-    plot_matrix_to_axis(a, ax5)
-
-    ax6 = fig.add_subplot(gs[1, 3])
-    m.where(m > max(0, m.quantile(0.01))).plot.hist(bins=100, ax=ax6)
-
-    fig.suptitle(f"Full Network Analysis on {x.attrs['long_name']}")
+    x_is_hex = len(x.dims) == 2
+    y_is_hex = len(x.dims) == 2
 
-    if saveto:
-        if svg:
-            fig.savefig(FIG_DIR / f"{saveto}.svg")
-        fig.savefig(FIG_DIR / f"{saveto}.jpg")
+    with stage("double_dataset", adj_method=adj_method, rr=rr, fused=fused, shape=x.shape, shape_other=y.shape) as s:
+        s.output(x, y)
+        if fused:
+            with stage("node_measures") as s:
+                deg, avgll, dego = s.output(node_measures(x, y, method=adj_method, rr=rr))
+        else:
+            with stage("similarity", method=adj_method) as s:
+                if adj_method == "lagged_similarity":
+                    m = laged_pearson_similarity_matrix(x, y)
+                elif adj_method == "mutual_information":
+                    m = mutual_information_matrix(x, y)
+                else:
+                    raise ValueError(f"adj_method must be one of {ADJ_METHODS}")
+                s.output(m)
+
+            with stage("adjacency", rr=rr) as s:
+                a = s.output(adjacency_matrix(m, rr))
+            with stage("link_lengths") as s:
+                avgll = s.output(average_link_length(a))
+            with stage("degrees") as s:
+                deg = s.output(degrees(a))
+                dego = s.output(degrees(a, dim="vertex"))
+
+        with stage("plot"):
+            fig = plt.figure(layout="constrained", figsize=(40, 20))
+            gs = GridSpec(4, 4, figure=fig)
+
+            ax1 = fig.add_subplot(gs[:2, :2], projection=ccrs.PlateCarree())
+            plot_world_to_axis(deg, ax1, "plasma")
+
+            ax2 = fig.add_subplot(gs[2:, 2:], projection=ccrs.PlateCarree())
+            plot_world_to_axis(avgll, ax2, "cividis")
+
+            ax3 = fig.add_subplot(gs[2:, :2], projection=ccrs.PlateCarree())
+            plot_world_to_axis(dego, ax3, "viridis")
+
+            ax4 = fig.add_subplot(gs[0, 2:])
+            plot_meanovertime(x, y, ax4)
+
+            if not fused:
+                ax5 = fig.add_subplot(gs[1, 2])
+                plot_matrix_to_axis(a, ax5)
+
+                ax6 = fig.add_subplot(gs[1, 3])
+                m.where(m > max(0, m.quantile(0.01))).plot.hist(bins=100, ax=ax6)
+
+            fig.suptitle(f"Full Network Analysis on {x.attrs['long_name']}")
+
+        if saveto:
+            with stage("save", svg=svg):
+                if svg:
+                    fig.savefig(FIG_DIR / f"{saveto}.svg")
+                fig.savefig(FIG_DIR / f"{saveto}.jpg")
 
     return fig
@@ -10,12 +10,13 @@ from chaotic_carbon_networks.matrix import (
     laged_pearson_similarity_matrix,
     mutual_information_matrix,
     adjacency_matrix,
-    link_lengths_like,
     degrees,
     betweenness,
     average_link_length,
+    node_measures,
 )
 from chaotic_carbon_networks.viz import plot_matrix_to_axis, plot_world_to_axis
+from chaotic_carbon_networks.profiling import stage
 from chaotic_carbon_networks import ROOT
 
 
@@ -26,54 +27,83 @@ FIG_DIR.mkdir(exist_ok=True)
 ADJ_METHODS = Literal["similarity", "lagged_similarity", "mutual_information"]
 
 
-def single_dataset(x: xr.DataArray, adj_method: ADJ_METHODS = "similarity", rr=0.05, saveto: str = None, svg=False):
-    """Expects dataset to be already aligned and corrected"""
+def single_dataset(
+    x: xr.DataArray,
+    adj_method: ADJ_METHODS = "similarity",
+    rr=0.05,
+    saveto: str = None,
+    svg=False,
+    fused=False,
+):
+    """Expects dataset to be already aligned and corrected
+
+    With `fused` the degrees and average link lengths are streamed by `node_measures` without storing any matrix,
+    betweenness and the matrix plots are skipped then.
+
+    Every step is a profiled stage, see `chaotic_carbon_networks.profiling`.
+    """
 
     is_hex = len(x.dims) == 2
 
-    if adj_method == "similarity":
-        m = pearson_similarity_matrix(x)
-    elif adj_method == "lagged_similarity":
-        m = laged_pearson_similarity_matrix(x)
-    elif adj_method == "mutual_information":
-        m = mutual_information_matrix(x, bins=32)
-    else:
-        raise ValueError(f"adj_method must be one of {ADJ_METHODS}")
-
-    a = adjacency_matrix(m, rr)
-    ll = link_lengths_like(a)
-    avgll = average_link_length(a, ll)
-    deg = degrees(a)
-    bc = betweenness(a, k=100)
-    fig = plt.figure(layout="constrained", figsize=(40, 20))
-    gs = GridSpec(4, 4, figure=fig)
-
-    ax1 = fig.add_subplot(gs[:2, :2], projection=ccrs.PlateCarree())
-    plot_world_to_axis(deg, ax1, "plasma")
-
-    ax2 = fig.add_subplot(gs[2:, 2:], projection=ccrs.PlateCarree())
-    plot_world_to_axis(avgll, ax2, "cividis")
-
-    ax3 = fig.add_subplot(gs[2:, :2], projection=ccrs.PlateCarree())
-    plot_world_to_axis(bc, ax3, "viridis")
-
-    ax4 = fig.add_subplot(gs[0, 2:])
-    if is_hex:
-        x.mean(dim=["vertex"], keep_attrs=True).plot(ax=ax4)
-    else:
-        x.mean(dim=["lat", "lon"], keep_attrs=True).plot(ax=ax4)
-
-    ax5 = fig.add_subplot(gs[1, 2])
-    plot_matrix_to_axis(a, ax5)
-
-    ax6 = fig.add_subplot(gs[1, 3])
-    m.where(m > max(0, m.quantile(0.01))).plot.hist(bins=100, ax=ax6)
-
-    fig.suptitle(f"Full Network Analysis on {x.attrs['long_name']}")
-
-    if saveto:
-        if svg:
-            fig.savefig(FIG_DIR / f"{saveto}.svg")
-        fig.savefig(FIG_DIR / f"{saveto}.jpg")
+    with stage("single_dataset", adj_method=adj_method, rr=rr, fused=fused, shape=x.shape) as s:
+        s.output(x)
+        if fused:
+            with stage("node_measures") as s:
+                deg, avgll, _ = s.output(node_measures(x, method=adj_method, rr=rr, bins=32))
+        else:
+            with stage("similarity", method=adj_method) as s:
+                if adj_method == "similarity":
+                    m = pearson_similarity_matrix(x)
+                elif adj_method == "lagged_similarity":
+                    m = laged_pearson_similarity_matrix(x)
+                elif adj_method == "mutual_information":
+                    m = mutual_information_matrix(x, bins=32)
+                else:
+                    raise ValueError(f"adj_method must be one of {ADJ_METHODS}")
+                s.output(m)
+
+            with stage("adjacency", rr=rr) as s:
+                a = s.output(adjacency_matrix(m, rr))
+            with stage("link_lengths") as s:
+                avgll = s.output(average_link_length(a))
+            with stage("degrees") as s:
+                deg = s.output(degrees(a))
+            with stage("betweenness", k=100) as s:
+                bc = s.output(betweenness(a, k=100))
+
+        with stage("plot"):
+            fig = plt.figure(layout="constrained", figsize=(40, 20))
+            gs = GridSpec(4, 4, figure=fig)
+
+            ax1 = fig.add_subplot(gs[:2, :2], projection=ccrs.PlateCarree())
+            plot_world_to_axis(deg, ax1, "plasma")
+
+            ax2 = fig.add_subplot(gs[2:, 2:], projection=ccrs.PlateCarree())
+            plot_world_to_axis(avgll, ax2, "cividis")
+
+            if not fused:
+                ax3 = fig.add_subplot(gs[2:, :2], projection=ccrs.PlateCarree())
+                plot_world_to_axis(bc, ax3, "viridis")
+
+            ax4 = fig.add_subplot(gs[0, 2:])
+            if is_hex:
+                x.mean(dim=["vertex"], keep_attrs=True).plot(ax=ax4)
+            else:
+                x.mean(dim=["lat", "lon"], keep_attrs=True).plot(ax=ax4)
+
+            if not fused:
+                ax5 = fig.add_subplot(gs[1, 2])
+                plot_matrix_to_axis(a, ax5)
+
+                ax6 = fig.add_subplot(gs[1, 3])
+                m.where(m > max(0, m.quantile(0.01))).plot.hist(bins=100, ax=ax6)
+
+            fig.suptitle(f"Full Network Analysis on {x.attrs['long_name']}")
+
+        if saveto:
+            with stage("save", svg=svg):
+                if svg:
+                    fig.savefig(FIG_DIR / f"{saveto}.svg")
+                fig.savefig(FIG_DIR / f"{saveto}.jpg")
 
     return fig
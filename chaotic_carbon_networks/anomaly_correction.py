@@ -1,20 +1,119 @@
+import numpy as np
 import xarray as xr
 from typing import Literal
+from rich import print
+import hashlib
 
+from chaotic_carbon_networks import ROOT
+from chaotic_carbon_networks.cache import save_cache, open_cached_dataarray
 
-def anomaly_correction_week(da: xr.DataArray):
-    """Corrects the GRACE anomalies for the weekly cycle"""
+CorrectMethod = Literal["month", "week", "weekday"]
+
+DATA_DIR = ROOT / "data"
+CACHE_DIR = DATA_DIR / "anomaly" / "cache"
+
+
+def climatology_groups(da: xr.DataArray, method: CorrectMethod = "month") -> xr.DataArray:
+    """Returns the group of every time step of the cycle which is corrected with `method`"""
+    if method == "month":
+        return da.time.dt.month
+    elif method == "week":
+        return da.time.dt.isocalendar().week
+    elif method == "weekday":
+        return da.time.dt.dayofweek
+    else:
+        raise ValueError(f"method must be one of {CorrectMethod}")
+
+
+def grid_key(da: xr.DataArray) -> str:
+    """Key of the cells of a hexgrid (vertex) or lat/lon grid, e.g. `res3_<hash of the hex ids>`"""
+    if "vertex" in da.dims:
+        prefix = f"res{da.vertex.attrs['hex_res']}" if "hex_res" in da.vertex.attrs else "vertex"
+        data = np.asarray(da.vertex.values).tobytes()
+    else:
+        prefix = "latlon"
+        data = np.asarray(da.lat.values, dtype=np.float64).tobytes() + np.asarray(da.lon.values, dtype=np.float64).tobytes()
+    return f"{prefix}_{hashlib.sha1(data).hexdigest()[:16]}"
+
+
+def time_key(da: xr.DataArray) -> str:
+    """Key of the time steps, e.g. `2015-01-01_2018-12-31_n1461_<hash of the time steps>`"""
+    time = np.asarray(da.time.values)
+    if np.issubdtype(time.dtype, np.datetime64):
+        first, last = np.datetime_as_string(time[[0, -1]], unit="D") if len(time) else ("none", "none")
+    else:
+        first, last = (str(time[0]), str(time[-1])) if len(time) else ("none", "none")
+    digest = hashlib.sha1(time.astype(str).tobytes()).hexdigest()[:8]
+    return f"{first}_{last}_n{len(time)}_{digest}"
+
+
+def climatology(da: xr.DataArray, method: CorrectMethod = "month", dataset: str = None, force=False) -> xr.DataArray:
+    """Calculates the mean of every group (month, week or weekday) of the cycle over time.
+
+    For dask-backed data the sums and counts of all groups are calculated in a single pass. If `dataset` is given,
+    the climatology is cached per (dataset, method, grid cells, time steps, dtype) at the dtype of the data, so that
+    repeated runs reuse it and a cached run gives the same anomalies as an uncached one.
+
+    Args:
+        da (xr.DataArray): DataArray with a time dimension, on a hexgrid (vertex) or lat/lon grid
+        method (CorrectMethod, optional): The cycle. Defaults to "month".
+        dataset (str, optional): Name of the dataset for caching. Defaults to None (no caching).
+        force (bool, optional): Recalculate a cached climatology. Defaults to False.
+
+    Returns:
+        xr.DataArray: The climatology with the group dimension instead of time
+    """
+    cached = None
+    if dataset is not None:
+        CACHE_DIR.mkdir(exist_ok=True, parents=True)
+        key = f"{grid_key(da)}_{time_key(da)}_{da.dtype}"
+        cached = CACHE_DIR / f"climatology_{dataset}_{method}_{key}.zarr"
+        if cached.exists() and not force:
+            print(f"Loading cached climatology from {cached}")
+            return open_cached_dataarray(cached).load()
+
+    clim = da.groupby(climatology_groups(da, method)).mean("time").compute()
+
+    if cached is not None:
+        print(f"Saving climatology to {cached}")
+        save_cache(clim, cached, float32=False)
+    return clim
+
+
+def anomaly_correction(da: xr.DataArray, method: CorrectMethod = "month", dataset: str = None, force=False):
+    """Corrects the anomalies for a cycle by subtracting the (cached) climatology of every group.
+
+    Dask-backed or lazily opened data stays lazy, only the climatology is computed.
+
+    Args:
+        da (xr.DataArray): DataArray with a time dimension, on a hexgrid (vertex) or lat/lon grid
+        method (CorrectMethod, optional): The cycle: "month" (seasonal), "week" or "weekday". Defaults to "month".
+        dataset (str, optional): Name of the dataset for caching the climatology. Defaults to None (no caching).
+        force (bool, optional): Recalculate a cached climatology. Defaults to False.
+
+    Returns:
+        xr.DataArray: The anomalies
+    """
     attrs = da.attrs.copy()
-    da = da.groupby("time.week") - da.groupby("time.week").mean("time")
+    clim = climatology(da, method, dataset, force)
+    groups = climatology_groups(da, method)
+    da = da.groupby(groups) - clim
+    da = da.drop_vars(groups.name, errors="ignore")
     da.attrs = attrs
     da.attrs["long_name"] += " Anomaly"
     return da
 
 
+def anomaly_correction_week(da: xr.DataArray):
+    """Corrects the GRACE anomalies for the weekly cycle"""
+    return anomaly_correction(da, "week")
+
+
 def anomaly_correction_month(da: xr.DataArray):
     """Corrects the GRACE anomalies for the seasonal cycle"""
-    attrs = da.attrs.copy()
-    da = da.groupby("time.month") - da.groupby("time.month").mean("time")
-    da.attrs = attrs
-    da.attrs["long_name"] += " Anomaly"
-    return da
+    return anomaly_correction(da, "month")
+
+
+def anomaly_correction_weekday(da: xr.DataArray):
+    """Corrects the GRACE anomalies for the weekday cycle"""
+    return anomaly_correction(da, "weekday")
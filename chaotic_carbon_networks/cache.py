@@ -0,0 +1,93 @@
+from pathlib import Path
+from typing import Union
+import numpy as np
+import xarray as xr
+import numcodecs
+import shutil
+import os
+
+# Number of vertices per chunk, the time dimension is never split, so a chunk is a contiguous [time, vertex] block
+VERTEX_CHUNK = 1024
+# Bytes per chunk of lat/lon grids, which are split along time only, since lat and lon are the core dimensions
+# of `hexgrid` (and of the masks), which must not be split
+LATLON_CHUNK_BYTES = 64 * 2**20
+
+COMPRESSOR = numcodecs.Blosc(cname="zstd", clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+
+def chunk_sizes(da: xr.DataArray, vertex_chunk: int = VERTEX_CHUNK) -> tuple[int, ...]:
+    """Chunks of a variable for reading blocks of vertices with all their time steps.
+
+    Lat/lon grids keep the full grid in every chunk and are split into blocks of time steps instead.
+    """
+    is_grid = "lat" in da.dims and "lon" in da.dims
+    grid_bytes = da.sizes["lat"] * da.sizes["lon"] * 4 if is_grid else 0
+    chunks = []
+    for dim, size in zip(da.dims, da.shape):
+        if dim in ("vertex", "vertex_other"):
+            chunks.append(min(size, vertex_chunk))
+        elif dim == "time" and is_grid:
+            chunks.append(min(size, max(1, LATLON_CHUNK_BYTES // grid_bytes)))
+        else:
+            chunks.append(size)
+    return tuple(chunks)
+
+
+def save_cache(data: Union[xr.DataArray, xr.Dataset], path: Path, vertex_chunk: int = VERTEX_CHUNK, float32=True):
+    """Writes a DataArray or Dataset into a chunked and compressed Zarr store, floats are stored as float32 by default.
+
+    Data with a time dimension is stored as [time, vertex] with the full time series in every chunk, so that
+    reading a block of vertices decodes only the chunks of these vertices. Lat/lon grids are stored as
+    [time, lat, lon] with the full grid in every chunk, so that they can be passed to `hexgrid` as they are.
+    Dask-backed data is written chunk by chunk. The store is written next to `path` first and then moved,
+    so that an interrupted run never leaves a broken cache behind.
+
+    Args:
+        data (xr.DataArray | xr.Dataset): The data to cache
+        path (Path): Path of the `.zarr` store
+        vertex_chunk (int, optional): Number of vertices per chunk. Defaults to VERTEX_CHUNK.
+        float32 (bool, optional): Store floats as float32, else at their dtype. Defaults to True.
+    """
+    ds = data.to_dataset(name=data.name or "data") if isinstance(data, xr.DataArray) else data
+    order = [d for d in ("time", "vertex", "vertex_other", "lat", "lon") if d in ds.dims]
+    ds = ds.transpose(*order, ...)
+
+    # Drop the encodings of the source files (e.g. netCDF chunks), which do not apply to the store
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {}
+
+    encoding = {}
+    for name in list(ds.data_vars):
+        var = ds[name]
+        chunks = chunk_sizes(var, vertex_chunk)
+        encoding[name] = {"chunks": chunks, "compressor": COMPRESSOR}
+        if float32 and np.issubdtype(var.dtype, np.floating):
+            encoding[name]["dtype"] = np.float32
+        # The chunks of dask must be aligned with the chunks of the store
+        if var.chunks:
+            ds[name] = var.chunk(dict(zip(var.dims, chunks)))
+
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    ds.to_zarr(tmp, mode="w", encoding=encoding, consolidated=True)
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def open_cached_dataset(path: Path) -> xr.Dataset:
+    """Lazily opens a cache written with `save_cache`, every variable is backed by its Zarr chunks"""
+    return xr.open_zarr(path, consolidated=True)
+
+
+def open_cached_dataarray(path: Path) -> xr.DataArray:
+    """Lazily opens a DataArray cached with `save_cache`.
+
+    The values are stored as float32 in [time, vertex] order, so `.values` (e.g. in `xrmatrix_from_func`)
+    decodes the chunks directly into the array handed to the kernels, without a further copy or conversion.
+    """
+    ds = open_cached_dataset(path)
+    assert len(ds.data_vars) == 1, f"{path} must contain exactly one variable"
+    return ds[next(iter(ds.data_vars))]
@@ -1,69 +1,216 @@
-import functools
-import shutil
-import requests
-from tqdm.auto import tqdm as atqdm
-from multiprocessing import Pool
-from tqdm import tqdm
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from rich.progress import track
 from rich import print
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+import requests
+import hashlib
+import json
+import time
+import os
 
 from chaotic_carbon_networks import ROOT
 
 DATA_DIR = ROOT / "data" / "aqua-airs"
 RAW_DIR = DATA_DIR / "raw"
-RAW_DIR.mkdir(parents=True, exist_ok=True)
 
+# Errors during a transfer, after which the download is resumed from the partial file
+TRANSFER_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def create_session(pool_size=16, retries=5, backoff=1.0) -> requests.Session:
+    """Creates a session whose connections are pooled and reused by all downloads (and threads).
+
+    Failed connections and responses with the status codes 429, 500, 502, 503 and 504 are retried with exponential
+    backoff. The credentials are read from `~/.netrc` and the cookies are kept in the session, see
+    [How to Generate Earthdata Prerequisite Files](https://disc.gsfc.nasa.gov/information/howto?title=How%20to%20Generate%20Earthdata%20Prerequisite%20Files)
+
+    Args:
+        pool_size (int, optional): Maximum number of connections per host, should be at least the number of workers. Defaults to 16.
+        retries (int, optional): Number of retries per request. Defaults to 5.
+        backoff (float, optional): Backoff factor of the retries in seconds. Defaults to 1.0.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def url_filename(url: str) -> str:
+    return url.strip().split("/")[-1].split("?")[0]
+
+
+def sha256(path: Path, chunk_size=1 << 20) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Sizes and SHA-256 checksums of the downloaded files, stored as JSON next to them.
 
-def download(url):
-    """Downloads aqua-airs data from the given URL. You must set cookies etc. first to download the data: [How to Generate Earthdata Prerequisite Files](https://disc.gsfc.nasa.gov/information/howto?title=How%20to%20Generate%20Earthdata%20Prerequisite%20Files)
+    A file counts as downloaded if it is in the manifest and its size (and with `verify` its checksum) matches,
+    so files which are missing, incomplete or corrupt are downloaded again. The manifest can be shared by threads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = Lock()
+        self.entries = json.loads(path.read_text()) if path.exists() else {}
+
+    def is_complete(self, file: Path, verify=False) -> bool:
+        entry = self.entries.get(file.name)
+        if entry is None or not file.exists() or file.stat().st_size != entry["size"]:
+            return False
+        return not verify or sha256(file) == entry["sha256"]
+
+    def add(self, file: Path):
+        entry = {"size": file.stat().st_size, "sha256": sha256(file)}
+        with self.lock:
+            self.entries[file.name] = entry
+            # Write to a temporary file first, so that an interrupted run never leaves a broken manifest behind
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+            os.replace(tmp, self.path)
+
+
+def download(
+    url: str,
+    raw_dir: Path = RAW_DIR,
+    session: requests.Session = None,
+    manifest: Manifest = None,
+    verify=False,
+    retries=5,
+    backoff=1.0,
+    chunk_size=1 << 16,
+) -> Path:
+    """Downloads a file (e.g. an AIRS granule) into raw_dir, unless it is already complete.
+
+    The data is streamed into a `.part` file. If the transfer breaks, it is resumed with an HTTP Range request
+    after an exponential backoff, also in later runs. Only complete files are moved to their final name
+    and added to the manifest.
 
     Args:
         url (str): The url from the subset file
+        raw_dir (Path, optional): Directory of the downloaded files. Defaults to RAW_DIR.
+        session (requests.Session, optional): Session to reuse. Defaults to None (a new session).
+        manifest (Manifest, optional): Manifest of the downloaded files. Defaults to None (the one in raw_dir).
+        verify (bool, optional): Also compare the checksums of already downloaded files. Defaults to False.
+        retries (int, optional): Number of resumes after a broken transfer. Defaults to 5.
+        backoff (float, optional): Backoff factor of the resumes in seconds. Defaults to 1.0.
+        chunk_size (int, optional): Bytes per read, a broken transfer resumes after the last complete read. Defaults to 64 KiB.
 
     Raises:
-        RuntimeError: Non-200 Return Code
+        requests.HTTPError: Error status code (after the retries of the session)
+        RuntimeError: Incomplete file after all retries
 
     Returns:
         Path: Resulting Path
+    """
+    url = url.strip()
+    raw_dir = Path(raw_dir)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    session = session or create_session()
+    manifest = manifest or Manifest(raw_dir / "manifest.json")
+
+    path = raw_dir / url_filename(url)
+    if manifest.is_complete(path, verify):
+        return path
+
+    part = path.with_name(path.name + ".part")
+    for attempt in range(retries + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        # Without content encoding the ranges and lengths refer to the bytes of the file
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        try:
+            with session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=60) as r:
+                if r.status_code == 416:
+                    # The range starts at the end of the remote file: the partial file is complete if it has its size,
+                    # otherwise (e.g. larger or stale) it is discarded and downloaded again
+                    size = r.headers.get("Content-Range", "").rpartition("/")[2]
+                    if size.isdigit() and int(size) == offset:
+                        break
+                    print(f"Partial download of {path.name} does not match the remote file, starting again")
+                    part.unlink()
+                    continue
+                r.raise_for_status()
+                if r.status_code != 206:
+                    # The server ignored the range, so start from scratch
+                    offset = 0
+                size = offset + int(r.headers.get("Content-Length", 0))
+                with part.open("ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk)
+            if "Content-Length" not in r.headers or part.stat().st_size == size:
+                break
+        except TRANSFER_ERRORS as e:
+            print(f"Download of {path.name} broke ({e.__class__.__name__}), retrying")
+        if attempt < retries:
+            time.sleep(backoff * 2**attempt)
+    else:
+        raise RuntimeError(f"Download of {url} is incomplete after {retries} retries")
+
+    os.replace(part, path)
+    manifest.add(path)
+    return path
+
+
+def download_all(urls: list[str], raw_dir: Path = RAW_DIR, workers=8, verify=False, **kwargs) -> list[Path]:
+    """Downloads all urls concurrently with a thread pool, which shares one pooled session and the manifest.
 
-    Usage:
+    Files which are already complete are skipped, so an interrupted sync can simply be started again.
 
-    ```py
-    from multiprocessing import Pool
-    from tqdm import tqdm
+    Args:
+        urls (list[str]): The urls, e.g. from a subset file (see `read_subset_file`)
+        raw_dir (Path, optional): Directory of the downloaded files. Defaults to RAW_DIR.
+        workers (int, optional): Number of concurrent downloads. Defaults to 8.
+        verify (bool, optional): Also compare the checksums of already downloaded files. Defaults to False.
+        **kwargs: Further arguments of `download`
 
-    subset_file = "..." # DATA_DIR / "subset_SNDRAQIL3CMCCP_2_20240319_201838_.txt"
-    with open(subset_file) as f:
-        urls = f.readlines()
-        with Pool(12) as p:
-            r = list(tqdm(p.imap(download, urls), total=len(urls)))
-            print(r)
-    ```
+    Returns:
+        list[Path]: The downloaded files in the order of urls
     """
+    raw_dir = Path(raw_dir)
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    session = kwargs.pop("session", None) or create_session(pool_size=workers)
+    manifest = Manifest(raw_dir / "manifest.json")
 
-    url = url.strip()
-    filename = url.split("/")[-1].split("?")[0]
-    print(filename.split(".")[2])
-    r = requests.get(url, stream=True, allow_redirects=True)
-    if r.status_code != 200:
-        r.raise_for_status()  # Will only raise for 4xx codes, so...
-        raise RuntimeError(f"Request to {url} returned status code {r.status_code}")
-    file_size = int(r.headers.get("Content-Length", 0))
-
-    path = (RAW_DIR / filename).expanduser().resolve()
-    path.parent.mkdir(parents=True, exist_ok=True)
-
-    desc = "(Unknown total file size)" if file_size == 0 else ""
-    r.raw.read = functools.partial(r.raw.read, decode_content=True)  # Decompress if needed
-    with atqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw:
-        with path.open("wb") as f:
-            shutil.copyfileobj(r_raw, f)
+    paths = [raw_dir / url_filename(url) for url in urls]
+    todo = [url for url, path in zip(urls, paths) if not manifest.is_complete(path, verify)]
+    print(f"Downloading {len(todo)} of {len(urls)} files")
 
-    return path
+    failed = []
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(download, url, raw_dir, session, manifest, verify, **kwargs): url for url in todo}
+        for future in track(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except (RuntimeError, requests.RequestException) as e:
+                print(f"Failed to download {futures[future].strip()}: {e}")
+                failed.append(futures[future])
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(todo)} downloads failed, run again to resume them")
+    return paths
+
+
+def read_subset_file(subset_file: Path) -> list[str]:
+    """Reads the urls of a subset file, as exported by the GES DISC"""
+    return [url.strip() for url in Path(subset_file).read_text().splitlines() if url.strip()]
 
 
 if __name__ == "__main__":
-    with open(DATA_DIR / "subset_SNDRAQIL3CMCCP_2_20240319_201838_.txt") as f:
-        urls = f.readlines()
-        with Pool(12) as p:
-            r = list(tqdm(p.imap(download, urls), total=len(urls)))
-            print(r)
+    download_all(read_subset_file(DATA_DIR / "subset_SNDRAQIL3CMCCP_2_20240319_201838_.txt"))
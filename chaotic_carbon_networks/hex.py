@@ -3,8 +3,10 @@ import h3
 import pandas as pd
 from typing import Literal
 import numpy as np
-from numba import njit
 import pickle
+import hashlib
+import os
+import scipy.sparse as sp
 from shapely.geometry import Polygon
 
 from chaotic_carbon_networks import ROOT
@@ -65,18 +67,122 @@ def h3_to_geom(x):
     return Polygon(b)  # if not crosses_antimeridian else None
 
 
-def hexgrid(x: xr.DataArray, method: ResampleMethod = "mean", hex_res: int = 2):
+def hex_centroids(hex_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the lats and lons of the centroids of the hex ids in degrees"""
+    latlons = np.array([h3.h3_to_geo(str(hex(h))[2:]) for h in np.asarray(hex_ids).tolist()]).reshape(-1, 2)
+    return latlons[:, 0], latlons[:, 1]
+
+
+def all_hexes(hex_res: int) -> np.ndarray:
+    """Returns the sorted ids of all hexes of the globe at hex_res"""
+    hexes = [c for h in h3.get_res0_indexes() for c in h3.h3_to_children(h, hex_res)]
+    return np.sort(np.array([int(h, base=16) for h in hexes], dtype=np.int64))
+
+
+# In-process cache of the hex boundaries per hex_res, filled lazily
+BOUNDARIES: dict[int, dict[int, np.ndarray]] = {}
+
+
+def hex_boundaries(hex_ids: np.ndarray, hex_res: int) -> list[np.ndarray]:
+    """Returns the (lon, lat) boundary of every hex, cached per hex_res, with the same antimeridian fix as h3_to_geom"""
+    cache = BOUNDARIES.setdefault(hex_res, {})
+    boundaries = []
+    for h in np.asarray(hex_ids).tolist():
+        if h not in cache:
+            b = np.array(h3.h3_to_geo_boundary(str(hex(h))[2:], geo_json=True))
+            if -90 > b[:, 0].min() and 90 < b[:, 0].max():
+                b[b[:, 0] < -90, 0] += 360
+            cache[h] = b
+        boundaries.append(cache[h])
+    return boundaries
+
+
+# In-process cache of the aggregation operators, keyed like their cache files
+OPERATORS: dict[str, tuple[np.ndarray, sp.csr_array]] = {}
+
+
+def hex_operator(lats: np.ndarray, lons: np.ndarray, hex_res: int = 2) -> tuple[np.ndarray, sp.csr_array]:
+    """Returns the sparse operator which aggregates the cells of a lat/lon grid into hex-bins.
+
+    The operator is built once per (grid, hex_res) and cached on disk and in-process.
+    Row i of the operator holds ones at the (row-major) lat/lon cells which fall into the hex hex_ids[i].
+
+    Args:
+        lats (np.ndarray): Latitudes of the grid
+        lons (np.ndarray): Longitudes of the grid
+        hex_res (int, optional): Resolution of the hexgrid. Defaults to 2.
+
+    Returns:
+        tuple[np.ndarray, sp.csr_array]: The sorted hex ids and the operator of shape [hex, lat * lon]
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    grid_hash = hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()[:16]
+    key = f"hex_operator_{hex_res}_{grid_hash}"
+    if key in OPERATORS:
+        return OPERATORS[key]
+
+    cache_fname = CACHE_DIR / f"{key}.npy"
+    if cache_fname.exists():
+        cell_hex = np.load(cache_fname)
+    else:
+        cell_hex = np.array(
+            [int(h3.geo_to_h3(lat, lon, hex_res), base=16) for lat in lats for lon in lons], dtype=np.int64
+        )
+        # Write to a temporary file first, so that parallel workers never read a partial cache file
+        tmp = cache_fname.with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp, cell_hex)
+        os.replace(tmp, cache_fname)
+
+    hex_ids, rows = np.unique(cell_hex, return_inverse=True)
+    op = sp.csr_array(
+        (np.ones(len(cell_hex), dtype=np.float32), (rows, np.arange(len(cell_hex)))),
+        shape=(len(hex_ids), len(cell_hex)),
+    )
+    op.sort_indices()
+    OPERATORS[key] = (hex_ids, op)
+    return hex_ids, op
+
+
+def aggregate_cells(v: np.ndarray, op: sp.csr_array, method: ResampleMethod = "mean") -> np.ndarray:
+    """Aggregates the last two (lat, lon) axes of v into the rows of the operator, NaNs are skipped."""
+    shape = v.shape[:-2]
+    v = v.reshape(-1, v.shape[-2] * v.shape[-1])
+    if method == "mean":
+        # The mean of integers is a float
+        v = v.astype(np.result_type(v.dtype, np.float32), copy=False)
+    if method in ("sum", "mean"):
+        op = op.astype(v.dtype, copy=False)
+        valid = ~np.isnan(v)
+        res = (op @ np.where(valid, v, 0).T).T
+        if method == "mean":
+            count = (op @ valid.T.astype(v.dtype)).T
+            res = np.divide(res, count, out=np.full_like(res, np.nan), where=count > 0)
+    elif method in ("max", "min"):
+        # The columns of every row are sorted, so the cells of each hex are one contiguous segment
+        reduce = np.fmax if method == "max" else np.fmin
+        res = reduce.reduceat(v[:, op.indices], op.indptr[:-1], axis=1)
+    else:
+        raise ValueError(f"Method {method} not supported")
+    return res.reshape(*shape, op.shape[0])
+
+
+def hexgrid(x: xr.DataArray, method: ResampleMethod = "mean", hex_res: int = 2, valid: xr.DataArray = None):
     """Convert a DataArray to a hexagonal grid -> flattened DataArray with hexagonal coordinates.
     Workflow of this function:
-    1. LatLon to hex
-    2. Groupby hex
-    3. Hex to LatLon
+    1. Get the (cached) sparse aggregation operator of the lat/lon grid
+    2. Drop the hexes which only contain cells that are always NaN
+    3. Aggregate all other dimensions at once with the operator
+
+    Dask-backed data stays lazy: the valid cells are then taken from `valid` and without it all hexes of the grid
+    are kept, so the data is never read just to find the empty hexes.
 
     Args:
         x (xr.DataArray): DataArray to convert
         method (ResampleMethod, optional): How the values of each hex-bin should be calculated. Defaults to "mean".
         hex_res (int, optional): Resolution of the hexgrid. 0 is largest. Defaults to 2.
-        final_res (int, optional): Lat Lon Coordinate roundup. 0 means 1 deg resolution. 1 means 0.1 deg resolution. Defaults to 0.
+        valid (xr.DataArray, optional): Static [lat, lon] mask of the cells which are not always NaN, e.g. the
+            inverse of the masks applied to x. Defaults to None (taken from the data, unless it is dask-backed).
 
     Returns:
         xr.DataArray: DataArray with hexagonal coordinates
@@ -84,62 +190,122 @@ def hexgrid(x: xr.DataArray, method: ResampleMethod = "mean", hex_res: int = 2):
     assert len(x.dims) >= 2, "x must have at least 2 dimensions"
     assert "lat" in x.dims, "lat must be in x.dims"
     assert "lon" in x.dims, "lon must be in x.dims"
+    if method not in ("mean", "max", "min", "sum"):
+        raise ValueError(f"Method {method} not supported")
+
+    hex_ids, op = hex_operator(x.lat.values, x.lon.values, hex_res=hex_res)
+
+    if valid is None and not x.chunks:
+        # Read lazily opened files once, the aggregation reuses the loaded data
+        x = x.compute()
+        valid = x.notnull()
+        other_dims = [d for d in x.dims if d not in ("lat", "lon")]
+        if other_dims:
+            valid = valid.any(dim=other_dims)
 
-    # Stack lat and lon into a single dimension called vertex
-    x_stacked = x.stack(vertex=("lat", "lon")).dropna(dim="vertex", how="all")
-    # Convert lat and lon to hexagonal coordinates and assign them to the vertex dimension
-    x_stacked = latlon_to_hex(x_stacked, hex_res=hex_res)
-
-    # Aggregate the data based on the hexagonal coordinates
-    if method == "sum":
-        x_stacked = x_stacked.groupby("vertex").sum()
-    elif method == "mean":
-        x_stacked = x_stacked.groupby("vertex").mean()
-    elif method == "max":
-        x_stacked = x_stacked.groupby("vertex").max()
-    elif method == "min":
-        x_stacked = x_stacked.groupby("vertex").min()
+    # Only keep the hexes with at least one cell that is not always NaN, or the non-empty rows of the operator
+    if valid is None:
+        keep = np.diff(op.indptr) > 0
     else:
-        raise ValueError(f"Method {method} not supported")
+        cell_valid = valid.transpose("lat", "lon").values.ravel()
+        keep = (op @ cell_valid.astype(np.float32)) > 0
+    hex_ids, op = hex_ids[keep], op[keep]
+
+    # lat and lon are the core dimensions, so every dask chunk must contain the full grid
+    if x.chunks:
+        x = x.chunk({"lat": -1, "lon": -1})
+
+    x_hex = xr.apply_ufunc(
+        aggregate_cells,
+        x,
+        kwargs={"op": op, "method": method},
+        input_core_dims=[["lat", "lon"]],
+        output_core_dims=[["vertex"]],
+        dask="parallelized",
+        output_dtypes=[np.result_type(x.dtype, np.float32) if method == "mean" else x.dtype],
+        keep_attrs=True,
+        dask_gufunc_kwargs={"output_sizes": {"vertex": len(hex_ids)}},
+    )
+    x_hex = x_hex.assign_coords(vertex=hex_ids)
+
+    x_hex.coords["vertex"].attrs["hex_res"] = hex_res
 
-    # x_stacked = hex_to_latlon(x_stacked, final_res=final_res)
+    return x_hex
 
-    x_stacked.coords["vertex"].attrs["hex_res"] = hex_res
 
-    return x_stacked
+# In-process cache of the hex rasters, keyed like their cache files
+RASTERS: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+
+def hex_raster(hex_res: int, res=1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the hex id of every pixel of a world-grid, cached on disk and in-process.
+
+    Args:
+        hex_res (int): Resolution of the hexgrid
+        res (int, optional): Resolution of the world-grid in degrees. Defaults to 1.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Latitudes, longitudes and the hex ids of shape [lat, lon]
+    """
+    lats = np.arange(-90, 90, res)
+    lons = np.arange(-180, 180, res)
+    key = f"hex_raster_{hex_res}_{res}"
+    if key in RASTERS:
+        return RASTERS[key]
+
+    cache_fname = CACHE_DIR / f"{key}.npy"
+    if cache_fname.exists():
+        raster = np.load(cache_fname)
+    else:
+        raster = np.array(
+            [[int(h3.geo_to_h3(lat, lon, hex_res), base=16) for lon in lons] for lat in lats], dtype=np.int64
+        )
+        tmp = cache_fname.with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp, raster)
+        os.replace(tmp, cache_fname)
+
+    RASTERS[key] = (lats, lons, raster)
+    return lats, lons, raster
 
 
 def filledgrid_from_hexgrid(x: xr.DataArray, res=1) -> xr.DataArray:
     """Creates a world-grid with lat/lon coordinates from a hexgrid. Should only be used for visualization purposes.
 
+    All other dimensions are kept, so e.g. a time series of [time, vertex] becomes [time, lat, lon] at once.
+
     Args:
         x (xr.DataArray): DataArray with hexagonal coordinates
         res (int, optional): Final resolution in degrees. Defaults to 1.
 
     Returns:
-        _type_: _description_
+        xr.DataArray: DataArray with lat/lon coordinates instead of the vertex dimension
     """
-    assert len(x.dims) == 1, "x must have 1 dimension"
     assert "vertex" in x.dims, "vertex must be in x.dims"
     assert "hex_res" in x.coords["vertex"].attrs, "hex_res must be in x.coords['vertex'].attrs"
 
     hex_res = x.coords["vertex"].attrs["hex_res"]
-    # hex_idx = np.array([int(h3.geo_to_h3(v.lat.item(), v.lon.item(), hex_res), base=16) for v in x.vertex])
-    hex_coords = x.coords["vertex"].values
-    x_vals = x.values
+    lats, lons, raster = hex_raster(hex_res, res)
 
-    @njit()
-    def get_v(h: int):
-        res = np.where(hex_coords == h)[0]
-        return x_vals[res[0]] if len(res) > 0 else np.nan
+    # Position of the hex of every pixel in the vertex dimension, pixels of missing hexes point to a NaN column
+    hex_coords = x.coords["vertex"].values.astype(np.int64)
+    sorter = np.argsort(hex_coords)
+    pos = np.searchsorted(hex_coords, raster, sorter=sorter).clip(max=len(hex_coords) - 1)
+    idx = sorter[pos]
+    idx[hex_coords[idx] != raster] = len(hex_coords)
 
-    lats = np.arange(-90, 90, res)
-    lons = np.arange(-180, 180, res)
-    g = np.zeros((len(lats), len(lons)))
-    for i, lat in enumerate(lats):
-        for j, lon in enumerate(lons):
-            h = int(h3.geo_to_h3(lat, lon, hex_res), base=16)
-            g[i, j] = get_v(h)
-    da = xr.DataArray(g, coords={"lat": lats, "lon": lons}, dims=["lat", "lon"], attrs=x.attrs, name=x.name)
+    x = x.transpose(..., "vertex")
+    x_vals = x.values.astype(np.float64)
+    x_vals = np.concatenate([x_vals, np.full((*x_vals.shape[:-1], 1), np.nan)], axis=-1)
+    g = x_vals[..., idx]
+
+    other_dims = x.dims[:-1]
+    coords = {d: x.coords[d] for d in other_dims if d in x.coords}
+    da = xr.DataArray(
+        g,
+        coords={**coords, "lat": lats, "lon": lons},
+        dims=[*other_dims, "lat", "lon"],
+        attrs=x.attrs,
+        name=x.name,
+    )
 
     return da
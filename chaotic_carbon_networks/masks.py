@@ -1,43 +1,236 @@
 from pathlib import Path
+import numpy as np
 import xarray as xr
-import rioxarray as rxr
+import rasterio
+from rasterio.windows import Window
 from rich import print
+from rich.progress import track
 import geopandas as gpd
 import regionmask
+import hashlib
 
 from chaotic_carbon_networks import ROOT
+from chaotic_carbon_networks.cache import save_cache, open_cached_dataarray
+from chaotic_carbon_networks.hex import hexgrid, hex_centroids, all_hexes
 
 DATA_DIR = ROOT / "data" / "population"
 CACHE_DIR = DATA_DIR / "cache"
-CACHE_DIR.mkdir(exist_ok=True, parents=True)
+POPULATION_TIF = DATA_DIR / "GHS_POP_E2020_GLOBE_R2023A_4326_30ss_V1_0.tif"
+
+OCEAN_DIR = ROOT / "data" / "ocean"
+OCEAN_CACHE_DIR = OCEAN_DIR / "cache"
+OCEAN_SHP = OCEAN_DIR / "ne_10m_ocean.shp"
+
+
+def grid_hash(lats: np.ndarray, lons: np.ndarray) -> str:
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    return hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()[:16]
+
+
+def latitudes(da: xr.DataArray) -> xr.DataArray:
+    """The latitudes of the cells of a lat/lon grid or of the hex centroids of a hexgrid (vertex)"""
+    if "vertex" in da.dims:
+        lats, _ = hex_centroids(da.vertex.values)
+        return xr.DataArray(lats, dims="vertex", coords={"vertex": da.vertex})
+    return da.lat
+
+
+def ocean_grid(lats: np.ndarray, lons: np.ndarray, force=False) -> xr.DataArray:
+    """Rasterizes the Natural Earth ocean polygons onto a lat/lon grid, cached per grid.
+
+    Returns:
+        xr.DataArray: Boolean grid of shape [lat, lon], True where the cell center lies in the ocean
+    """
+    cached = OCEAN_CACHE_DIR / f"ocean_{grid_hash(lats, lons)}.zarr"
+    if cached.exists() and not force:
+        return open_cached_dataarray(cached).load()
+
+    print(f"Rasterizing the oceans onto a grid of {len(lats)}x{len(lons)} cells")
+    oceans = gpd.read_file(OCEAN_SHP)
+    ocean = regionmask.mask_geopandas(oceans, np.asarray(lons), np.asarray(lats)).notnull()
+    ocean = ocean.rename("ocean").drop_vars([c for c in ocean.coords if c not in ("lat", "lon")])
+
+    save_cache(ocean, cached)
+    return ocean
+
+
+def ocean_hexes(hex_res: int, res=0.1, force=False) -> np.ndarray:
+    """Returns the sorted ids of all hexes at hex_res whose centroid lies in the ocean, cached per (hex_res, res).
+
+    The centroids are looked up in the ocean raster of a global grid of `res` degrees (see `ocean_grid`).
+    """
+    cached = OCEAN_CACHE_DIR / f"ocean_hexes_res{hex_res}_{res}deg.npy"
+    if cached.exists() and not force:
+        return np.load(cached)
+
+    lats = np.arange(-90 + res / 2, 90, res)
+    lons = np.arange(-180 + res / 2, 180, res)
+    ocean = ocean_grid(lats, lons, force).values
+
+    hex_ids = all_hexes(hex_res)
+    hex_lats, hex_lons = hex_centroids(hex_ids)
+    i = np.clip(np.floor((hex_lats + 90) / res).astype(np.int64), 0, len(lats) - 1)
+    j = np.clip(np.floor((hex_lons + 180) / res).astype(np.int64), 0, len(lons) - 1)
+    hex_ids = hex_ids[ocean[i, j]]
+
+    cached.parent.mkdir(exist_ok=True, parents=True)
+    np.save(cached, hex_ids)
+    return hex_ids
+
+
+def ocean_mask(da: xr.DataArray, force=False) -> xr.DataArray:
+    """True for the cells (or hex cells) of da in the ocean"""
+    if "vertex" in da.dims:
+        ocean = ocean_hexes(da.vertex.attrs["hex_res"], force=force)
+        return xr.DataArray(np.isin(da.vertex.values, ocean), dims="vertex", coords={"vertex": da.vertex})
+    return ocean_grid(da.lat.values, da.lon.values, force).assign_coords(lat=da.lat, lon=da.lon)
+
+
+def pole_mask(da: xr.DataArray, deg: int = 60) -> xr.DataArray:
+    """True for the cells (or hex cells) of da outside of deg°S to deg°N"""
+    lat = latitudes(da)
+    return ~((lat > -deg) & (lat < deg))
+
+
+def population_mask(da: xr.DataArray, threshold=0, force=False) -> xr.DataArray:
+    """True for the cells (or hex cells) of da with a population of at most threshold"""
+    return ~(population(da, force) > threshold)
+
+
+def apply_masks(da: xr.DataArray, *masks: xr.DataArray, drop=False) -> xr.DataArray:
+    """Sets the cells of da to NaN which are True in any of the masks, e.g.
+    `apply_masks(da, ocean_mask(da), pole_mask(da), population_mask(da))`.
+
+    Masked cells are dropped by `hexgrid` if they are NaN at all times, so masking before `hexgrid` shrinks the vertex set.
+    With `drop` the masked vertices of a hexgrid are dropped right away.
+    """
+    masked = masks[0]
+    for mask in masks[1:]:
+        masked = masked | mask
+    if drop and "vertex" in da.dims:
+        return da.sel(vertex=~masked.values)
+    return da.where(~masked)
 
 
 def mask_oceans(da: xr.DataArray):
-    # Load ocean-mask
-    oceans = gpd.read_file(ROOT / "data" / "ocean/ne_10m_ocean.shp")
-    mask = regionmask.mask_geopandas(oceans, da)
-    return da.where(mask.isnull())
+    """Only use data on land"""
+    return apply_masks(da, ocean_mask(da))
 
 
 def mask_poles(da: xr.DataArray, deg: int = 60):
     """Only use data between 60°S and 60°N"""
-    return da.where((da.lat > -deg) & (da.lat < deg))
+    return apply_masks(da, pole_mask(da, deg))
 
 
-def mask_population(da: xr.DataArray, correct=False, force=False, threshold=0):
-    resolution = da.lon[1] - da.lon[0]
-    cached = CACHE_DIR / f"GHS_POP_E2020_GLOBE_R2023A_4326_30ss_V1_0_resampled_{resolution:.2f}deg.nc"
+def population_grid(lats: np.ndarray, lons: np.ndarray, force=False, strip_bytes=1 << 28) -> xr.DataArray:
+    """Sums the population of the GHS_POP raster into the cells of a regular lat/lon grid.
+
+    The raster is read in strips of whole blocks of at most `strip_bytes`, every pixel is added to the cell
+    which contains its center, so the memory is bounded by one strip and no population is lost (unlike sampling).
+    Nodata and negative pixels count as 0. The result is cached per grid.
+
+    Args:
+        lats (np.ndarray): Latitudes of the cell centers, equally spaced (ascending or descending)
+        lons (np.ndarray): Longitudes of the cell centers, equally spaced
+        force (bool, optional): Recalculate a cached grid. Defaults to False.
+        strip_bytes (int, optional): Bytes of the raster read at once. Defaults to 256 MiB.
+
+    Returns:
+        xr.DataArray: The population of every cell of shape [lat, lon]
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    cached = CACHE_DIR / f"{POPULATION_TIF.stem}_blocksum_{grid_hash(lats, lons)}.zarr"
     if cached.exists() and not force:
-        # print(f"Loading cached population data from {cached}")
-        pop = xr.open_dataarray(cached)
-    else:
-        pop = rxr.open_rasterio("../data/population/GHS_POP_E2020_GLOBE_R2023A_4326_30ss_V1_0.tif").squeeze("band")
-        pop = pop.rename({"x": "lon", "y": "lat"})
-        pop = pop.interp_like(da, method="nearest")
-        print(f"Saving cached population data to {cached}")
-        pop.to_netcdf(cached)
+        return open_cached_dataarray(cached).load()
+
+    # Cell i of an axis covers [edge + i * res, edge + (i + 1) * res)
+    lat_res, lon_res = lats[1] - lats[0], lons[1] - lons[0]
+    lat_edge, lon_edge = lats[0] - lat_res / 2, lons[0] - lon_res / 2
+    pop = np.zeros(len(lats) * len(lons))
+
+    print(f"Summing the population into a grid of {len(lats)}x{len(lons)} cells")
+    with rasterio.open(POPULATION_TIF) as src:
+        t = src.transform
+        lon_idx = np.floor((t.c + (np.arange(src.width) + 0.5) * t.a - lon_edge) / lon_res).astype(np.int64)
+        lon_valid = (lon_idx >= 0) & (lon_idx < len(lons))
+
+        block_height = src.block_shapes[0][0]
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+        strip = max(strip_bytes // (src.width * itemsize) // block_height, 1) * block_height
+        for row in track(range(0, src.height, strip)):
+            height = min(strip, src.height - row)
+            values = src.read(1, window=Window(0, row, src.width, height)).astype(np.float64)
+            if src.nodata is not None:
+                values[values == src.nodata] = 0
+            values[~(values > 0)] = 0
+
+            lat_idx = np.floor((t.f + (np.arange(row, row + height) + 0.5) * t.e - lat_edge) / lat_res)
+            lat_idx = lat_idx.astype(np.int64)
+            lat_valid = (lat_idx >= 0) & (lat_idx < len(lats))
+
+            idx = lat_idx[lat_valid, None] * len(lons) + lon_idx[None, lon_valid]
+            pop += np.bincount(idx.ravel(), weights=values[lat_valid][:, lon_valid].ravel(), minlength=len(pop))
+
+    pop = xr.DataArray(
+        pop.reshape(len(lats), len(lons)),
+        dims=("lat", "lon"),
+        coords={"lat": lats, "lon": lons},
+        name="population",
+        attrs={"long_name": "Population", "units": "people"},
+    )
+    print(f"Saving cached population data to {cached}")
+    save_cache(pop, cached)
+    return pop
+
+
+def population_hexgrid(hex_res: int, res=0.1, force=False) -> xr.DataArray:
+    """Sums the population of the GHS_POP raster into hex cells.
+
+    The raster is first block-summed into a global grid of `res` degrees (see `population_grid`), whose cells are
+    then summed into the hex cells that contain their centers. The result is cached per (hex_res, res).
+
+    Args:
+        hex_res (int): Resolution of the hexgrid
+        res (float, optional): Resolution of the intermediate grid in degrees, should be well below the hex size. Defaults to 0.1.
+        force (bool, optional): Recalculate a cached hexgrid. Defaults to False.
+
+    Returns:
+        xr.DataArray: The population of every hex cell with population data of shape [vertex]
+    """
+    cached = CACHE_DIR / f"{POPULATION_TIF.stem}_hexsum_res{hex_res}_{res}deg.zarr"
+    if cached.exists() and not force:
+        return open_cached_dataarray(cached).load()
+
+    lats = np.arange(-90 + res / 2, 90, res)
+    lons = np.arange(-180 + res / 2, 180, res)
+    pop = hexgrid(population_grid(lats, lons, force), method="sum", hex_res=hex_res)
+
+    print(f"Saving cached population data to {cached}")
+    save_cache(pop, cached)
+    return pop
+
+
+def population(da: xr.DataArray, force=False) -> xr.DataArray:
+    """The population of the cells (or hex cells) of da, see `population_grid` and `population_hexgrid`"""
+    if "vertex" in da.dims:
+        pop = population_hexgrid(da.vertex.attrs["hex_res"], force=force)
+        return pop.reindex(vertex=da.vertex, fill_value=0)
+    return population_grid(da.lat.values, da.lon.values, force).assign_coords(lat=da.lat, lon=da.lon)
+
+
+def mask_population(da: xr.DataArray, correct=False, force=False, threshold=0):
+    """Only use the cells (or hex cells) with a population larger than threshold.
+
+    The population of a cell is the sum of the GHS_POP pixels within it, see `population_grid` and `population_hexgrid`.
 
+    Args:
+        da (xr.DataArray): DataArray on a lat/lon grid or hexgrid (vertex)
+        correct (bool, optional): Multiply the data with the population. Defaults to False.
+        force (bool, optional): Recalculate the cached population. Defaults to False.
+        threshold (int, optional): Minimum population (exclusive). Defaults to 0.
+    """
     if correct:
-        da = da * pop
-    da = da.where(pop > threshold)
-    return da
+        da = da * population(da, force)
+    return apply_masks(da, population_mask(da, threshold, force))
@@ -4,6 +4,22 @@ from chaotic_carbon_networks.matrix.gen import (
     laged_pearson_similarity_matrix,
     adjacency_matrix,
     link_lengths_like,
+    link_lengths,
 )
+from chaotic_carbon_networks.matrix.sparse import SparseMatrix
 
-from chaotic_carbon_networks.matrix.measures import degrees, average_link_length, betweenness
+from chaotic_carbon_networks.matrix.measures import (
+    degrees,
+    average_link_length,
+    link_length_degree,
+    threshold_sweep,
+    betweenness,
+    clustering,
+    transitivity,
+    closeness,
+    kcore,
+)
+from chaotic_carbon_networks.matrix.fused import node_measures
+from chaotic_carbon_networks.matrix.significance import significance_matrix
+from chaotic_carbon_networks.matrix.window import windowed_networks, windowed_measures
+from chaotic_carbon_networks.matrix.state import NetworkState
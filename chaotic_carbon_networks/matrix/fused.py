@@ -0,0 +1,140 @@
+import numpy as np
+import xarray as xr
+from rich import print
+from typing import Literal
+
+from chaotic_carbon_networks.matrix.gen import (
+    stack_vertices,
+    get_coords,
+    blocks,
+    default_lags,
+    pearson_correlation,
+    mutual_information_kernel,
+    laged_pearson_kernel,
+    haversine,
+    vertex_latlons,
+)
+from chaotic_carbon_networks.matrix.measures import format_degrees, format_average_link_length
+
+SIM_METHODS = Literal["similarity", "lagged_similarity", "mutual_information"]
+
+
+def similarity_kernel(
+    x: xr.DataArray,
+    y: xr.DataArray,
+    method: SIM_METHODS = "similarity",
+    bins=64,
+    tau_min: int = None,
+    tau_max: int = None,
+):
+    """Returns the kernel of a similarity method for any blocks of vertices of x and y"""
+    if method == "similarity":
+        return pearson_correlation
+    elif method == "lagged_similarity":
+        tau_min, tau_max = default_lags(x, tau_min, tau_max)
+        print(f"Calculating similarity for lags from {tau_min} to {tau_max}")
+        return laged_pearson_kernel(tau_min, tau_max)
+    elif method == "mutual_information":
+        return mutual_information_kernel(x, y, bins)
+    else:
+        raise ValueError(f"method must be one of {SIM_METHODS}")
+
+
+def vertex_dataarray(values: np.ndarray, x: xr.DataArray, is_hex: bool, other: bool):
+    """Wraps per-vertex values of the stacked x into a DataArray along vertex (or vertex_other)"""
+    dim = "vertex_other" if other else "vertex"
+    da = xr.DataArray(values, dims=dim, coords={dim: get_coords(x, is_hex, other)})
+    if is_hex:
+        da.coords[dim].attrs["hex_res"] = x.coords["vertex"].attrs["hex_res"]
+    return da
+
+
+def node_measures(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    method: SIM_METHODS = "similarity",
+    rr=0.05,
+    bins=64,
+    tau_min: int = None,
+    tau_max: int = None,
+    n_sample=1000,
+    seed=0,
+    block_size=256,
+):
+    """Calculates degrees and average link lengths of a network without ever storing a [v, v] matrix.
+
+    1. The threshold for the link density `rr` is estimated from the similarities of `n_sample` random x-vertices.
+    2. The similarities are streamed in blocks of `block_size` x-vertices, the links of each block are counted
+       and their lengths summed up on the fly.
+
+    Hence, memory is O(block_size * v) instead of O(v²). The results equal
+    `degrees(a)`, `average_link_length(a, ll)` and `degrees(a, dim="vertex")` with `a = adjacency_matrix(m, rr)`,
+    up to the sampling error of the threshold.
+
+    Args:
+        x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+        y (xr.DataArray, optional): The DataArray of shape [t, v] or [t, lat, lon]. Defaults to None (x).
+        method (SIM_METHODS, optional): The similarity measure. Defaults to "similarity".
+        rr (float, optional): Link density. Defaults to 0.05.
+        bins (int, optional): Bins for "mutual_information". Defaults to 64.
+        tau_min (int, optional): Minimum lag for "lagged_similarity". Defaults to None.
+        tau_max (int, optional): Maximum lag for "lagged_similarity". Defaults to None.
+        n_sample (int, optional): Number of x-vertices to estimate the threshold from. Defaults to 1000.
+        seed (int, optional): Seed for sampling the x-vertices. Defaults to 0.
+        block_size (int, optional): Number of x-vertices to calculate at once. Defaults to 256.
+
+    Returns:
+        tuple[xr.DataArray, xr.DataArray, xr.DataArray]: Degrees and average link lengths of the x-vertices and
+        degrees of the y-vertices
+    """
+    if y is None:
+        y = x
+    f = similarity_kernel(x, y, method, bins, tau_min, tau_max)
+    # Self-links are zeroed by the same rule as in `xrmatrix_from_func`
+    diagonal = x.sizes != y.sizes
+
+    x, x_is_hex = stack_vertices(x)
+    y, y_is_hex = stack_vertices(y)
+    xv = x.values
+    yv = y.values
+    vx = xv.shape[1]
+    vy = yv.shape[1]
+
+    def block(rows: np.ndarray):
+        mb = f(xv[:, rows], yv)
+        if not diagonal:
+            # Zero the self-links like `xrmatrix_from_func` does
+            i = np.arange(vx)[rows]
+            mb[np.arange(len(i)), i] = 0
+        return mb
+
+    # 1. Estimate the threshold from a sample of rows
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(vx, min(n_sample, vx), replace=False))
+    eps = np.nanquantile(block(sample), 1 - rr)
+    print(f"Using a threshold of {eps} for the adjacency matrix (estimated from {len(sample)} vertices)")
+
+    # 2. Stream the blocks and accumulate the node measures
+    lats_i, lons_i = vertex_latlons(get_coords(x, x_is_hex, False), x_is_hex)
+    lats_j, lons_j = vertex_latlons(get_coords(y, y_is_hex, True), y_is_hex)
+    lats_i, lons_i, lats_j, lons_j = (a.astype(np.float32) for a in (lats_i, lons_i, lats_j, lons_j))
+
+    deg = np.zeros(vx)
+    dego = np.zeros(vy)
+    llsum = np.zeros(vx)
+    llcount = np.zeros(vx)
+    for rows in blocks(vx, block_size):
+        links = block(rows) > eps
+        deg[rows] = links.sum(axis=1)
+        dego += links.sum(axis=0)
+
+        ll = haversine(lats_i[rows, None], lons_i[rows, None], lats_j[None, :], lons_j[None, :])
+        ll = np.where(links, ll, 0)
+        llsum[rows] = ll.sum(axis=1)
+        llcount[rows] = (ll > 0).sum(axis=1)
+
+    deg = format_degrees(vertex_dataarray(deg, x, x_is_hex, False), "vertex_other")
+    dego = format_degrees(vertex_dataarray(dego, y, y_is_hex, True), "vertex")
+    avgll = np.divide(llsum, llcount, out=np.zeros(vx), where=llcount > 0)
+    avgll = format_average_link_length(vertex_dataarray(avgll, x, x_is_hex, False), "vertex_other")
+    return deg, avgll, dego
@@ -1,13 +1,18 @@
 import numpy as np
 import xarray as xr
 import pandas as pd
+import scipy.sparse as sp
 from rich import print
 import h3
-from typing import Callable
+from pathlib import Path
+from typing import Callable, Union
+from functools import lru_cache
 
 # Own rust library
 from chaotic_carbon_networks.rust_chaotic_carbon_networks import mind, lapend
 from chaotic_carbon_networks.hex import axis_is_hex
+from chaotic_carbon_networks.profiling import progress, current_path
+from chaotic_carbon_networks.matrix.sparse import SparseMatrix
 
 
 def assert_dims(x: xr.DataArray):
@@ -30,34 +35,135 @@ def get_coords(x: xr.DataArray, is_hex: bool, other: bool):
     return vertex_multiindex
 
 
-def xrmatrix_from_func(x: xr.DataArray, y: xr.DataArray, f: Callable[[np.ndarray, np.ndarray], np.ndarray]):
+def stack_vertices(x: xr.DataArray):
+    """Flattens a [t, lat, lon] DataArray into [t, v], DataArrays of shape [t, v] are returned as they are"""
+    assert_dims(x)
+    if len(x.dims) == 2:
+        return x, True
+    return x.stack(vertex=("lat", "lon")).dropna(dim="vertex", how="all"), False
+
+
+def blocks(n: int, block_size: int):
+    """Yields slices which split range(n) into consecutive blocks of size block_size"""
+    for start in range(0, n, block_size):
+        yield slice(start, min(start + block_size, n))
+
+
+def largest(values: np.ndarray, n: int):
+    """Returns the (unordered) indices of the n largest values"""
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    if n >= len(values):
+        return np.arange(len(values))
+    return np.argpartition(values, len(values) - n)[len(values) - n :]
+
+
+def n_largest_for_quantile(n: int, q: float) -> int:
+    """Number of the largest of n values which determine their q-quantile (see `quantile_of_largest`)"""
+    return n - int(np.floor(q * (n - 1))) + 1
+
+
+def quantile_of_largest(values: np.ndarray, n: int, q: float):
+    """The q-quantile of n values computed like `np.nanquantile` (linear method), of which only the largest are given.
+
+    The given values must include the `n_largest_for_quantile(n, q)` largest of the n values, so the quantile is
+    exactly the same as of all values, which keeps the sparse adjacency equal to `adjacency_matrix`.
+    """
+    if n == 0:
+        return np.nan
+    top = np.sort(values)[::-1]
+    # The (fractional) index in the ascending values and the interpolation exactly like numpy
+    virtual = (n - 1) * np.float64(q)
+    lo = np.floor(virtual)
+    gamma = virtual - lo
+    if virtual >= n - 1:
+        a = b = top[0]
+    else:
+        i = max(int(lo), 0)
+        a, b = top[n - 1 - i], top[n - 2 - i]
+    diff = np.subtract(b, a)
+    return a + diff * gamma if gamma < 0.5 else b - diff * (1 - gamma)
+
+
+def xrmatrix_from_func(
+    x: xr.DataArray,
+    y: xr.DataArray,
+    f: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    diagonal=True,
+    tile_size: int = None,
+    store: Union[str, Path] = None,
+):
     """Wraps a matrix-generation function to xarray
 
+    If `tile_size` or `store` is given, `f` is evaluated tile by tile and the tiles are written into a float32 matrix.
+    With `store` this matrix is a memory-mapped `.npy` file, so the returned DataArray is backed by the file
+    and the matrix may be larger than the RAM.
+
+    If `f` returns a tuple of matrices (e.g. a similarity and a lag matrix), a tuple of DataArrays is returned.
+    When storing, the additional matrices are written next to `store` with the suffixes `_1`, `_2`, ...
+
+    Kernels with an `out_dtypes` attribute (see `mutual_information_kernel`) are called as `f(x, y, out=...)` with
+    the blocks of the output matrices as `out`, so they write every tile directly into the (memory-mapped) matrices.
+    Kernels with a true `takes_offset` attribute (see `surrogate_kernel`) are additionally passed the first row and
+    column of the tile as `offset=(row, col)`.
+
     Args:
         x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
         y (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
-        f (Callable): A function which generates a matrix of shape [v, v]
+        f (Callable): A function which generates a matrix of shape [v, v], for tiling it must work on any subset of the vertices of x and y
+        diagonal (bool, optional): If False, the diagonal is set to 0. Defaults to True.
+        tile_size (int, optional): Number of vertices per tile and axis. Defaults to None (2048 if store is given).
+        store (str | Path, optional): Path of the `.npy` file to write the matrix to. Defaults to None.
     """
-    assert_dims(x)
-    assert_dims(y)
-
-    x_is_hex = len(x.dims) == 2
-    y_is_hex = len(y.dims) == 2
-    if not x_is_hex:
-        x = x.stack(vertex=("lat", "lon")).dropna(dim="vertex", how="all")
-    if not y_is_hex:
-        y = y.stack(vertex=("lat", "lon")).dropna(dim="vertex", how="all")
-
-    vcoords = get_coords(x, x_is_hex, False)
-    vocoords = get_coords(y, y_is_hex, True)
-
-    m = f(x.values, y.values)
+    x, x_is_hex = stack_vertices(x)
+    y, y_is_hex = stack_vertices(y)
+    takes_offset = getattr(f, "takes_offset", False)
+
+    if tile_size is None and store is None:
+        ms = f(x.values, y.values, **({"offset": (0, 0)} if takes_offset else {}))
+        is_tuple = isinstance(ms, tuple)
+        ms = list(ms) if is_tuple else [ms]
+    else:
+        tile_size = tile_size or 2048
+        xv = x.values
+        yv = y.values
+        shape = (xv.shape[1], yv.shape[1])
+        ms = None
+        out_dtypes = getattr(f, "out_dtypes", None)
+        if out_dtypes is not None:
+            ms = [allocate_matrix(shape, dtype, store, i) for i, dtype in enumerate(out_dtypes)]
+            is_tuple = len(ms) > 1
+        for rows in blocks(shape[0], tile_size):
+            for cols in blocks(shape[1], tile_size):
+                kwargs = {"offset": (rows.start, cols.start)} if takes_offset else {}
+                if out_dtypes is not None:
+                    f(xv[:, rows], yv[:, cols], out=tuple(m[rows, cols] for m in ms), **kwargs)
+                    continue
+                tiles = f(xv[:, rows], yv[:, cols], **kwargs)
+                is_tuple = isinstance(tiles, tuple)
+                tiles = list(tiles) if is_tuple else [tiles]
+                if ms is None:
+                    ms = [allocate_matrix(shape, tile.dtype, store, i) for i, tile in enumerate(tiles)]
+                for m, tile in zip(ms, tiles):
+                    m[rows, cols] = tile
+
+    for i, m in enumerate(ms):
+        if not diagonal:
+            np.fill_diagonal(m, 0)
+        if store is not None:
+            m.flush()
+        ms[i] = matrix_dataarray(m, x, x_is_hex, y, y_is_hex)
+    return tuple(ms) if is_tuple else ms[0]
+
+
+def matrix_dataarray(m: np.ndarray, x: xr.DataArray, x_is_hex: bool, y: xr.DataArray, y_is_hex: bool):
+    """Wraps a matrix of shape [v, v_other] into a DataArray with the vertex coordinates of the stacked x and y"""
     m = xr.DataArray(
         m,
         dims=("vertex", "vertex_other"),
         coords={
-            "vertex": vcoords,
-            "vertex_other": vocoords,
+            "vertex": get_coords(x, x_is_hex, False),
+            "vertex_other": get_coords(y, y_is_hex, True),
         },
     )
     if x_is_hex:
@@ -67,17 +173,175 @@ def xrmatrix_from_func(x: xr.DataArray, y: xr.DataArray, f: Callable[[np.ndarray
     return m
 
 
-def mutual_information_matrix(x: xr.DataArray, y: xr.DataArray = None, bins=64):
+def allocate_matrix(shape: tuple, dtype: np.dtype, store: Union[str, Path] = None, i: int = 0):
+    """Allocates the i-th output matrix of a tiled computation, floats are stored as float32"""
+    dtype = np.float32 if np.issubdtype(dtype, np.floating) else dtype
+    if store is None:
+        return np.empty(shape, dtype=dtype)
+    store = Path(store)
+    if i > 0:
+        store = store.with_name(f"{store.stem}_{i}{store.suffix}")
+    store.parent.mkdir(exist_ok=True, parents=True)
+    return np.lib.format.open_memmap(store, mode="w+", dtype=dtype, shape=shape)
+
+
+def sparsematrix_from_func(
+    x: xr.DataArray,
+    y: xr.DataArray,
+    f: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    rr: float = None,
+    k: int = None,
+    diagonal=True,
+    block_size=256,
+) -> SparseMatrix:
+    """Wraps a matrix-generation function to a sparse adjacency matrix without materializing the full matrix.
+
+    `f` is evaluated for blocks of `block_size` x-vertices against all y-vertices.
+    Of every block only the strongest links are kept: the `k` largest values of each row, or the values above the
+    same threshold as `adjacency_matrix` (the 1 - rr quantile of the whole matrix), so the adjacency is identical to
+    the dense one and symmetric links are kept in pairs. Hence, peak memory is O(edges + block_size * v).
+
+    Args:
+        x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+        y (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+        f (Callable): A function which generates a matrix of shape [vx, vy] for any subset of the vertices of x and y
+        rr (float, optional): Global link density to keep. Defaults to None.
+        k (int, optional): Number of links to keep per vertex of x. Defaults to None.
+        diagonal (bool, optional): Whether the diagonal is a valid link. Set to False if x and y are the same. Defaults to True.
+        block_size (int, optional): Number of x-vertices to calculate at once. Defaults to 256.
+
+    Returns:
+        SparseMatrix: The adjacency matrix of shape [vx, vy]
+    """
+    assert (rr is None) != (k is None), "Exactly one of rr and k must be given"
+
+    x, x_is_hex = stack_vertices(x)
+    y, y_is_hex = stack_vertices(y)
+    xv = x.values
+    yv = y.values
+    vx = xv.shape[1]
+    vy = yv.shape[1]
+
+    # Flat indices (i * vy + j) and values of the links kept so far
+    kept_idx = np.empty(0, dtype=np.int64)
+    kept_val = np.empty(0, dtype=np.float64)
+    # The largest values which determine the threshold, the exact number depends on the number of valid (non-NaN) values
+    n_max = n_largest_for_quantile(vx * vy, 1 - rr) if rr is not None else None
+    n_valid = 0
+
+    for rows in blocks(vx, block_size):
+        mb = np.asarray(f(xv[:, rows], yv))
+        if rows.start == 0 and np.issubdtype(mb.dtype, np.floating):
+            # Keep the dtype of the kernel, so the threshold is the same as of the dense matrix
+            kept_val = kept_val.astype(mb.dtype)
+        mb = mb.astype(kept_val.dtype, copy=False)
+        if not diagonal:
+            # Self-links are never among the k strongest, for rr they count as zeros like in `xrmatrix_from_func`
+            i = np.arange(rows.start, min(rows.stop, vy))
+            mb[i - rows.start, i] = np.nan if k is not None else 0
+        offset = rows.start * vy
+
+        if k is not None:
+            mb = np.where(np.isnan(mb), -np.inf, mb)
+            kk = min(k, vy)
+            cols = np.argpartition(mb, vy - kk, axis=1)[:, vy - kk :]
+            vals = np.take_along_axis(mb, cols, axis=1)
+            idx = offset + np.arange(mb.shape[0])[:, None] * vy + cols
+            valid = np.isfinite(vals)
+            kept_idx = np.concatenate([kept_idx, idx[valid]])
+            kept_val = np.concatenate([kept_val, vals[valid]])
+            continue
+
+        mb = mb.reshape(-1)
+        valid = np.flatnonzero(~np.isnan(mb))
+        n_valid += len(valid)
+        # Skip everything which can't make it into the kept values anymore
+        if len(kept_val) == n_max and n_max > 0:
+            valid = valid[mb[valid] > kept_val.min()]
+        kept_idx = np.concatenate([kept_idx, offset + valid])
+        kept_val = np.concatenate([kept_val, mb[valid]])
+        if len(kept_val) > n_max:
+            top = largest(kept_val, n_max)
+            kept_idx = kept_idx[top]
+            kept_val = kept_val[top]
+
+    if rr is not None:
+        eps = quantile_of_largest(kept_val, n_valid, 1 - rr)
+        print(f"Using a threshold of {eps} for the adjacency matrix")
+        links = kept_val > eps
+        kept_idx = kept_idx[links]
+        kept_val = kept_val[links]
+
+    data = sp.csr_array(
+        (np.ones(len(kept_idx), dtype=np.int8), (kept_idx // vy, kept_idx % vy)),
+        shape=(vx, vy),
+    )
+    return SparseMatrix(
+        data,
+        get_coords(x, x_is_hex, False),
+        get_coords(y, y_is_hex, True),
+        x.coords["vertex"].attrs["hex_res"] if x_is_hex else None,
+        y.coords["vertex"].attrs["hex_res"] if y_is_hex else None,
+        attrs={
+            "long_name": "Adjacency Matrix",
+            "valid_range": (0, 1),
+            "actual_range": (0, 1),
+        },
+    )
+
+
+def mutual_information_kernel(x: xr.DataArray, y: xr.DataArray, bins=64):
+    """Returns the Mutual Information kernel for any blocks of vertices of x and y.
+
+    The data is binned with the ranges of the full x and y, so that all blocks are binned alike.
+    The progress is recorded under the stage creating the kernel, as the blocks may run in worker threads.
+    """
+    xrange = (x.min().item(), x.max().item())
+    yrange = (y.min().item(), y.max().item())
+    parent = current_path()
+
+    def f(x, y, out=None):
+        out = None if out is None else out[0]
+        return mind(x, y, bins, xrange, yrange, out=out, progress=progress("mind", parent))
+
+    f.out_dtypes = (np.float32,)
+    return f
+
+
+def mutual_information_matrix(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    bins=64,
+    rr: float = None,
+    k: int = None,
+    tile_size: int = None,
+    store: Union[str, Path] = None,
+):
+    """Calculates the Mutual Information between all vertices of x (and y).
+
+    If `rr` or `k` is given, the matrix is never materialized and a sparse adjacency matrix is returned instead,
+    see `sparsematrix_from_func`. With `tile_size` or `store` the matrix is computed tile by tile,
+    see `xrmatrix_from_func`.
+    """
     # Set y to x if y is none
-    if y is None:
+    single = y is None
+    if single:
         y = x
 
-    def f(x, y):
-        return mind(x, y, bins)
+    f = mutual_information_kernel(x, y, bins)
+
+    if rr is not None or k is not None:
+        return sparsematrix_from_func(x, y, f, rr=rr, k=k, diagonal=x.sizes != y.sizes)
+
+    if single and tile_size is None and store is None:
+        # The kernel only calculates the symmetric half for a single dataset
+        xrange = (x.min().item(), x.max().item())
+        parent = current_path()
+
+        def f(x, y):
+            return mind(x, None, bins, xrange, progress=progress("mind", parent))
 
-    m = xrmatrix_from_func(x, y, f)
-    if x.sizes == y.sizes:
-        m = m.where(~np.eye(len(m), dtype=bool), 0)
+    m = xrmatrix_from_func(x, y, f, diagonal=x.sizes != y.sizes, tile_size=tile_size, store=store)
     m.attrs = {
         "long_name": "Mutual Information Matrix",
         "valid_range": (0, np.inf),
@@ -86,13 +350,37 @@ def mutual_information_matrix(x: xr.DataArray, y: xr.DataArray = None, bins=64):
     return m
 
 
-def pearson_similarity_matrix(x: xr.DataArray):
+def pearson_correlation(x: np.ndarray, y: np.ndarray):
+    """Pearson correlation between every column of x [t, vx] and y [t, vy]"""
+    xs = (x - x.mean(axis=0)) / x.std(axis=0)
+    ys = (y - y.mean(axis=0)) / y.std(axis=0)
+    return xs.T @ ys / len(x)
+
+
+def pearson_similarity_matrix(
+    x: xr.DataArray,
+    rr: float = None,
+    k: int = None,
+    tile_size: int = None,
+    store: Union[str, Path] = None,
+):
+    """Calculates the Pearson correlation between all vertices of x.
+
+    If `rr` or `k` is given, the matrix is never materialized and a sparse adjacency matrix is returned instead,
+    see `sparsematrix_from_func`. With `tile_size` or `store` the matrix is computed tile by tile,
+    see `xrmatrix_from_func`.
+    """
     # TODO: Add y
+    if rr is not None or k is not None:
+        return sparsematrix_from_func(x, x, pearson_correlation, rr=rr, k=k, diagonal=False)
+
     def f(x, y):
         return np.corrcoef(x, rowvar=False)
 
-    m = xrmatrix_from_func(x, x, f)
-    m = m.where(~np.eye(len(m), dtype=bool), 0)
+    if tile_size is not None or store is not None:
+        f = pearson_correlation
+
+    m = xrmatrix_from_func(x, x, f, diagonal=False, tile_size=tile_size, store=store)
     m.attrs = {
         "long_name": "Pearson Similarity Matrix",
         "valid_range": (0, 1),
@@ -101,28 +389,90 @@ def pearson_similarity_matrix(x: xr.DataArray):
     return m
 
 
-def laged_pearson_similarity_matrix(x: xr.DataArray, y: xr.DataArray = None, tau_min: int = None, tau_max: int = None):
-    # Set y to x if y is none
-    if y is None:
-        y = x
-
+def default_lags(x: xr.DataArray, tau_min: int = None, tau_max: int = None):
+    """Fills in the default lag range of 1/40 to 1/10 of the time series length"""
     if not tau_min:
         tau_min = int(len(x.time) / 40)
     if not tau_max:
         tau_max = int(len(x.time) / 10)
-    print(f"Calculating similarity matrix for lags from {tau_min} to {tau_max}")
+    return tau_min, tau_max
 
-    def f(x, y):
-        return lapend(x, tau_min, tau_max, y)
 
-    m = xrmatrix_from_func(x, y, f)
-    if x.sizes == y.sizes:
-        m = m.where(~np.eye(len(m), dtype=bool), 0)
+def laged_pearson_kernel(tau_min: int, tau_max: int, return_lag=False):
+    """Returns the Lagged Pearson kernel for any blocks of vertices of x and y.
+
+    The progress is recorded under the stage creating the kernel, as the blocks may run in worker threads.
+    """
+    parent = current_path()
+
+    def f(x, y, out=None):
+        if out is None:
+            return lapend(x, tau_min, tau_max, y, return_lag=return_lag, progress=progress("lapend", parent))
+        return lapend(x, tau_min, tau_max, y, return_lag, *out, progress=progress("lapend", parent))
+
+    f.out_dtypes = (np.float32, np.int32) if return_lag else (np.float32,)
+    return f
+
+
+def laged_pearson_similarity_matrix(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    tau_min: int = None,
+    tau_max: int = None,
+    rr: float = None,
+    k: int = None,
+    tile_size: int = None,
+    store: Union[str, Path] = None,
+    return_lag=False,
+):
+    """Calculates the maximum absolute Pearson correlation over the lags tau_min..tau_max between all vertices of x (and y).
+
+    If `rr` or `k` is given, the matrix is never materialized and a sparse adjacency matrix is returned instead,
+    see `sparsematrix_from_func`. With `tile_size` or `store` the matrix is computed tile by tile,
+    see `xrmatrix_from_func`.
+
+    If `return_lag` is set, the lag (in time steps) at which the maximum correlation is reached is returned as
+    second matrix, i.e. the delay with which y follows x. Self-links and links without correlation at any lag have
+    no lag and are set to -1 (the `missing_value` of its attrs).
+    """
+    # Set y to x if y is none
+    if y is None:
+        y = x
+
+    tau_min, tau_max = default_lags(x, tau_min, tau_max)
+    print(f"Calculating similarity matrix for lags from {tau_min} to {tau_max}")
+
+    f = laged_pearson_kernel(tau_min, tau_max, return_lag)
+
+    if rr is not None or k is not None:
+        assert not return_lag, "return_lag is not supported for sparse adjacency matrices"
+        return sparsematrix_from_func(x, y, f, rr=rr, k=k, diagonal=x.sizes != y.sizes)
+
+    m = xrmatrix_from_func(x, y, f, diagonal=x.sizes != y.sizes, tile_size=tile_size, store=store)
+    if return_lag:
+        m, lag = m
+        # Mark the links without a lag block by block, so that memory-mapped matrices are not loaded at once
+        lag_range = (np.inf, -np.inf)
+        for rows in blocks(lag.shape[0], 2048):
+            block = lag.values[rows]
+            block[m.values[rows] <= 0] = -1
+            valid = block[block >= 0]
+            if len(valid):
+                lag_range = (min(lag_range[0], valid.min()), max(lag_range[1], valid.max()))
+        lag.attrs = {
+            "long_name": "Lag of the maximum Pearson Correlation",
+            "units": "time steps",
+            "valid_range": (tau_min, tau_max - 1),
+            "actual_range": tuple(int(r) for r in lag_range) if np.isfinite(lag_range[0]) else (np.nan, np.nan),
+            "missing_value": -1,
+        }
     m.attrs = {
         "long_name": "Lagged Pearson Similarity Matrix",
         "valid_range": (0, np.inf),
         "actual_range": (m.min().item(), m.max().item()),
     }
+    if return_lag:
+        return m, lag
     return m
 
 
@@ -143,11 +493,76 @@ def adjacency_matrix(m: xr.DataArray, rr=0.05):
     return adjacency_matrix
 
 
-def link_lengths_like(m: xr.DataArray):
+def haversine(lats_i, lons_i, lats_j, lons_j):
+    """Distance in km between two points on earth, lats and lons in radians"""
+    d_lat = lats_i - lats_j
+    d_lon = lons_i - lons_j
+
+    # Distance between two points on a sphere
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lats_i) * np.cos(lats_j) * np.sin(d_lon / 2) ** 2
+
+    # Clip to avoid numerical errors
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(np.clip(1 - a, 0, 1)))
+    R = 6371.0088
+    return R * c
+
+
+@lru_cache(maxsize=None)
+def hex_centroid(h: int):
+    """Lat and lon of the centroid of a hex id in degrees, cached across calls"""
+    return h3.h3_to_geo(str(hex(h))[2:])
+
+
+def vertex_latlons(coords: Union[np.ndarray, pd.MultiIndex], is_hex: bool):
+    """Returns the lats and lons of vertex coordinates (hex ids or a (lat, lon) MultiIndex) in radians"""
+    if is_hex:
+        latlon_coords = np.array([hex_centroid(h) for h in np.asarray(coords).tolist()]).reshape(-1, 2)
+        lats, lons = latlon_coords[:, 0], latlon_coords[:, 1]
+    else:
+        lats, lons = coords.get_level_values(0).values, coords.get_level_values(1).values
+    return lats * np.pi / 180, lons * np.pi / 180
+
+
+def matrix_latlons(m: Union[xr.DataArray, SparseMatrix], dim: str, dtype=np.float32):
+    """Returns the lats and lons of the vertices of the dimension dim of a matrix in radians"""
+    if isinstance(m, SparseMatrix):
+        is_hex = m.hex_res(dim) is not None
+        coords = getattr(m, dim)
+    else:
+        is_hex = axis_is_hex(m, dim)
+        coords = m.coords[dim].values if is_hex else m.indexes[dim]
+    lats, lons = vertex_latlons(coords, is_hex)
+    return lats.astype(dtype), lons.astype(dtype)
+
+
+def link_lengths(m: Union[xr.DataArray, SparseMatrix], rows: np.ndarray, cols: np.ndarray, dtype=np.float32):
+    """Returns the lengths of the links (rows[k], cols[k]) between the vertices of a matrix in km
+
+    Args:
+        m (xr.DataArray | SparseMatrix): The Matrix, only its coordinates are used
+        rows (np.ndarray): Indices of the links along the vertex dimension
+        cols (np.ndarray): Indices of the links along the vertex_other dimension
+        dtype (np.dtype, optional): Precision of the calculation. Defaults to np.float32.
+
+    Returns:
+        np.ndarray: The link lengths of shape [len(rows)]
+    """
+    lats_i, lons_i = matrix_latlons(m, "vertex", dtype)
+    lats_j, lons_j = matrix_latlons(m, "vertex_other", dtype)
+    return haversine(lats_i[rows], lons_i[rows], lats_j[cols], lons_j[cols])
+
+
+def link_lengths_like(m: xr.DataArray, dtype=np.float32, tile_size=1024):
     """Returns a Matrix with length between verticies
 
+    If m is a SparseMatrix, the lengths are only calculated for its stored entries (e.g. the links of an adjacency matrix)
+    and returned as SparseMatrix with the same sparsity. Otherwise the dense matrix is calculated in tiles of
+    `tile_size` rows, so that no intermediates of shape [v, v] are allocated.
+
     Args:
-        m (xr.DataArray): The Matrix
+        m (xr.DataArray | SparseMatrix): The Matrix
+        dtype (np.dtype, optional): Precision of the lengths. Defaults to np.float32.
+        tile_size (int, optional): Number of rows to calculate at once. Defaults to 1024.
 
     Usage:
 
@@ -157,52 +572,33 @@ def link_lengths_like(m: xr.DataArray):
     m * ll # Length-Corrected Similarity
     ```
     """
+    if isinstance(m, SparseMatrix):
+        coo = m.data.tocoo()
+        ll = link_lengths(m, coo.row, coo.col, dtype)
+        return m.with_data(
+            sp.csr_array((ll, (coo.row, coo.col)), shape=m.shape),
+            attrs={
+                "long_name": f"Link lengths",
+                "units": "km",
+                "var_desc": "Link length",
+                "valid_range": (0, ll.max(initial=0)),
+                "actual_range": (ll.min(initial=0), ll.max(initial=0)),
+            },
+        )
+
     assert len(m.dims) == 2, "m must have 2 dimensions"
     assert "vertex" in m.dims, "m must have vertex dimension"
     assert "vertex_other" in m.dims, "m must have vertex_other dimension"
 
-    x_hex = axis_is_hex(m, "vertex")
-    y_hex = axis_is_hex(m, "vertex_other")
-
-    if x_hex:
-        latlon_coords = [h3.h3_to_geo(str(hex(h))[2:]) for h in m.vertex.values]
-        lats_i = xr.DataArray([lat for lat, lon in latlon_coords], dims="vertex", coords={"vertex": m.vertex})
-        lons_i = xr.DataArray([lon for lat, lon in latlon_coords], dims="vertex", coords={"vertex": m.vertex})
-        lats_i *= np.pi / 180
-        lons_i *= np.pi / 180
-    else:
-        lats_i = m.coords["lat"] * np.pi / 180
-        lons_i = m.coords["lon"] * np.pi / 180
-
-    if y_hex:
-        latlon_coords_other = [h3.h3_to_geo(str(hex(h))[2:]) for h in m.vertex_other.values]
-        lats_j = xr.DataArray(
-            [lat for lat, lon in latlon_coords_other],
-            dims="vertex_other",
-            coords={"vertex_other": m.vertex_other},
-        )
-        lons_j = xr.DataArray(
-            [lon for lat, lon in latlon_coords_other],
-            dims="vertex_other",
-            coords={"vertex_other": m.vertex_other},
-        )
-        lats_j *= np.pi / 180
-        lons_j *= np.pi / 180
-    else:
-        lats_j = m.coords["lat_other"] * np.pi / 180
-        lons_j = m.coords["lon_other"] * np.pi / 180
-
-    d_lat = lats_i - lats_j
-    d_lon = lons_i - lons_j
+    m = m.transpose("vertex", "vertex_other")
+    lats_i, lons_i = matrix_latlons(m, "vertex", dtype)
+    lats_j, lons_j = matrix_latlons(m, "vertex_other", dtype)
 
-    # Distance between two points on a sphere
-    a = np.sin(d_lat / 2) ** 2 + np.cos(lats_i) * np.cos(lats_j) * np.sin(d_lon / 2) ** 2
-
-    # Clip to avoid numerical errors
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(np.clip(1 - a, 0, 1)))
-    R = 6371.0088
-    ll = R * c
+    ll = np.empty(m.shape, dtype=dtype)
+    for rows in blocks(len(lats_i), tile_size):
+        ll[rows] = haversine(lats_i[rows, None], lons_i[rows, None], lats_j[None, :], lons_j[None, :])
 
+    ll = m.copy(data=ll)
     ll.attrs = {
         "long_name": f"Link lengths",
         "units": "km",
@@ -211,9 +607,4 @@ def link_lengths_like(m: xr.DataArray):
         "actual_range": (ll.min().item(), ll.max().item()),
     }
 
-    if x_hex:
-        ll.coords["vertex"].attrs["hex_res"] = x_hex
-    if y_hex:
-        ll.coords["vertex_other"].attrs["hex_res"] = y_hex
-
     return ll
@@ -1,18 +1,38 @@
 import numpy as np
 import xarray as xr
-import networkx as nx
 import pandas as pd
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
 from typing import Literal
+import os
 
 from chaotic_carbon_networks.hex import axis_is_hex
+from chaotic_carbon_networks.matrix.sparse import SparseMatrix
+from chaotic_carbon_networks.matrix.gen import link_lengths, matrix_latlons, haversine, blocks
+from rich import print
 
 MDIMS = Literal["vertex", "vertex_other"]
 
 
+def count_links(m: SparseMatrix, dim: MDIMS = "vertex_other"):
+    """Number of stored entries of a SparseMatrix, summed over the dimension dim"""
+    if dim == "vertex_other":
+        return np.diff(m.data.indptr)
+    return np.bincount(m.data.indices, minlength=m.shape[1])
+
+
 def degrees(m: xr.DataArray, dim: MDIMS = "vertex_other", weighted=True):
     dimo = "vertex" if dim == "vertex_other" else "vertex_other"
-    d = m.sum(dim=dim, keep_attrs=True)
+    if isinstance(m, SparseMatrix):
+        d = m.vertex_dataarray(count_links(m, dim), dimo)
+    else:
+        d = m.sum(dim=dim, keep_attrs=True)
+    return format_degrees(d, dim, weighted)
 
+
+def format_degrees(d: xr.DataArray, dim: MDIMS = "vertex_other", weighted=True):
+    """Turns the link counts of the vertices, summed over dim, into the output format of `degrees`"""
+    dimo = "vertex" if dim == "vertex_other" else "vertex_other"
     if not axis_is_hex(d, dimo):
         d = d.unstack(dimo)
 
@@ -32,12 +52,60 @@ def degrees(m: xr.DataArray, dim: MDIMS = "vertex_other", weighted=True):
     return d
 
 
-def average_link_length(m: xr.DataArray, ll: xr.DataArray, dim: MDIMS = "vertex_other"):
+def link_length_sums(m: xr.DataArray, dim: MDIMS = "vertex_other"):
+    """Sum and number of the lengths of the links of every vertex (over dim), only calculated for the non-zero entries"""
+    dimo = "vertex" if dim == "vertex_other" else "vertex_other"
+    if isinstance(m, SparseMatrix):
+        coo = m.data.tocoo()
+        rows, cols, w = coo.row, coo.col, coo.data
+    else:
+        m = m.transpose("vertex", "vertex_other")
+        rows, cols = np.nonzero(m.values)
+        w = m.values[rows, cols]
+    mll = w * link_lengths(m, rows, cols)
+    valid = mll > 0
+    idx = (rows if dim == "vertex_other" else cols)[valid]
+    nv = m.shape[0 if dim == "vertex_other" else 1]
+    n = np.bincount(idx, minlength=nv)
+    s = np.bincount(idx, weights=mll[valid], minlength=nv)
+
+    def wrap(values):
+        if isinstance(m, SparseMatrix):
+            return m.vertex_dataarray(values, dimo)
+        return m.isel({dim: 0}, drop=True).copy(data=values)
+
+    return wrap(s), wrap(n)
+
+
+def average_link_length(m: xr.DataArray, ll: xr.DataArray = None, dim: MDIMS = "vertex_other"):
+    """Average length of the links of every vertex.
+
+    Without ll, the lengths are only calculated for the non-zero entries (links) of m, so this scales with the number
+    of links instead of v².
+    """
     dimo = "vertex" if dim == "vertex_other" else "vertex_other"
-    mll = m * ll
-    avgll = mll.where(mll > 0).mean(dim=dim)
-    avgll = avgll.fillna(0)
+    if ll is None:
+        s, n = link_length_sums(m, dim)
+        avgll = s.copy(data=np.divide(s.values, n.values, out=np.zeros(len(s)), where=n.values > 0))
+    elif isinstance(m, SparseMatrix):
+        # Only look at the links, ll may be sparse (with the same links) or dense
+        mll = sp.csr_array(m.data.multiply(ll.data if isinstance(ll, SparseMatrix) else ll.values))
+        mll.data = np.where(mll.data > 0, mll.data, 0)
+        mll.eliminate_zeros()
+        mll = m.with_data(mll)
+        n = count_links(mll, dim)
+        s = np.asarray(mll.data.sum(axis=1 if dim == "vertex_other" else 0)).ravel()
+        avgll = mll.vertex_dataarray(np.divide(s, n, out=np.zeros(len(s)), where=n > 0), dimo)
+    else:
+        mll = m * ll
+        avgll = mll.where(mll > 0).mean(dim=dim)
+        avgll = avgll.fillna(0)
+    return format_average_link_length(avgll, dim)
 
+
+def format_average_link_length(avgll: xr.DataArray, dim: MDIMS = "vertex_other"):
+    """Turns the average link lengths of the vertices, averaged over dim, into the output format of `average_link_length`"""
+    dimo = "vertex" if dim == "vertex_other" else "vertex_other"
     if not axis_is_hex(avgll, dimo):
         avgll = avgll.unstack(dimo)
     elif dim == "vertex":
@@ -53,31 +121,368 @@ def average_link_length(m: xr.DataArray, ll: xr.DataArray, dim: MDIMS = "vertex_
     return avgll
 
 
-def betweenness(m: xr.DataArray, k: int = 100):
-    # TODO: Implement directed version
-    assert m.shape[0] == m.shape[1], "Expect Graph to be non-directed."
+def threshold_sweep(m: xr.DataArray, rrs: list[float], weighted=True, tile_size=1024):
+    """Degrees and average link lengths of the networks of many link densities from one pass over the matrix.
+
+    The thresholds of all link densities are calculated with one `np.nanquantile`. Every entry is then assigned to the
+    bin between two thresholds, so the links of a vertex for all densities are the reversed cumulative sum of its
+    per-bin counts. The link lengths are summed the same way, so the sweep costs about as much as a single network.
+    The results equal `degrees(a, weighted=weighted)` and `average_link_length(a)` with `a = adjacency_matrix(m, rr)`
+    for every rr.
+
+    Args:
+        m (xr.DataArray): The similarity matrix
+        rrs (list[float]): Link densities
+        weighted (bool, optional): Whether the degrees of lat/lon grids are weighted by latitude. Defaults to True.
+        tile_size (int, optional): Number of rows to process at once. Defaults to 1024.
+
+    Returns:
+        tuple[xr.DataArray, xr.DataArray]: Degrees and average link lengths with an additional rr dimension
+    """
+    assert len(m.dims) == 2, "m must have 2 dimensions"
+    assert "vertex" in m.dims, "m must have vertex dimension"
+    assert "vertex_other" in m.dims, "m must have vertex_other dimension"
+
+    m = m.transpose("vertex", "vertex_other")
+    rrs = np.asarray(rrs, dtype=np.float64)
+    eps = np.nanquantile(m.values, 1 - rrs)
+    print(f"Using thresholds of {eps} for the adjacency matrices")
+
+    # Entries in bin b are links for the b smallest thresholds
+    order = np.argsort(eps)
+    eps_sorted = eps[order]
+    nb = len(eps) + 1
+
+    lats_i, lons_i = matrix_latlons(m, "vertex")
+    lats_j, lons_j = matrix_latlons(m, "vertex_other")
+
+    nv = m.shape[0]
+    counts = np.zeros((nv, nb))
+    ll_counts = np.zeros((nv, nb))
+    ll_sums = np.zeros((nv, nb))
+    for rows in blocks(nv, tile_size):
+        mb = np.asarray(m.values[rows])
+        b = np.searchsorted(eps_sorted, mb, side="left")
+        b[np.isnan(mb)] = 0
+        idx = (np.arange(b.shape[0])[:, None] * nb + b).ravel()
+        counts[rows] = np.bincount(idx, minlength=b.shape[0] * nb).reshape(-1, nb)
+
+        ll = haversine(lats_i[rows, None], lons_i[rows, None], lats_j[None, :], lons_j[None, :]).ravel()
+        valid = ll > 0
+        ll_counts[rows] = np.bincount(idx[valid], minlength=b.shape[0] * nb).reshape(-1, nb)
+        ll_sums[rows] = np.bincount(idx[valid], weights=ll[valid], minlength=b.shape[0] * nb).reshape(-1, nb)
+
+    def links(c):
+        # Number (or sum) of the entries above every threshold, in the order of rrs
+        above = np.cumsum(c[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        return above[:, np.argsort(order)].T
+
+    template = m.isel(vertex_other=0, drop=True).expand_dims(rr=rrs)
+    deg = format_degrees(template.copy(data=links(counts)), "vertex_other", weighted)
+    n = links(ll_counts)
+    avgll = np.divide(links(ll_sums), n, out=np.zeros(n.shape), where=n > 0)
+    avgll = format_average_link_length(template.copy(data=avgll), "vertex_other")
+    return deg, avgll
+
+
+def link_length_degree(m: xr.DataArray, dim: MDIMS = "vertex_other"):
+    """Total length of the links of every vertex, i.e. the degree weighted by the link lengths"""
+    s, _ = link_length_sums(m, dim)
+    lld = format_average_link_length(s, dim)
+    lld.attrs = {
+        "long_name": "Link length weighted Connectivity of Vertices",
+        "units": "km",
+        "valid_range": (0, np.inf),
+        "actual_range": (lld.min().item(), lld.max().item()),
+    }
+    return lld
+
+
+def bfs_batch(AT: sp.csr_array, sources: np.ndarray):
+    """Level-synchronous BFS from a batch of sources, every level is one sparse-dense product.
+
+    Args:
+        AT (sp.csr_array): The transposed adjacency, links are followed from row to column of the adjacency
+        sources (np.ndarray): The sources of the batch
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, int]: Distances (-1 if unreachable) and numbers of shortest paths of shape
+        [n, batch] and the depth of the deepest BFS
+    """
+    n = AT.shape[0]
+    cols = np.arange(len(sources))
+
+    sigma = np.zeros((n, len(sources)))
+    sigma[sources, cols] = 1
+    dist = np.full((n, len(sources)), -1, dtype=np.int32)
+    dist[sources, cols] = 0
+
+    frontier = sigma.copy()
+    depth = 0
+    while True:
+        nxt = AT @ frontier
+        nxt[dist >= 0] = 0
+        if not nxt.any():
+            break
+        depth += 1
+        dist[nxt > 0] = depth
+        sigma += nxt
+        frontier = nxt
+    return dist, sigma, depth
+
+
+def brandes_batch(A: sp.csr_array, sources: np.ndarray) -> np.ndarray:
+    """Dependencies of all vertices on the shortest paths from a batch of sources (Brandes), summed over the sources.
+
+    The BFS of all sources run at once with `bfs_batch`, the backward pass accumulates the dependencies level by level
+    with one sparse-dense product per level as well.
+    """
+    dist, sigma, depth = bfs_batch(A.T.tocsr(), sources)
 
-    G = nx.from_numpy_array(m.values)
-    bc = nx.betweenness_centrality(G, k=k)
+    delta = np.zeros(dist.shape)
+    for level in range(depth, 0, -1):
+        coef = np.where(dist == level, (1 + delta) / np.where(sigma > 0, sigma, 1), 0)
+        delta += np.where(dist == level - 1, sigma * (A @ coef), 0)
 
-    vertex_coords = m.coords["vertex"]
-    if axis_is_hex(m, "vertex"):
-        vc = vertex_coords.values.copy()
+    delta[sources, np.arange(len(sources))] = 0
+    return delta.sum(axis=1)
+
+
+def brandes(A: sp.csr_array, sources: np.ndarray, batch_size=64) -> np.ndarray:
+    """Sums the dependencies of `brandes_batch` over all sources in batches of `batch_size`"""
+    bc = np.zeros(A.shape[0])
+    for start in range(0, len(sources), batch_size):
+        bc += brandes_batch(A, sources[start : start + batch_size])
+    return bc
+
+
+def betweenness(
+    m: xr.DataArray, k: int = 100, seed=0, batch_size=64, workers: int = None, directed: bool = None
+) -> xr.DataArray:
+    """Betweenness Centrality of an unweighted network, normalized like networkx.
+
+    Every non-zero entry of m is a link. The sources are split into one chunk per worker process, each worker runs
+    `brandes` over its chunk.
+    If vertex and vertex_other differ (e.g. the network of two datasets), the network is directed from vertex to
+    vertex_other and its nodes are the union of both, so that paths can pass through vertices of both dimensions.
+
+    Args:
+        m (xr.DataArray | SparseMatrix): The adjacency matrix
+        k (int, optional): Number of sampled sources. None for the exact betweenness. Defaults to 100.
+        seed (int, optional): Seed for sampling the sources. Defaults to 0.
+        batch_size (int, optional): Number of sources whose BFS run at once. Defaults to 64.
+        workers (int, optional): Number of processes. Defaults to None (number of CPUs).
+        directed (bool, optional): Whether the network is directed. Defaults to None (if vertex and vertex_other differ).
+
+    Returns:
+        xr.DataArray: The betweenness of every node
+    """
+    nodes, A, hex_res = network(m, directed)
+    n = A.shape[0]
+    if k is None or k >= n:
+        sources = np.arange(n)
     else:
-        vc = pd.MultiIndex.from_tuples(vertex_coords.values, names=("lat", "lon"))
+        rng = np.random.default_rng(seed)
+        sources = np.sort(rng.choice(n, k, replace=False))
+
+    bc = sum(map_sources(brandes, A, sources, batch_size, workers))
+
+    # Normalize by the number of (s, t) pairs, sampled sources only count for k - 1 pairs (like networkx)
+    if n > 2:
+        if len(sources) == n:
+            bc /= (n - 1) * (n - 2)
+        else:
+            scale = np.full(n, 1 / (len(sources) * (n - 2)))
+            scale[sources] = 1 / ((len(sources) - 1) * (n - 2)) if len(sources) > 1 else np.nan
+            bc *= scale
+
+    return node_dataarray(
+        bc,
+        nodes,
+        hex_res,
+        {
+            "long_name": "Betweenness Centrality of Vertices",
+            "units": "°",
+            "valid_range": (0, 1),
+        },
+    )
 
-    b = xr.DataArray(list(bc.values()), dims="vertex", coords={"vertex": vc})
 
-    if axis_is_hex(m, "vertex"):
-        b.coords["vertex"].attrs["hex_res"] = m.coords["vertex"].attrs["hex_res"]
+def network(m: xr.DataArray, directed: bool = None):
+    """Returns the nodes and the binary CSR adjacency (without self-links) of the network of a matrix.
+
+    If vertex and vertex_other differ, the links are directed from vertex to vertex_other and the nodes are the
+    union of both. Undirected networks have a symmetric adjacency.
+
+    Args:
+        m (xr.DataArray | SparseMatrix): The adjacency matrix, every non-zero entry is a link
+        directed (bool, optional): Whether the network is directed. Defaults to None (if vertex and vertex_other differ).
+
+    Returns:
+        tuple[pd.Index, sp.csr_array, int]: The nodes, the adjacency of shape [n, n] and the hex_res of the nodes
+    """
+    if not isinstance(m, SparseMatrix):
+        m = SparseMatrix.from_dataarray(m)
+
+    iv = m.vertex if isinstance(m.vertex, pd.MultiIndex) else pd.Index(m.vertex)
+    io = m.vertex_other if isinstance(m.vertex_other, pd.MultiIndex) else pd.Index(m.vertex_other)
+    if isinstance(io, pd.MultiIndex):
+        io = io.set_names(iv.names)
+    if directed is None:
+        directed = not iv.equals(io)
+
+    if iv.equals(io):
+        nodes = iv
+        A = m.data
     else:
-        b = b.unstack("vertex")
+        assert m.vertex_hex_res == m.vertex_other_hex_res, "vertex and vertex_other must have the same hex_res"
+        nodes = iv.union(io)
+        coo = m.data.tocoo()
+        n = len(nodes)
+        rows = nodes.get_indexer(iv)[coo.row]
+        cols = nodes.get_indexer(io)[coo.col]
+        A = sp.csr_array((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    A = sp.csr_array(A != 0, dtype=np.float64)
+    if not directed:
+        A = sp.csr_array((A + A.T) != 0, dtype=np.float64)
+    A.setdiag(0)
+    A.eliminate_zeros()
+    return nodes, A, m.vertex_hex_res
 
-    b.attrs = {
-        "long_name": "Betweenness Centrality of Vertices",
-        "units": "°",
-        "valid_range": (0, 1),
-        "actual_range": (b.min().item(), b.max().item()),
-    }
 
-    return b
+def node_dataarray(values: np.ndarray, nodes: pd.Index, hex_res: int, attrs: dict) -> xr.DataArray:
+    """Wraps the values of the nodes of a `network` into a DataArray, unstacked to lat and lon if not hex"""
+    if isinstance(nodes, pd.MultiIndex):
+        d = xr.DataArray(values, dims="vertex", coords=xr.Coordinates.from_pandas_multiindex(nodes, "vertex"))
+    else:
+        d = xr.DataArray(values, dims="vertex", coords={"vertex": nodes.values})
+    if hex_res is not None:
+        d.coords["vertex"].attrs["hex_res"] = hex_res
+    else:
+        d = d.unstack("vertex")
+
+    d.attrs = {**attrs, "actual_range": (d.min().item(), d.max().item())}
+    return d
+
+
+def map_sources(f, A: sp.csr_array, sources: np.ndarray, batch_size=64, workers: int = None) -> list:
+    """Calls f(A, chunk, batch_size) for one chunk of the sources per worker process, returns the results in order"""
+    workers = min(workers or os.cpu_count(), -(-len(sources) // batch_size))
+    if workers <= 1:
+        return [f(A, sources, batch_size)]
+    chunks = np.array_split(sources, workers)
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(f, [A] * workers, chunks, [batch_size] * workers))
+
+
+def triangles(A: sp.csr_array) -> np.ndarray:
+    """Twice the number of triangles through every node, the row sums of A·A∘A"""
+    return np.asarray((A @ A).multiply(A).sum(axis=1)).ravel()
+
+
+def clustering(m: xr.DataArray) -> xr.DataArray:
+    """Local clustering coefficient of every vertex of the undirected network (like networkx)"""
+    nodes, A, hex_res = network(m, directed=False)
+    k = np.asarray(A.sum(axis=1)).ravel()
+    kk = k * (k - 1)
+    c = np.divide(triangles(A), kk, out=np.zeros(len(k)), where=kk > 0)
+    return node_dataarray(
+        c,
+        nodes,
+        hex_res,
+        {
+            "long_name": "Local Clustering Coefficient of Vertices",
+            "valid_range": (0, 1),
+        },
+    )
+
+
+def transitivity(m: xr.DataArray) -> xr.DataArray:
+    """Transitivity (global clustering coefficient) of the undirected network (like networkx)"""
+    _, A, _ = network(m, directed=False)
+    k = np.asarray(A.sum(axis=1)).ravel()
+    triads = (k * (k - 1)).sum()
+    t = triangles(A).sum() / triads if triads > 0 else 0.0
+    return xr.DataArray(
+        t,
+        attrs={
+            "long_name": "Transitivity of the Network",
+            "valid_range": (0, 1),
+        },
+    )
+
+
+def closeness_batch(A: sp.csr_array, sources: np.ndarray, batch_size=64) -> np.ndarray:
+    """Number of reached nodes and sum of distances from every source, with BFS in batches of `batch_size`"""
+    AT = A.T.tocsr()
+    res = np.zeros((len(sources), 2))
+    for start in range(0, len(sources), batch_size):
+        dist, _, _ = bfs_batch(AT, sources[start : start + batch_size])
+        reached = dist >= 0
+        res[start : start + batch_size, 0] = reached.sum(axis=0)
+        res[start : start + batch_size, 1] = np.where(reached, dist, 0).sum(axis=0)
+    return res
+
+
+def closeness(m: xr.DataArray, batch_size=64, workers: int = None, directed: bool = None) -> xr.DataArray:
+    """Closeness Centrality of every vertex, scaled by the reachable part of the network (like networkx).
+
+    The distances are calculated with batched BFS (`bfs_batch`) in worker processes. For directed networks the
+    distances are the ones to a vertex, i.e. the BFS follow the links backwards.
+
+    Args:
+        m (xr.DataArray | SparseMatrix): The adjacency matrix
+        batch_size (int, optional): Number of sources whose BFS run at once. Defaults to 64.
+        workers (int, optional): Number of processes. Defaults to None (number of CPUs).
+        directed (bool, optional): Whether the network is directed. Defaults to None (if vertex and vertex_other differ).
+
+    Returns:
+        xr.DataArray: The closeness of every node
+    """
+    nodes, A, hex_res = network(m, directed)
+    n = A.shape[0]
+    res = np.concatenate(map_sources(closeness_batch, A.T.tocsr(), np.arange(n), batch_size, workers))
+    reached, total = res[:, 0], res[:, 1]
+    c = np.divide(reached - 1, total, out=np.zeros(n), where=total > 0)
+    if n > 1:
+        c *= (reached - 1) / (n - 1)
+    return node_dataarray(
+        c,
+        nodes,
+        hex_res,
+        {
+            "long_name": "Closeness Centrality of Vertices",
+            "valid_range": (0, 1),
+        },
+    )
+
+
+def kcore(m: xr.DataArray) -> xr.DataArray:
+    """Core number of every vertex of the undirected network (like networkx).
+
+    The nodes are peeled in batches: all nodes with a degree of at most k are removed at once and the degrees of their
+    neighbours are updated with one sparse product, until no such node is left and k increases.
+    """
+    nodes, A, hex_res = network(m, directed=False)
+    deg = np.asarray(A.sum(axis=1)).ravel()
+    core = np.zeros(len(deg))
+    alive = np.ones(len(deg), dtype=bool)
+    k = 0
+    while alive.any():
+        k = max(k, deg[alive].min())
+        while True:
+            removed = alive & (deg <= k)
+            if not removed.any():
+                break
+            core[removed] = k
+            alive &= ~removed
+            deg -= A @ removed.astype(np.float64)
+    return node_dataarray(
+        core,
+        nodes,
+        hex_res,
+        {
+            "long_name": "Core Number of Vertices",
+            "valid_range": (0, np.inf),
+        },
+    )
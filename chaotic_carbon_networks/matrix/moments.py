@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class LaggedMoments:
+    """Running sums of the pairs (x[t], y[t + tau]) for every lag tau, from which the Pearson correlations follow.
+
+    For every lag the number of pairs and the sums Σx, Σx², Σy, Σy² and Σxy are kept in float64, so pairs can be
+    added and removed in any order (e.g. when a window slides or new days arrive) without touching the other pairs.
+    The data should be roughly centered (e.g. by subtracting the mean of a first chunk) to avoid cancellation.
+
+    Args:
+        vx (int): Number of vertices of x
+        vy (int): Number of vertices of y
+        lags (list[int]): The lags tau, 0 gives the ordinary Pearson correlation
+    """
+
+    def __init__(self, vx: int, vy: int, lags: list[int]):
+        self.lags = np.asarray(lags, dtype=int)
+        nl = len(self.lags)
+        self.n = np.zeros(nl, dtype=np.int64)
+        self.sx = np.zeros((nl, vx))
+        self.sxx = np.zeros((nl, vx))
+        self.sy = np.zeros((nl, vy))
+        self.syy = np.zeros((nl, vy))
+        self.sxy = np.zeros((nl, vx, vy))
+
+    @staticmethod
+    def nbytes(vx: int, vy: int, n_lags: int) -> int:
+        """Size of the running sums of vx x vy vertices and n_lags lags, dominated by Σxy of [lags, vx, vy]"""
+        return n_lags * (vx * vy + 2 * vx + 2 * vy + 1) * np.dtype(np.float64).itemsize
+
+    def update(self, i: int, x: np.ndarray, y: np.ndarray, sign=1):
+        """Adds (sign=1) or removes (sign=-1) the aligned pairs x[k] [k, vx] and y[k] [k, vy] of the i-th lag"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.n[i] += sign * len(x)
+        self.sx[i] += sign * x.sum(axis=0)
+        self.sxx[i] += sign * (x * x).sum(axis=0)
+        self.sy[i] += sign * y.sum(axis=0)
+        self.syy[i] += sign * (y * y).sum(axis=0)
+        self.sxy[i] += sign * (x.T @ y)
+
+    def update_range(self, x: np.ndarray, y: np.ndarray, start: int, stop: int, sign=1):
+        """Adds or removes the pairs (x[t], y[t + tau]) of all lags for the time steps start <= t < stop
+
+        Pairs whose y[t + tau] lies outside of y are skipped.
+        """
+        for i, tau in enumerate(self.lags):
+            stop_tau = min(stop, len(y) - tau)
+            if stop_tau > start:
+                self.update(i, x[start:stop_tau], y[start + tau : stop_tau + tau], sign)
+
+    def correlations(self) -> np.ndarray:
+        """Pearson correlations of every lag of shape [lags, vx, vy], 0 for vertices without variance"""
+        n = self.n[:, None]
+        varx = self.sxx - self.sx**2 / n
+        vary = self.syy - self.sy**2 / n
+        cov = self.sxy - self.sx[:, :, None] * self.sy[:, None, :] / n[:, :, None]
+        std = np.sqrt(np.clip(varx, 0, None))[:, :, None] * np.sqrt(np.clip(vary, 0, None))[:, None, :]
+        return np.divide(cov, std, out=np.zeros(cov.shape), where=std > 1e-12 * n[:, :, None])
+
+    def max_correlation(self):
+        """Maximum absolute correlation over the lags and the lag at which it is reached, like `lapend`"""
+        rho = np.abs(self.correlations())
+        i = rho.argmax(axis=0)
+        return np.take_along_axis(rho, i[None], axis=0)[0].astype(np.float32), self.lags[i].astype(np.int32)
+
+    def similarity(self) -> np.ndarray:
+        """The signed correlation if the only lag is 0 (like `pearson_similarity_matrix`), else `max_correlation`"""
+        if len(self.lags) == 1 and self.lags[0] == 0:
+            return self.correlations()[0].astype(np.float32)
+        return self.max_correlation()[0]
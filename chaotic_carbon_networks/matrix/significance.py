@@ -0,0 +1,152 @@
+import numpy as np
+import xarray as xr
+from rich import print
+from pathlib import Path
+from typing import Callable, Literal, Union
+
+from chaotic_carbon_networks.matrix.gen import xrmatrix_from_func, blocks
+from chaotic_carbon_networks.matrix.fused import SIM_METHODS, similarity_kernel
+
+SURROGATE_METHODS = Literal["shuffle", "phase"]
+
+
+def surrogates(y: np.ndarray, n: int, method: SURROGATE_METHODS = "shuffle", rng: np.random.Generator = None):
+    """Generates n surrogates of every vertex of y [t, v], returned as [t, n * v] with surrogate s in columns s * v + j.
+
+    - "shuffle": Independent random permutations of the time steps, keeps the distribution of the values
+    - "phase": Random Fourier phases, keeps the power spectrum (and autocorrelation) of the time series
+    """
+    rng = rng or np.random.default_rng()
+    ys = np.tile(y, n)
+    if method == "shuffle":
+        return rng.permuted(ys, axis=0)
+    elif method == "phase":
+        t = ys.shape[0]
+        spectrum = np.fft.rfft(ys, axis=0)
+        phases = rng.uniform(0, 2 * np.pi, spectrum.shape)
+        # The mean (and the Nyquist frequency) must stay real
+        phases[0] = 0
+        if t % 2 == 0:
+            phases[-1] = 0
+        return np.fft.irfft(spectrum * np.exp(1j * phases), n=t, axis=0).astype(y.dtype)
+    else:
+        raise ValueError(f"method must be one of {SURROGATE_METHODS}")
+
+
+def surrogate_kernel(
+    f: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    n_surrogates=100,
+    surrogate: SURROGATE_METHODS = "shuffle",
+    seed=0,
+    batch_size=10,
+):
+    """Returns a kernel which calculates the p-values of the similarities of the kernel f against surrogates of y.
+
+    The surrogates are evaluated `batch_size` at a time in one call of f, by concatenating them along the vertices.
+    Only the number of surrogates exceeding the observed similarity is kept per link, so the memory stays at
+    [vx, batch_size * vy] no matter how many surrogates are drawn.
+
+    The surrogates of every y vertex are drawn from its own generator of the seed and the index of the vertex,
+    so they are the same for all tiles of this vertex and the p-values do not depend on the tiling.
+    Links whose observed similarity is NaN (e.g. of constant vertices) get a p-value of NaN.
+    """
+
+    def g(x, y, offset=(0, 0)):
+        obs = f(x, y)
+        count = np.zeros(obs.shape, dtype=np.int32)
+        rngs = [np.random.default_rng([seed, offset[1] + j]) for j in range(y.shape[1])]
+        for start in range(0, n_surrogates, batch_size):
+            n = min(batch_size, n_surrogates - start)
+            ys = np.empty((y.shape[0], n, y.shape[1]), dtype=y.dtype)
+            for j, rng in enumerate(rngs):
+                ys[:, :, j] = surrogates(y[:, j : j + 1], n, surrogate, rng)
+            null = f(x, ys.reshape(y.shape[0], -1)).reshape(x.shape[1], n, y.shape[1])
+            count += (null >= obs[:, None, :]).sum(axis=1)
+        p = ((1 + count) / (n_surrogates + 1)).astype(np.float32)
+        p[np.isnan(obs)] = np.nan
+        return p
+
+    g.takes_offset = True
+    return g
+
+
+def mirror_upper(m: np.ndarray, block_size=2048):
+    """Copies the upper triangle of the square matrix m onto its lower triangle in place, block by block"""
+    n = m.shape[0]
+    for rows in blocks(n, block_size):
+        for cols in blocks(rows.start, block_size):
+            m[rows, cols] = m[cols, rows].T
+        m[rows, rows] = np.triu(m[rows, rows]) + np.triu(m[rows, rows], 1).T
+
+
+def significance_matrix(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    method: SIM_METHODS = "similarity",
+    n_surrogates=100,
+    surrogate: SURROGATE_METHODS = "shuffle",
+    alpha: float = None,
+    bins=64,
+    tau_min: int = None,
+    tau_max: int = None,
+    seed=0,
+    batch_size=10,
+    tile_size=256,
+    store: Union[str, Path] = None,
+):
+    """Tests every link against surrogates of y and returns its p-value, or with `alpha` the adjacency of significant links.
+
+    The p-value of a link is (1 + number of surrogates with a similarity >= the observed one) / (n_surrogates + 1),
+    or NaN if its similarity is NaN, which is never significant. For a single dataset the p-values are symmetric,
+    the link i < j is tested against the surrogates of j. They do not depend on `tile_size`.
+    The matrix is computed tile by tile (see `xrmatrix_from_func`), every tile evaluates its surrogates in batches of
+    `batch_size` with one kernel call each, so the binning of the Mutual Information or the lagged standardization of
+    the Lagged Pearson Correlation are done once per batch instead of once per surrogate.
+
+    Args:
+        x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+        y (xr.DataArray, optional): The DataArray of shape [t, v] or [t, lat, lon]. Defaults to None (x).
+        method (SIM_METHODS, optional): The similarity measure. Defaults to "similarity".
+        n_surrogates (int, optional): Number of surrogates per link. Defaults to 100.
+        surrogate (SURROGATE_METHODS, optional): How the surrogates are generated. Defaults to "shuffle".
+        alpha (float, optional): Significance level. If given, an adjacency matrix is returned. Defaults to None.
+        bins (int, optional): Bins for "mutual_information". Defaults to 64.
+        tau_min (int, optional): Minimum lag for "lagged_similarity". Defaults to None.
+        tau_max (int, optional): Maximum lag for "lagged_similarity". Defaults to None.
+        seed (int, optional): Seed of the surrogates. Defaults to 0.
+        batch_size (int, optional): Number of surrogates per kernel call. Defaults to 10.
+        tile_size (int, optional): Number of vertices per tile and axis. Defaults to 256.
+        store (str | Path, optional): Path of the `.npy` file to write the p-values to. Defaults to None.
+
+    Returns:
+        xr.DataArray: The p-values (or adjacency matrix) of shape [vertex, vertex_other]
+    """
+    single = y is None
+    if single:
+        y = x
+    f = similarity_kernel(x, y, method, bins, tau_min, tau_max)
+    g = surrogate_kernel(f, n_surrogates, surrogate, seed, batch_size)
+
+    p = xrmatrix_from_func(x, y, g, tile_size=tile_size, store=store)
+    if single:
+        # p[i, j] tests against the surrogates of j, the upper triangle is kept so that the links are undirected
+        mirror_upper(p.values, tile_size)
+        # Self-links are never significant
+        np.fill_diagonal(p.values, 1)
+
+    p.attrs = {
+        "long_name": "P-Values of the Links",
+        "valid_range": (0, 1),
+        "actual_range": (p.min().item(), p.max().item()),
+    }
+    if alpha is None:
+        return p
+
+    print(f"{(p <= alpha).mean().item():.2%} of the links are significant at alpha={alpha}")
+    a = (p <= alpha).astype(int)
+    a.attrs = {
+        "long_name": f"Adjacency Matrix",
+        "valid_range": (0, 1),
+        "actual_range": (0, 1),
+    }
+    return a
@@ -0,0 +1,108 @@
+from dataclasses import dataclass, field
+from typing import Literal, Union
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import scipy.sparse as sp
+
+from chaotic_carbon_networks.hex import axis_is_hex
+
+MDIMS = Literal["vertex", "vertex_other"]
+VertexCoords = Union[np.ndarray, pd.MultiIndex]
+
+
+@dataclass
+class SparseMatrix:
+    """A sparse matrix of shape [vertex, vertex_other] with the vertex coordinates attached.
+
+    Stands in for the dense matrices of `chaotic_carbon_networks.matrix.gen` when only a few entries are non-zero,
+    e.g. the links of an adjacency matrix. Memory scales with the number of stored entries instead of v².
+
+    Args:
+        data (sp.csr_array): The sparse matrix of shape [v, v_other]
+        vertex (VertexCoords): Coordinates of the vertex dimension, hex ids or a (lat, lon) MultiIndex
+        vertex_other (VertexCoords): Coordinates of the vertex_other dimension, hex ids or a (lat_other, lon_other) MultiIndex
+        vertex_hex_res (int, optional): Hex resolution of the vertex dimension. None if it is not hex. Defaults to None.
+        vertex_other_hex_res (int, optional): Hex resolution of the vertex_other dimension. None if it is not hex. Defaults to None.
+        attrs (dict, optional): Attributes like the ones of a DataArray. Defaults to {}.
+    """
+
+    data: sp.csr_array
+    vertex: VertexCoords
+    vertex_other: VertexCoords
+    vertex_hex_res: int = None
+    vertex_other_hex_res: int = None
+    attrs: dict = field(default_factory=dict)
+
+    @property
+    def dims(self):
+        return ("vertex", "vertex_other")
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def nnz(self):
+        return self.data.nnz
+
+    def __len__(self):
+        return self.shape[0]
+
+    def hex_res(self, dim: MDIMS):
+        return self.vertex_hex_res if dim == "vertex" else self.vertex_other_hex_res
+
+    def vertex_dataarray(self, values: np.ndarray, dim: MDIMS) -> xr.DataArray:
+        """Wraps a vector of per-vertex values into a DataArray with the coordinates of the dimension `dim`"""
+        da = xr.DataArray(np.asarray(values), dims=dim, coords={dim: getattr(self, dim)})
+        if self.hex_res(dim) is not None:
+            da.coords[dim].attrs["hex_res"] = self.hex_res(dim)
+        return da
+
+    def with_data(self, data: sp.csr_array, attrs: dict = None) -> "SparseMatrix":
+        """Returns a new SparseMatrix with the same coordinates but different data"""
+        return SparseMatrix(
+            data, self.vertex, self.vertex_other, self.vertex_hex_res, self.vertex_other_hex_res, attrs or {}
+        )
+
+    def to_dataarray(self) -> xr.DataArray:
+        """Densifies the matrix into a DataArray as returned by `chaotic_carbon_networks.matrix.gen`"""
+        m = xr.DataArray(
+            self.data.toarray(),
+            dims=self.dims,
+            coords={"vertex": self.vertex, "vertex_other": self.vertex_other},
+            attrs=self.attrs,
+        )
+        if self.vertex_hex_res is not None:
+            m.coords["vertex"].attrs["hex_res"] = self.vertex_hex_res
+        if self.vertex_other_hex_res is not None:
+            m.coords["vertex_other"].attrs["hex_res"] = self.vertex_other_hex_res
+        return m
+
+    @classmethod
+    def from_dataarray(cls, m: xr.DataArray) -> "SparseMatrix":
+        """Stores the non-zero entries of a dense matrix, NaNs are treated as zeros"""
+        assert len(m.dims) == 2, "m must have 2 dimensions"
+        assert "vertex" in m.dims, "m must have vertex dimension"
+        assert "vertex_other" in m.dims, "m must have vertex_other dimension"
+
+        m = m.transpose("vertex", "vertex_other")
+        data = sp.csr_array(np.nan_to_num(m.values, nan=0))
+        data.eliminate_zeros()
+
+        def coords(dim):
+            idx = m.indexes[dim]
+            return idx if isinstance(idx, pd.MultiIndex) else idx.values.copy()
+
+        def hex_res(dim):
+            return m.coords[dim].attrs["hex_res"] if axis_is_hex(m, dim) else None
+
+        return cls(
+            data,
+            coords("vertex"),
+            coords("vertex_other"),
+            hex_res("vertex"),
+            hex_res("vertex_other"),
+            m.attrs.copy(),
+        )
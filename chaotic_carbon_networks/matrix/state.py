@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+from typing import Union
+
+from chaotic_carbon_networks.matrix.gen import stack_vertices, get_coords, default_lags, adjacency_matrix
+from chaotic_carbon_networks.matrix.fused import SIM_METHODS
+from chaotic_carbon_networks.matrix.moments import LaggedMoments
+from chaotic_carbon_networks.matrix.sparse import SparseMatrix
+
+# Maximum size of the statistics of all pairs of a state (joint histograms or lagged moments)
+MAX_STATE_BYTES = 2**30
+
+
+class NetworkState:
+    """Sufficient statistics of a network, which can be updated with new time steps without the history.
+
+    - "similarity" and "lagged_similarity" keep the `LaggedMoments` of all pairs and the last tau_max time steps of x,
+      which are needed for the lagged pairs crossing the boundary to the new time steps.
+    - "mutual_information" keeps the joint histograms of all pairs, i.e. [vx, vy, bins, bins] counts, so it is only
+      suited for modest numbers of vertices (see `max_bytes`, which also bounds the moments of all lags). The bin ranges are fixed by the first data, later values
+      outside of them fall into the outermost bins. Time steps where x or y is NaN are left out of the pair.
+
+    Create a state with `NetworkState.from_data`, then `append` new time steps and get the refreshed
+    `similarity` or `adjacency` matrices. The state can be stored with `save` and restored with `NetworkState.load`.
+    """
+
+    def __init__(self, method: SIM_METHODS, coords: SparseMatrix, single: bool, arrays: dict):
+        self.method = method
+        self.coords = coords
+        self.single = single
+        self.arrays = arrays
+        if method != "mutual_information":
+            self.moments = LaggedMoments(0, 0, arrays["lags"])
+            for name in ("n", "sx", "sxx", "sy", "syy", "sxy"):
+                setattr(self.moments, name, arrays[name])
+
+    @classmethod
+    def from_data(
+        cls,
+        x: xr.DataArray,
+        y: xr.DataArray = None,
+        method: SIM_METHODS = "lagged_similarity",
+        tau_min: int = None,
+        tau_max: int = None,
+        bins=64,
+        max_bytes: int = MAX_STATE_BYTES,
+    ) -> "NetworkState":
+        """Creates the state of the network of x (and y) of the similarity measure `method`
+
+        Args:
+            x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+            y (xr.DataArray, optional): The DataArray of shape [t, v] or [t, lat, lon]. Defaults to None (x).
+            method (SIM_METHODS, optional): The similarity measure. Defaults to "lagged_similarity".
+            tau_min (int, optional): Minimum lag for "lagged_similarity". Defaults to None.
+            tau_max (int, optional): Maximum lag for "lagged_similarity". Defaults to None.
+            bins (int, optional): Bins for "mutual_information". Defaults to 64.
+            max_bytes (int, optional): Maximum size of the joint histograms or lagged moments of all pairs.
+                Defaults to 1 GiB.
+        """
+        single = y is None
+        if single:
+            y = x
+        xs, x_is_hex = stack_vertices(x)
+        ys, y_is_hex = stack_vertices(y)
+        coords = SparseMatrix(
+            None,
+            get_coords(xs, x_is_hex, False),
+            get_coords(ys, y_is_hex, True),
+            xs.coords["vertex"].attrs["hex_res"] if x_is_hex else None,
+            ys.coords["vertex"].attrs["hex_res"] if y_is_hex else None,
+        )
+
+        xv = xs.values.astype(np.float64)
+        yv = ys.values.astype(np.float64)
+        if method == "similarity":
+            lags = np.arange(1)
+        elif method == "lagged_similarity":
+            tau_min, tau_max = default_lags(x, tau_min, tau_max)
+            lags = np.arange(tau_min, tau_max)
+        elif method == "mutual_information":
+            nbytes = xv.shape[1] * yv.shape[1] * bins * bins * np.dtype(np.uint32).itemsize
+            assert nbytes <= max_bytes, (
+                f"The joint histograms of {xv.shape[1]} x {yv.shape[1]} vertices with {bins} bins need "
+                f"{nbytes / 2**30:.1f} GiB, use fewer vertices or bins or raise max_bytes"
+            )
+            arrays = {
+                "bins": np.array(bins),
+                "xrange": np.array([np.nanmin(xv), np.nanmax(xv)]),
+                "yrange": np.array([np.nanmin(yv), np.nanmax(yv)]),
+                "joint": np.zeros((xv.shape[1], yv.shape[1], bins, bins), dtype=np.uint32),
+                "n": np.array(0),
+            }
+            state = cls(method, coords, single, arrays)
+            state.update(xv, yv)
+            return state
+        else:
+            raise ValueError(f"method must be one of {SIM_METHODS}")
+
+        nbytes = LaggedMoments.nbytes(xv.shape[1], yv.shape[1], len(lags))
+        assert nbytes <= max_bytes, (
+            f"The lagged moments of {xv.shape[1]} x {yv.shape[1]} vertices with {len(lags)} lags need "
+            f"{nbytes / 2**30:.1f} GiB, use fewer vertices or lags or raise max_bytes"
+        )
+
+        # Center the data by the first means to keep the running sums precise
+        moments = LaggedMoments(xv.shape[1], yv.shape[1], lags)
+        arrays = {
+            "lags": moments.lags,
+            "xoffset": xv.mean(axis=0),
+            "yoffset": yv.mean(axis=0),
+            "xtail": np.zeros((0, xv.shape[1])),
+            **{name: getattr(moments, name) for name in ("n", "sx", "sxx", "sy", "syy", "sxy")},
+        }
+        state = cls(method, coords, single, arrays)
+        state.update(xv, yv)
+        return state
+
+    def align(self, x: xr.DataArray, dim: str) -> np.ndarray:
+        """Returns the values of new time steps of x in the vertex order of the state"""
+        if len(x.dims) == 2:
+            return x.transpose("time", "vertex").sel(vertex=getattr(self.coords, dim)).values.astype(np.float64)
+        xs = x.stack(vertex=("lat", "lon")).transpose("time", "vertex")
+        idx = xs.indexes["vertex"].get_indexer(getattr(self.coords, dim).to_flat_index())
+        assert (idx >= 0).all(), "x must contain all vertices of the state"
+        return xs.values[:, idx].astype(np.float64)
+
+    def update(self, xv: np.ndarray, yv: np.ndarray):
+        """Adds new time steps xv [k, vx] and yv [k, vy], which directly follow the time steps already in the state"""
+        a = self.arrays
+        if self.method == "mutual_information":
+            bins = int(a["bins"])
+            joint = a["joint"].reshape(-1)
+            vx, vy = xv.shape[1], yv.shape[1]
+            cx = quantize(xv, bins, a["xrange"])
+            cy = quantize(yv, bins, a["yrange"])
+            pair = (np.arange(vx)[:, None] * vy + np.arange(vy)[None, :]) * bins * bins
+            for t in range(len(xv)):
+                # NaN samples have the code -1 and are skipped
+                valid = (cx[t] >= 0)[:, None] & (cy[t] >= 0)[None, :]
+                joint[(pair + cx[t][:, None] * bins + cy[t][None, :])[valid]] += 1
+            a["n"] = a["n"] + len(xv)
+            return
+
+        xv = xv - a["xoffset"]
+        yv = yv - a["yoffset"]
+        # The pairs (x[t], y[t + tau]) with t + tau in the new time steps, x[t] may be in the kept tail
+        xc = np.concatenate([a["xtail"], xv])
+        nt = len(a["xtail"])
+        for i, tau in enumerate(self.moments.lags):
+            start = max(nt - tau, 0)
+            stop = len(xc) - tau
+            if stop > start:
+                self.moments.update(i, xc[start:stop], yv[start + tau - nt : stop + tau - nt])
+        a["xtail"] = xc[-max(self.moments.lags.max(), 1) :]
+
+    def append(self, x: xr.DataArray, y: xr.DataArray = None):
+        """Adds the new time steps of x (and y) to the state, they must directly follow the time steps already added"""
+        if y is None:
+            assert self.single, "y must be given, since the state has two datasets"
+            y = x
+        self.update(self.align(x, "vertex"), self.align(y, "vertex_other"))
+
+    def similarity(self) -> xr.DataArray:
+        """The similarity matrix of all time steps added so far"""
+        a = self.arrays
+        if self.method == "mutual_information":
+            joint = a["joint"].astype(np.float64)
+            nlogn = lambda c: np.where(c > 0, c * np.log(np.where(c > 0, c, 1)), 0)
+            sxy = nlogn(joint).sum(axis=(2, 3))
+            sx = nlogn(joint.sum(axis=3)).sum(axis=2)
+            sy = nlogn(joint.sum(axis=2)).sum(axis=2)
+            # The number of samples of every pair, which differ if there are NaNs
+            n = joint.sum(axis=(2, 3))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                m = np.where(n > 0, np.log(np.maximum(n, 1)) - (sx + sy - sxy) / n, np.nan).astype(np.float32)
+            long_name = "Mutual Information Matrix"
+        else:
+            m = self.moments.similarity()
+            long_name = "Pearson Similarity Matrix"
+        if self.single:
+            np.fill_diagonal(m, 0)
+
+        m = self.dataarray(m)
+        m.attrs = {
+            "long_name": long_name,
+            "valid_range": (0, np.inf),
+            "actual_range": (m.min().item(), m.max().item()),
+        }
+        return m
+
+    def dataarray(self, m: np.ndarray) -> xr.DataArray:
+        """Wraps a matrix into a DataArray with the coordinates of the state"""
+        da = xr.DataArray(
+            m,
+            dims=("vertex", "vertex_other"),
+            coords={"vertex": self.coords.vertex, "vertex_other": self.coords.vertex_other},
+        )
+        if self.coords.vertex_hex_res is not None:
+            da.coords["vertex"].attrs["hex_res"] = self.coords.vertex_hex_res
+        if self.coords.vertex_other_hex_res is not None:
+            da.coords["vertex_other"].attrs["hex_res"] = self.coords.vertex_other_hex_res
+        return da
+
+    def adjacency(self, rr=0.05) -> xr.DataArray:
+        """The adjacency matrix of all time steps added so far"""
+        return adjacency_matrix(self.similarity(), rr)
+
+    def save(self, path: Union[str, Path]):
+        """Stores the state into a `.npz` file"""
+        coords = {}
+        for dim in ("vertex", "vertex_other"):
+            c = getattr(self.coords, dim)
+            if isinstance(c, pd.MultiIndex):
+                coords[f"{dim}_lat"] = c.get_level_values(0).values
+                coords[f"{dim}_lon"] = c.get_level_values(1).values
+            else:
+                coords[f"{dim}_hex"] = c
+                coords[f"{dim}_hex_res"] = np.array(self.coords.hex_res(dim))
+        np.savez(path, method=np.array(self.method), single=np.array(self.single), **coords, **self.arrays)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "NetworkState":
+        """Restores a state stored with `save`"""
+        f = dict(np.load(path))
+        coords = {}
+        hex_res = {}
+        for dim, names in (("vertex", ("lat", "lon")), ("vertex_other", ("lat_other", "lon_other"))):
+            if f"{dim}_hex" in f:
+                coords[dim] = f.pop(f"{dim}_hex")
+                hex_res[dim] = int(f.pop(f"{dim}_hex_res"))
+            else:
+                coords[dim] = pd.MultiIndex.from_arrays([f.pop(f"{dim}_lat"), f.pop(f"{dim}_lon")], names=names)
+                hex_res[dim] = None
+        method = str(f.pop("method"))
+        single = bool(f.pop("single"))
+        sm = SparseMatrix(None, coords["vertex"], coords["vertex_other"], hex_res["vertex"], hex_res["vertex_other"])
+        return cls(method, sm, single, f)
+
+
+def quantize(x: np.ndarray, bins: int, xrange: np.ndarray) -> np.ndarray:
+    """Bin codes of x like `mind`, values outside of xrange fall into the outermost bins and NaNs get the code -1"""
+    xmin, xmax = xrange
+    codes = np.floor((x - xmin) * (bins / (xmax - xmin)))
+    codes = np.clip(codes, 0, bins - 1)
+    return np.where(np.isnan(codes), -1, codes).astype(np.int64)
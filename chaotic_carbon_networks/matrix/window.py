@@ -0,0 +1,112 @@
+import numpy as np
+import xarray as xr
+from typing import Iterator
+
+from chaotic_carbon_networks.matrix.gen import stack_vertices, matrix_dataarray, adjacency_matrix
+from chaotic_carbon_networks.matrix.measures import degrees, average_link_length
+from chaotic_carbon_networks.matrix.moments import LaggedMoments
+
+
+def windowed_networks(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    window: int = 365,
+    step: int = 30,
+    tau_min: int = None,
+    tau_max: int = None,
+    lagged=True,
+    rr=0.05,
+) -> Iterator[tuple[np.datetime64, xr.DataArray, xr.DataArray]]:
+    """Lazily yields the degrees and average link lengths of the networks of sliding windows over the time series.
+
+    The (lagged) Pearson correlations are not recomputed for every window: the sums of `LaggedMoments` are updated
+    with the `step` time steps which enter and leave the window, so every step costs O(step * v²) per lag instead of
+    O(window * v²). The networks equal `laged_pearson_similarity_matrix` (or `pearson_similarity_matrix` if not
+    `lagged`) of every window, thresholded with `adjacency_matrix(m, rr)`.
+
+    Args:
+        x (xr.DataArray): The DataArray of shape [t, v] or [t, lat, lon]
+        y (xr.DataArray, optional): The DataArray of shape [t, v] or [t, lat, lon]. Defaults to None (x).
+        window (int, optional): Length of the windows in time steps. Defaults to 365.
+        step (int, optional): Time steps between two windows. Defaults to 30.
+        tau_min (int, optional): Minimum lag. Defaults to None (1/40 of the window, at least 1).
+        tau_max (int, optional): Maximum lag (exclusive). Defaults to None (1/10 of the window).
+        lagged (bool, optional): Whether to use the lagged Pearson correlation. Defaults to True.
+        rr (float, optional): Link density. Defaults to 0.05.
+
+    Yields:
+        tuple[np.datetime64, xr.DataArray, xr.DataArray]: The last time step of the window, degrees and average link lengths
+    """
+    single = y is None
+    if single:
+        y = x
+    assert len(x.time) == len(y.time), "x and y must have the same time steps"
+    assert len(x.time) >= window, "window must not be longer than the time series"
+
+    if lagged:
+        if tau_min is None:
+            tau_min = max(1, int(window / 40))
+        if tau_max is None:
+            tau_max = int(window / 10)
+        assert 0 <= tau_min < tau_max, f"the lags {tau_min} to {tau_max} are empty, give tau_min and tau_max"
+        assert tau_max < window, "tau_max must be shorter than the window"
+        lags = np.arange(tau_min, tau_max)
+    else:
+        lags = np.arange(1)
+
+    x, x_is_hex = stack_vertices(x)
+    y, y_is_hex = stack_vertices(y)
+    # Center the data once to keep the running sums precise
+    xv = x.values - x.values[:window].mean(axis=0)
+    yv = y.values - y.values[:window].mean(axis=0)
+    times = x.time.values
+
+    moments = LaggedMoments(xv.shape[1], yv.shape[1], lags)
+
+    # The pairs (x[t], y[t + tau]) of the window [s, s + window) are the ones with s <= t < s + window - tau,
+    # when the window slides, the pairs leaving and entering this range are removed and added
+    for start in range(0, len(times) - window + 1, step):
+        for i, tau in enumerate(lags):
+            n = window - tau
+            prev = start - step
+            if start == 0:
+                moments.update(i, xv[:n], yv[tau : n + tau])
+                continue
+            a, b = prev, min(prev + n, start)
+            moments.update(i, xv[a:b], yv[a + tau : b + tau], -1)
+            a, b = max(start, prev + n), start + n
+            moments.update(i, xv[a:b], yv[a + tau : b + tau], 1)
+
+        rho = moments.similarity()
+        if single:
+            np.fill_diagonal(rho, 0)
+        m = matrix_dataarray(rho, x, x_is_hex, y, y_is_hex)
+        a = adjacency_matrix(m, rr)
+        yield times[start + window - 1], degrees(a), average_link_length(a)
+
+
+def windowed_measures(
+    x: xr.DataArray,
+    y: xr.DataArray = None,
+    window: int = 365,
+    step: int = 30,
+    tau_min: int = None,
+    tau_max: int = None,
+    lagged=True,
+    rr=0.05,
+) -> xr.Dataset:
+    """Collects the results of `windowed_networks` into a Dataset with the variables degree and average_link_length,
+    indexed by the last time step of every window"""
+    times, degs, avglls = [], [], []
+    for t, deg, avgll in windowed_networks(x, y, window, step, tau_min, tau_max, lagged, rr):
+        times.append(t)
+        degs.append(deg)
+        avglls.append(avgll)
+
+    time = xr.DataArray(times, dims="time", name="time")
+    return xr.Dataset(
+        {
+            "degree": xr.concat(degs, dim=time, combine_attrs="override"),
+            "average_link_length": xr.concat(avglls, dim=time, combine_attrs="override"),
+        }
+    )
@@ -2,54 +2,147 @@ from pathlib import Path
 from rich.progress import track
 from rich import print
 import xarray as xr
-from typing import Literal
+from typing import Callable, Literal
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import hashlib
+import json
+import os
 
 from chaotic_carbon_networks import ROOT
-from chaotic_carbon_networks.masks import mask_population
+from chaotic_carbon_networks.masks import mask_population, population_mask, apply_masks
 from chaotic_carbon_networks.hex import hexgrid
+from chaotic_carbon_networks.cache import save_cache, open_cached_dataarray, open_cached_dataset
+from chaotic_carbon_networks.anomaly_correction import CorrectMethod
 
 DATA_DIR = ROOT / "data"
 
 ResampleMethod = Literal["mean", "max", "min", "sum"]
-CorrectMethod = Literal["month", "week", "weekday"]
 
 
 def get_cached_fname(resample: int = None, method: ResampleMethod = "mean"):
     fname = "graced_co2_concat"
     if resample:
         fname += f"_{resample}x_{method}ed"
-    fname += ".nc"
+    fname += ".zarr"
     return fname
 
 
-def concat_graced_data(resample: int = None, method: ResampleMethod = "mean", force=False) -> xr.DataArray:
+def file_key(file: Path, **params) -> str:
+    """Key of a raw file and its processing parameters, changes whenever the file is modified"""
+    stat = file.stat()
+    key = json.dumps([file.name, stat.st_size, stat.st_mtime_ns, params], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def params_dirname(**params) -> str:
+    """Directory name of a set of processing parameters, e.g. `hex_res-3_method-sum`"""
+    return "_".join(f"{k}-{v}" for k, v in sorted(params.items())) or "default"
+
+
+def cached_per_file(
+    files: list[Path],
+    process: Callable[..., xr.DataArray],
+    cache_dir: Path,
+    force=False,
+    workers: int = None,
+    **params,
+) -> list[Path]:
+    """Processes every file independently into its own cache file, in parallel and only if not cached yet.
+
+    The cache file of a raw file is keyed by its size, modification time and the processing parameters,
+    so only new or changed files are processed again. Every set of parameters has its own subdirectory of
+    cache_dir, so runs with different parameters keep each other's caches.
+
+    Args:
+        files (list[Path]): The raw files
+        process (Callable): Top-level function called as process(file, **params), which returns the processed DataArray
+        cache_dir (Path): Directory of the cache files, the subdirectories per parameters are created in it
+        force (bool, optional): Process all files again. Defaults to False.
+        workers (int, optional): Number of processes. Defaults to None (number of CPUs).
+
+    Returns:
+        list[Path]: The cache files in the order of files
+    """
+    cache_dir = cache_dir / params_dirname(**params)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    cached = [cache_dir / f"{file.stem}_{file_key(file, **params)}.nc" for file in files]
+    todo = [(file, c) for file, c in zip(files, cached) if force or not c.exists()]
+    if not todo:
+        return cached
+    print(f"Processing {len(todo)} of {len(files)} files")
+
+    # Process the first file serially, so that shared caches (e.g. population mask, hex operator) are written only once
+    process_to_cache(process, *todo[0], **params)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(process_to_cache, process, file, c, **params) for file, c in todo[1:]]
+        for future in track(as_completed(futures), total=len(futures)):
+            future.result()
+
+    # Remove outdated versions of the processed files, only those of the same parameters share cache_dir
+    for file, c in todo:
+        for old in cache_dir.glob(f"{file.stem}_{'?' * 16}.nc"):
+            if old != c:
+                old.unlink()
+
+    return cached
+
+
+def process_to_cache(process: Callable[..., xr.DataArray], file: Path, cached: Path, **params):
+    da = process(file, **params)
+    # Write to a temporary file first, so that an interrupted run never leaves a broken cache file behind
+    tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+    da.to_netcdf(tmp)
+    os.replace(tmp, cached)
+
+
+def manifest_is_current(cached_files: list[Path], cached: Path) -> bool:
+    """Whether the concatenated cache file `cached` was built from exactly the per-file caches"""
+    manifest = cached.with_suffix(".json")
+    if not cached.exists() or not manifest.exists():
+        return False
+    return json.loads(manifest.read_text()) == [c.name for c in cached_files]
+
+
+def write_manifest(cached_files: list[Path], cached: Path):
+    cached.with_suffix(".json").write_text(json.dumps([c.name for c in cached_files]))
+
+
+def coarsen_graced_file(file: Path, resample: int = None, method: ResampleMethod = "mean") -> xr.DataArray:
+    da = xr.open_dataarray(file)
+    if resample:
+        da = da.coarsen(latitude=resample, longitude=resample, boundary="trim")
+        if method == "mean":
+            da = da.mean()
+        elif method == "max":
+            da = da.max()
+        elif method == "min":
+            da = da.min()
+        elif method == "sum":
+            da = da.sum()
+    return da
+
+
+def concat_graced_data(
+    resample: int = None, method: ResampleMethod = "mean", force=False, workers: int = None
+) -> xr.DataArray:
     RAW_DIR = DATA_DIR / "graced" / "original"
     CACHE_DIR = DATA_DIR / "graced" / "cache"
     CACHE_DIR.mkdir(exist_ok=True, parents=True)
 
     fname = get_cached_fname(resample, method)
     cached = CACHE_DIR / fname
-    if cached.exists() and not force:
+
+    files = sorted(RAW_DIR.glob("*.nc"))
+    cached_files = cached_per_file(
+        files, coarsen_graced_file, CACHE_DIR / "files" / "concat", force, workers, resample=resample, method=method
+    )
+    if not force and manifest_is_current(cached_files, cached):
         print(f"Loading cached data from {cached}")
-        return xr.open_dataarray(cached)
-
-    files = list(RAW_DIR.glob("*.nc"))
-    arrays = []
-    for file in track(files):
-        da = xr.open_dataarray(file)
-        if resample:
-            da = da.coarsen(latitude=resample, longitude=resample, boundary="trim")
-            if method == "mean":
-                da = da.mean()
-            elif method == "max":
-                da = da.max()
-            elif method == "min":
-                da = da.min()
-            elif method == "sum":
-                da = da.sum()
-        arrays.append(da)
-    co2 = xr.concat(arrays, dim="nday")
+        return open_cached_dataarray(cached)
+
+    co2 = xr.concat([xr.open_dataarray(c) for c in cached_files], dim="nday")
     co2 = co2.rename({"latitude": "lat", "longitude": "lon", "nday": "time"})
     co2 = co2.sortby("time")
 
@@ -57,74 +150,226 @@ def concat_graced_data(resample: int = None, method: ResampleMethod = "mean", fo
     co2 = co2 * 24
 
     co2.attrs = {"units": "kgC", "long_name": "Carbon Dioxide Emissions"}
-    co2.name = fname.strip(".nc")
+    co2.name = cached.stem
 
     print(f"Saving data to {cached}")
-    co2.to_netcdf(cached)
+    save_cache(co2, cached)
+    write_manifest(cached_files, cached)
+
+    return open_cached_dataarray(cached)
+
+
+def open_graced_data(
+    resample: int = None, method: ResampleMethod = "mean", time_chunk: int = 1, parallel=True
+) -> xr.DataArray:
+    """Lazily opens the raw GRACED files as one dask-backed DataArray, optionally coarsened.
+
+    Unlike `concat_graced_data` nothing is computed or cached, the coarsening is part of the dask graph,
+    so only `time_chunk` days of the full grid are held in memory per chunk.
+
+    Args:
+        resample (int, optional): Coarsening factor of lat and lon. Defaults to None.
+        method (ResampleMethod, optional): How the coarsened cells are calculated. Defaults to "mean".
+        time_chunk (int, optional): Number of days per chunk. Defaults to 1.
+        parallel (bool, optional): Open the metadata of the files in parallel. Defaults to True.
+
+    Returns:
+        xr.DataArray: The daily emissions in kgC of shape [time, lat, lon]
+    """
+    RAW_DIR = DATA_DIR / "graced" / "original"
+    files = sorted(RAW_DIR.glob("*.nc"))
+
+    ds = xr.open_mfdataset(
+        files,
+        combine="nested",
+        concat_dim="nday",
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="override",
+        # lat and lon must not be chunked, since they are the core dimensions of coarsen and hexgrid
+        chunks={"nday": time_chunk, "latitude": -1, "longitude": -1},
+        parallel=parallel,
+    )
+    co2 = next(iter(ds.data_vars.values()))
+    if resample:
+        co2 = co2.coarsen(latitude=resample, longitude=resample, boundary="trim")
+        co2 = getattr(co2, method)()
+    co2 = co2.rename({"latitude": "lat", "longitude": "lon", "nday": "time"})
+    co2 = co2.sortby("time")
+
+    # Convert from kgC/h to kgC
+    co2 = co2 * 24
+
+    co2.attrs = {"units": "kgC", "long_name": "Carbon Dioxide Emissions"}
+    co2.name = Path(get_cached_fname(resample, method)).stem
+    return co2
+
 
+def open_preprocessed_graced_data(
+    hex_res: int = 3,
+    method: ResampleMethod = "sum",
+    population_threshold: float = 0,
+    time_chunk: int = 1,
+) -> xr.DataArray:
+    """Lazy counterpart of `preprocess_graced_data`: masks and hexgrids the lazily opened GRACED data.
+
+    The hexes are taken from the static population mask, so nothing is read up front and the aggregation onto the
+    hexgrid is computed chunk by chunk on access.
+
+    Args:
+        hex_res (int, optional): Resolution of the hexgrid. Defaults to 3.
+        method (ResampleMethod, optional): How the values of each hex-bin should be calculated. Defaults to "sum".
+        population_threshold (float, optional): Threshold of the population mask. Defaults to 0.
+        time_chunk (int, optional): Number of days per chunk. Defaults to 1.
+
+    Returns:
+        xr.DataArray: The daily emissions in kgC of shape [time, vertex]
+    """
+    co2 = open_graced_data(time_chunk=time_chunk)
+    masked = population_mask(co2, threshold=population_threshold)
+    co2 = apply_masks(co2, masked)
+    co2 = hexgrid(co2, method=method, hex_res=hex_res, valid=~masked)
+
+    co2.attrs = {"units": "kgC", "long_name": "Carbon Dioxide Emissions"}
+    co2.name = f"preprocessed_res{hex_res}"
     return co2
 
 
-def preprocess_graced_data(hex_res: int = 3, force=False):
+def hexgrid_graced_file(
+    file: Path, hex_res: int = 3, method: ResampleMethod = "sum", population_threshold: float = 0
+) -> xr.DataArray:
+    da = xr.open_dataarray(file)
+    da = da.rename({"latitude": "lat", "longitude": "lon", "nday": "time"})
+    # Convert from kgC/h to kgC
+    da = da * 24
+    da = mask_population(da, threshold=population_threshold)
+    da = hexgrid(da, method=method, hex_res=hex_res)
+    return da
+
+
+def preprocess_graced_data(
+    hex_res: int = 3,
+    force=False,
+    method: ResampleMethod = "sum",
+    population_threshold: float = 0,
+    workers: int = None,
+):
+    """Masks and hexgrids the raw GRACED files in parallel and concatenates them.
+
+    Every raw file is processed into its own cache file, so when new months are added (or files change)
+    only these are processed again. The concatenated result is cached as well.
+
+    Args:
+        hex_res (int, optional): Resolution of the hexgrid. Defaults to 3.
+        force (bool, optional): Process all files again. Defaults to False.
+        method (ResampleMethod, optional): How the values of each hex-bin should be calculated. Defaults to "sum".
+        population_threshold (float, optional): Threshold of the population mask. Defaults to 0.
+        workers (int, optional): Number of processes. Defaults to None (number of CPUs).
+    """
     RAW_DIR = DATA_DIR / "graced" / "original"
     CACHE_DIR = DATA_DIR / "graced" / "cache"
     CACHE_DIR.mkdir(exist_ok=True, parents=True)
 
-    fname = f"preprocessed_res{hex_res}.nc"
+    fname = f"preprocessed_res{hex_res}.zarr"
+    if method != "sum" or population_threshold != 0:
+        fname = f"preprocessed_res{hex_res}_{method}_pop{population_threshold}.zarr"
     cached = CACHE_DIR / fname
-    if cached.exists() and not force:
+
+    files = sorted(RAW_DIR.glob("*.nc"))
+    cached_files = cached_per_file(
+        files,
+        hexgrid_graced_file,
+        CACHE_DIR / "files" / "hex",
+        force,
+        workers,
+        hex_res=hex_res,
+        method=method,
+        population_threshold=population_threshold,
+    )
+    if not force and manifest_is_current(cached_files, cached):
         print(f"Loading cached data from {cached}")
-        return xr.open_dataarray(cached)
-
-    files = list(RAW_DIR.glob("*.nc"))
-    arrays = []
-    for file in track(files):
-        da = xr.open_dataarray(file)
-        da = da.rename({"latitude": "lat", "longitude": "lon", "nday": "time"})
-        # Convert from kgC/h to kgC
-        da = da * 24
-        da = mask_population(da)
-        da = hexgrid(da, method="sum", hex_res=hex_res)
-        arrays.append(da)
-    co2 = xr.concat(arrays, dim="time").sortby("time")
+        return open_cached_dataarray(cached)
+
+    co2 = xr.concat([xr.open_dataarray(c) for c in cached_files], dim="time").sortby("time")
     co2.vertex.attrs = {"hex_res": hex_res}
 
     co2.attrs = {"units": "kgC", "long_name": "Carbon Dioxide Emissions"}
-    co2.name = fname.strip(".nc")
+    co2.name = cached.stem
 
     print(f"Saving data to {cached}")
-    co2.to_netcdf(cached)
+    save_cache(co2, cached)
+    write_manifest(cached_files, cached)
 
-    return co2
+    return open_cached_dataarray(cached)
 
 
-def concat_airs_data(force=False) -> xr.Dataset:
+def airs_date(file: Path) -> datetime:
+    """Date of a raw AIRS file, parsed from its name"""
+    return datetime.strptime(file.stem.split(".")[3], "%Y%m%d")
+
+
+def prepare_airs_file(ds: xr.Dataset, variables: list[str] = None) -> xr.Dataset:
+    """Selects the variables of an opened AIRS file and adds the time dimension to concatenate along"""
+    if variables is not None:
+        ds = ds[list(variables)]
+    return ds.expand_dims("time")
+
+
+def open_airs_data(variables: list[str] = None, parallel=True) -> xr.Dataset:
+    """Lazily opens the raw AIRS files as one dask-backed Dataset with one chunk per file (day).
+
+    The dates are parsed from the file names, the variables are selected before the files are combined, and
+    the coordinates of the files are not compared, since all files share the same grid.
+
+    Args:
+        variables (list[str], optional): The variables to open. Defaults to None (all).
+        parallel (bool, optional): Open the metadata of the files in parallel. Defaults to True.
+
+    Returns:
+        xr.Dataset: The AIRS data with a time dimension
+    """
     RAW_DIR = DATA_DIR / "aqua-airs" / "raw"
+    files = sorted(RAW_DIR.glob("*.nc.nc4"), key=airs_date)
+    dates = [airs_date(file) for file in files]
+
+    airs = xr.open_mfdataset(
+        files,
+        combine="nested",
+        concat_dim="time",
+        preprocess=partial(prepare_airs_file, variables=variables),
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="override",
+        chunks=-1,
+        parallel=parallel,
+    )
+    airs = airs.assign_coords(time=dates)
+
+    # Correct co variable according to documentation
+    if "co_mmr_midtrop" in airs:
+        airs["co_mmr_midtrop"] = airs["co_mmr_midtrop"] * 28.01 / 44.01
+
+    return airs
+
+
+def concat_airs_data(force=False, variables: list[str] = None) -> xr.Dataset:
     CACHE_DIR = DATA_DIR / "aqua-airs" / "cache"
     CACHE_DIR.mkdir(exist_ok=True, parents=True)
 
-    fname = "aqua_airs_concat.nc"
+    fname = "aqua_airs_concat.zarr"
+    if variables is not None:
+        fname = f"aqua_airs_concat_{'_'.join(sorted(variables))}.zarr"
     cached = CACHE_DIR / fname
     if cached.exists() and not force:
         print(f"Loading cached data from {cached}")
-        return xr.open_dataset(cached)
+        return open_cached_dataset(cached)
 
-    files = list(RAW_DIR.glob("*.nc.nc4"))
-    datasets = []
-    for file in track(files):
-        date = file.stem.split(".")[3]
-        date = datetime.strptime(date, "%Y%m%d")
-        ds = xr.open_dataset(file)
-        ds = ds.expand_dims({"time": [date]})
-        datasets.append(ds)
-
-    airs = xr.concat(datasets, dim="time")
-    airs = airs.sortby("time")
-
-    # Correct co variable according to documentation
-    airs["co_mmr_midtrop"] = airs["co_mmr_midtrop"] * 28.01 / 44.01
+    airs = open_airs_data(variables)
 
+    # The data is written chunk by chunk, without loading all files at once
     print(f"Saving data to {cached}")
-    airs.to_netcdf(cached)
+    save_cache(airs, cached)
 
-    return airs
+    return open_cached_dataset(cached)
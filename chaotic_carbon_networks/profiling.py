@@ -0,0 +1,338 @@
+"""Stage-level profiling of the analysis pipelines.
+
+Every stage records its wall time, CPU time (of all threads, so cpu / wall is the parallelism), resident and peak
+memory and the sizes of its outputs. The Rust kernels report their progress to the running stage via callbacks.
+The records can be saved as JSON or as a Chrome trace, which opens in https://ui.perfetto.dev or chrome://tracing.
+
+Profiling is disabled by default, then `stage` returns a shared no-op context and `progress` returns None, so the
+instrumented code only pays a global lookup per stage. Enable it with `profile` or the environment variable
+`CCN_PROFILE=<path>` (a `.json` or `.trace.json` file written at exit):
+
+```python
+from chaotic_carbon_networks.profiling import profile
+
+with profile("figures/single.trace.json"):
+    single_dataset(x, "mutual_information")
+```
+"""
+
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from threading import Lock, local, get_ident
+from typing import Union
+from rich.console import Console
+from rich.table import Table
+from rich import print
+import resource
+import atexit
+import json
+import time
+import sys
+import os
+
+ENV_VAR = "CCN_PROFILE"
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB (ru_maxrss is in KB on Linux and in bytes on macOS)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def rss_mb() -> float:
+    """Current resident memory of this process in MB, None where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return None
+
+
+def nbytes(obj) -> int:
+    """Bytes of an array, DataArray, Dataset or SparseMatrix (of its stored entries), None for anything else"""
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    data = getattr(obj, "data", None)
+    if hasattr(data, "indptr"):
+        return int(data.data.nbytes + data.indices.nbytes + data.indptr.nbytes)
+    return None
+
+
+def describe(obj) -> dict:
+    """Type, shape, dtype and bytes of an output"""
+    shape = getattr(obj, "shape", None)
+    dtype = getattr(obj, "dtype", None)
+    return {
+        "type": type(obj).__name__,
+        "shape": list(shape) if shape is not None else None,
+        "dtype": str(dtype) if dtype is not None else None,
+        "nbytes": nbytes(obj),
+    }
+
+
+class Stage:
+    """The record of a running stage, to which the instrumented code adds its outputs and further info"""
+
+    def __init__(self, name: str, path: str, depth: int, info: dict):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.info = info
+        self.outputs = []
+        self.thread = get_ident()
+
+    def add(self, **info):
+        self.info.update(info)
+
+    def output(self, *objs):
+        """Records the shapes and sizes of the outputs, tuples (e.g. of a matrix and its lags) are unpacked"""
+        for obj in objs:
+            if isinstance(obj, tuple):
+                self.output(*obj)
+            elif obj is not None:
+                self.outputs.append(describe(obj))
+        return objs[0] if len(objs) == 1 else objs
+
+
+class NullStage:
+    """Stands in for `Stage` when profiling is disabled"""
+
+    def add(self, **info):
+        pass
+
+    def output(self, *objs):
+        return objs[0] if len(objs) == 1 else objs
+
+
+NULL_STAGE = NullStage()
+NULL_CONTEXT = nullcontext(NULL_STAGE)
+
+
+class Profiler:
+    """Collects the records of the stages and the progress of the kernels, can be shared by threads"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.local = local()
+        self.start = time.perf_counter()
+        self.records = []
+        self.events = []
+
+    def timestamp(self) -> float:
+        return time.perf_counter() - self.start
+
+    def stack(self) -> list[Stage]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        stack = self.stack()
+        path = f"{stack[-1].path}/{name}" if stack else name
+        s = Stage(name, path, len(stack), info)
+        stack.append(s)
+        start, cpu_start = self.timestamp(), time.process_time()
+        rss_start, peak_start = rss_mb(), peak_rss_mb()
+        error = None
+        try:
+            yield s
+        except BaseException as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            end, cpu_end = self.timestamp(), time.process_time()
+            stack.pop()
+            peak = peak_rss_mb()
+            record = {
+                "name": name,
+                "path": path,
+                "depth": s.depth,
+                "thread": s.thread,
+                "start": start,
+                "wall_s": end - start,
+                "cpu_s": cpu_end - cpu_start,
+                "rss_start_mb": rss_start,
+                "rss_end_mb": rss_mb(),
+                "peak_rss_mb": peak,
+                # The peak of the process only grows, so this is how much the stage raised it
+                "peak_rss_growth_mb": peak - peak_start,
+                "outputs": s.outputs,
+                "info": s.info,
+            }
+            if error:
+                record["error"] = error
+            with self.lock:
+                self.records.append(record)
+
+    def current_path(self) -> str:
+        """Path of the innermost stage running in the calling thread, None outside of any stage"""
+        stack = self.stack()
+        return stack[-1].path if stack else None
+
+    def progress(self, name: str, parent: str = None):
+        """Returns a callback `(done, total)` for the kernels, which records the progress under the parent path.
+
+        The stages are tracked per thread, so kernels running in worker threads have to get the parent path
+        from the thread which started them, see `current_path`.
+        """
+        path = f"{parent}/{name}" if parent else name
+
+        def callback(done: int, total: int):
+            event = {"name": path, "t": self.timestamp(), "thread": get_ident(), "done": done, "total": total}
+            with self.lock:
+                self.events.append(event)
+
+        return callback
+
+    def to_json(self) -> dict:
+        return {"pid": os.getpid(), "argv": sys.argv, "stages": self.records, "progress": self.events}
+
+    def to_trace(self) -> dict:
+        """Chrome trace events: a complete event per stage and counters for the memory and the kernel progress"""
+        pid = os.getpid()
+        us = 1e6
+        events = []
+        for r in self.records:
+            args = {k: r[k] for k in ("cpu_s", "peak_rss_mb", "peak_rss_growth_mb", "rss_start_mb", "rss_end_mb")}
+            args["cpu/wall"] = r["cpu_s"] / r["wall_s"] if r["wall_s"] else None
+            args["output_mb"] = sum(o["nbytes"] or 0 for o in r["outputs"]) / 2**20
+            args.update({k: str(v) for k, v in r["info"].items()})
+            events.append(
+                {
+                    "name": r["name"],
+                    "cat": "stage",
+                    "ph": "X",
+                    "ts": r["start"] * us,
+                    "dur": r["wall_s"] * us,
+                    "pid": pid,
+                    "tid": r["thread"],
+                    "args": args,
+                }
+            )
+            for ts, rss in ((r["start"], r["rss_start_mb"]), (r["start"] + r["wall_s"], r["rss_end_mb"])):
+                if rss is not None:
+                    events.append({"name": "rss_mb", "ph": "C", "ts": ts * us, "pid": pid, "args": {"rss_mb": rss}})
+        for e in self.events:
+            events.append(
+                {
+                    "name": e["name"],
+                    "cat": "progress",
+                    "ph": "C",
+                    "ts": e["t"] * us,
+                    "pid": pid,
+                    "args": {"done": e["done"] / e["total"] if e["total"] else 1.0},
+                }
+            )
+        return {"traceEvents": sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}
+
+    def save(self, path: Union[str, Path]):
+        """Saves the records as Chrome trace if the path ends with `.trace.json`, else as JSON"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            data = self.to_trace() if path.name.endswith(".trace.json") else self.to_json()
+        path.write_text(json.dumps(data, indent=1, default=str))
+        print(f"Saved profile to {path}")
+
+    def summary(self) -> Table:
+        """Table of the stages in order of their start"""
+        table = Table("stage", "wall (s)", "cpu (s)", "cpu/wall", "peak RSS (MB)", "+peak (MB)", "outputs (MB)")
+        for r in sorted(self.records, key=lambda r: r["start"]):
+            table.add_row(
+                "  " * r["depth"] + r["name"],
+                f"{r['wall_s']:.3f}",
+                f"{r['cpu_s']:.3f}",
+                f"{r['cpu_s'] / r['wall_s']:.2f}" if r["wall_s"] else "-",
+                f"{r['peak_rss_mb']:.0f}",
+                f"{r['peak_rss_growth_mb']:.0f}",
+                f"{sum(o['nbytes'] or 0 for o in r['outputs']) / 2**20:.1f}",
+            )
+        return table
+
+
+PROFILER: Profiler = None
+
+
+def enable() -> Profiler:
+    """Starts profiling into a new profiler, which is returned"""
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+def disable() -> Profiler:
+    """Stops profiling and returns the profiler with the records"""
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    return profiler
+
+
+def stage(name: str, **info):
+    """Context manager which profiles a stage, yields a `Stage` (or a no-op stand-in when disabled).
+
+    Args:
+        name (str): Name of the stage, nested stages are recorded with the path of their parents
+        **info: Further info to record, e.g. parameters of the stage
+
+    Example:
+        with stage("adjacency", rr=rr) as s:
+            a = s.output(adjacency_matrix(m, rr))
+    """
+    if PROFILER is None:
+        return NULL_CONTEXT
+    return PROFILER.stage(name, **info)
+
+
+def current_path() -> str:
+    """Path of the innermost stage in the calling thread, None when disabled or outside of any stage"""
+    if PROFILER is None:
+        return None
+    return PROFILER.current_path()
+
+
+def progress(name: str, parent: str = None):
+    """Progress callback of a kernel, None when disabled (so the kernels skip the calls)
+
+    Args:
+        name (str): Name of the kernel
+        parent (str, optional): Path of the stage which runs the kernel, captured with `current_path` in the thread
+            which started it. Defaults to None (recorded at the top level).
+    """
+    if PROFILER is None:
+        return None
+    return PROFILER.progress(name, parent)
+
+
+@contextmanager
+def profile(path: Union[str, Path] = None, summary=True):
+    """Profiles the enclosed code and saves the records to path (see `Profiler.save`). The profiler which was
+    active before (e.g. of CCN_PROFILE) is restored afterwards.
+
+    Args:
+        path (str | Path, optional): Path of the `.json` or `.trace.json` file. Defaults to None (not saved).
+        summary (bool, optional): Print a table of the stages at the end. Defaults to True.
+    """
+    global PROFILER
+    previous, profiler = PROFILER, Profiler()
+    PROFILER = profiler
+    try:
+        yield profiler
+    finally:
+        PROFILER = previous
+        if summary:
+            Console().print(profiler.summary())
+        if path is not None:
+            profiler.save(path)
+
+
+def profile_from_env():
+    """Enables profiling if CCN_PROFILE is set and saves the records to its path at exit"""
+    path = os.environ.get(ENV_VAR)
+    if not path:
+        return
+    profiler = enable()
+    atexit.register(profiler.save, path)
+
+
+profile_from_env()
@@ -1,10 +1,39 @@
 import numpy as np
 import numpy.typing as npt
-from typing import Optional
+from typing import Callable, Literal, Optional, Tuple, Union, overload
+
+FloatArray = Union[npt.NDArray[np.float32], npt.NDArray[np.float64]]
+# Called as progress(done, total)
+Progress = Callable[[int, int], None]
 
 def mind(
-    x: npt.NDArray[np.float32], y: Optional[npt.NDArray[np.float32]], bins: int = 64
+    x: FloatArray,
+    y: Optional[FloatArray],
+    bins: int = 64,
+    xrange: Optional[Tuple[float, float]] = None,
+    yrange: Optional[Tuple[float, float]] = None,
+    out: Optional[npt.NDArray[np.float32]] = None,
+    progress: Optional[Progress] = None,
 ) -> npt.NDArray[np.float32]: ...
+@overload
 def lapend(
-    x: npt.NDArray[np.float32], tau_min: int, tau_max: int, y: Optional[npt.NDArray[np.float32]]
+    x: FloatArray,
+    tau_min: int,
+    tau_max: int,
+    y: Optional[FloatArray] = None,
+    return_lag: Literal[False] = False,
+    out: Optional[npt.NDArray[np.float32]] = None,
+    out_lag: Optional[npt.NDArray[np.int32]] = None,
+    progress: Optional[Progress] = None,
 ) -> npt.NDArray[np.float32]: ...
+@overload
+def lapend(
+    x: FloatArray,
+    tau_min: int,
+    tau_max: int,
+    y: Optional[FloatArray] = None,
+    return_lag: Literal[True] = ...,
+    out: Optional[npt.NDArray[np.float32]] = None,
+    out_lag: Optional[npt.NDArray[np.int32]] = None,
+    progress: Optional[Progress] = None,
+) -> Tuple[npt.NDArray[np.float32], npt.NDArray[np.int32]]: ...
@@ -7,9 +7,10 @@ import matplotlib.colors as colors
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
 from pathlib import Path
 
-from chaotic_carbon_networks.hex import filledgrid_from_hexgrid, axis_is_hex, h3_to_geom
+from chaotic_carbon_networks.hex import filledgrid_from_hexgrid, axis_is_hex, hex_boundaries
 
 crs_epsg = ccrs.PlateCarree(central_longitude=0)
 
@@ -20,11 +21,11 @@ CKWARGS = dict(
 )
 
 
-def plot_world(da: xr.DataArray):
+def plot_world(da: xr.DataArray, raster=False):
     if axis_is_hex(da, "vertex"):
         # Generate a figure with two axes, one for CartoPy, one for GeoPandas
         fig, ax = plt.subplots(1, 1, subplot_kw={"projection": crs_epsg})
-        plot_world_to_axis(da, ax)
+        plot_world_to_axis(da, ax, raster=raster)
         return
 
     assert "lat" in da.dims, "lat must be in da.dims"
@@ -36,24 +37,36 @@ def plot_world(da: xr.DataArray):
     plt.gca().gridlines(draw_labels=True)
 
 
-def plot_world_to_axis(da: xr.DataArray, ax, cmap="viridis", nocbar=False, vmin=None, vmax=None):
+def plot_world_to_axis(
+    da: xr.DataArray, ax, cmap="viridis", nocbar=False, vmin=None, vmax=None, raster=False, res=0.5
+):
+    """Plots a world map of da to a cartopy axis.
+
+    Hexgrids are drawn as one PolyCollection of the cached hex boundaries, or with `raster=True` as an image of the
+    cached hex raster of resolution `res`, which is much faster for many or small hexes.
+    """
     if axis_is_hex(da, "vertex"):
         cmap = cm.get_cmap(cmap)
         norm = colors.Normalize(vmin=vmin or da.quantile(0.02), vmax=vmax or da.quantile(0.98))
-        rgba = cmap(norm(da.values.tolist()))
-        geoms = [h3_to_geom(h) for h in da.vertex]
-        c = {g: colors.rgb2hex(c) for g, c in zip(geoms, rgba)}
-
-        def styler(geometry):
-            return {"facecolor": c[geometry]}
-
-        ax.add_geometries(geoms, crs=crs_epsg, styler=styler, linewidth=0)
+        if raster:
+            g = filledgrid_from_hexgrid(da, res=res)
+            ax.imshow(
+                g.values,
+                cmap=cmap,
+                norm=norm,
+                origin="lower",
+                extent=[-180, 180, -90, 90],
+                transform=crs_epsg,
+                interpolation="nearest",
+            )
+        else:
+            polys = hex_boundaries(da.vertex.values, da.vertex.attrs["hex_res"])
+            c = PolyCollection(polys, array=da.values, cmap=cmap, norm=norm, linewidth=0, transform=crs_epsg)
+            ax.add_collection(c)
         ax.add_feature(cfeature.COASTLINE, linewidth=1)
         ax.add_feature(cfeature.BORDERS, linewidth=1)
         ax.gridlines(draw_labels=True)
         ax.set_extent([-180, 180, -83, 83])
-        # For some unknown reason, set_extent will reorder the association between geometries and colors
-        # Note: now it works because I use the styler function
         title = None
         if "long_name" in da.attrs:
             title = da.long_name
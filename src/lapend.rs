@@ -1,158 +1,214 @@
-use std::usize;
-
 use ndarray::Zip;
-use ndarray::{s, Array2, ArrayView2};
+use ndarray::{s, Array2, ArrayView2, ArrayViewMut2, Axis};
 use rayon::prelude::*;
 
-// TODO: Use this: https://docs.rs/ndarray/latest/ndarray/parallel/index.html
-
-pub fn lapend_single(x: ArrayView2<'_, f32>, tau_min: isize, tau_max: isize) -> Array2<f32> {
-    // Expect the shape of x to be (time [t], vertex[v])
-    assert_eq!(x.ndim(), 2, "x must have 2 dimensions");
+// Number of x-vertices per parallel block, a block of the correlation matrix is calculated as one matrix product
+const BLOCK_SIZE: usize = 64;
+
+/// Standardizes every column (vertex) of x to zero mean and unit variance.
+/// Columns without variance (or with NaNs) are set to 0, so that they never correlate.
+fn standardize(x: ArrayView2<'_, f32>) -> Array2<f32> {
+    let nt = x.shape()[0] as f32;
+    let mut xs = x.to_owned();
+    for mut col in xs.axis_iter_mut(Axis(1)) {
+        let mean = col.sum() / nt;
+        col.mapv_inplace(|v| v - mean);
+        let std = (col.fold(0., |acc, v| acc + v * v) / nt).sqrt();
+        if std > 0. {
+            col.mapv_inplace(|v| v / std);
+        } else {
+            col.fill(0.);
+        }
+    }
+    xs
+}
 
+/// Calculates the maximum absolute correlation between x[t, i] and y[t + tau, j] over all tau in tau_min..tau_max
+/// and the tau at which the maximum is reached, written into rho and lag of shape (vertex[vx], vertex[vy]).
+/// Without lag only the correlation is calculated.
+///
+/// For every tau the lagged slices of x and y are standardized once, then the correlations of all pairs are the
+/// matrix product xs^T ys / nt, which is calculated in parallel blocks of x-vertices.
+/// progress is called once per finished tau.
+fn lapend_gemm_into(
+    x: ArrayView2<'_, f32>,
+    y: ArrayView2<'_, f32>,
+    tau_min: isize,
+    tau_max: isize,
+    mut rho: ArrayViewMut2<'_, f32>,
+    mut lag: Option<ArrayViewMut2<'_, i32>>,
+    progress: &(dyn Fn(usize) + Sync),
+) {
     let t = x.shape()[0] as isize;
-    let v = x.shape()[1];
+    let vx = x.shape()[1];
+    let vy = y.shape()[1];
+    assert_eq!(rho.shape(), &[vx, vy], "out must have the shape (vx, vy)");
+    rho.fill(0.);
+    if let Some(lag) = lag.as_mut() {
+        assert_eq!(lag.shape(), &[vx, vy], "out_lag must have the shape (vx, vy)");
+        lag.fill(0);
+    }
+    let n_blocks = (vx + BLOCK_SIZE - 1) / BLOCK_SIZE;
+
+    for tau in tau_min..tau_max {
+        let nt = (t - tau) as f32;
+
+        // Shift y by tau and clip x
+        let xs = standardize(x.slice(s![..-tau, ..]));
+        let ys = standardize(y.slice(s![tau.., ..]));
+
+        // The blocks of the lag matrix, if any, matching the blocks of rho
+        let mut lag_blocks: Vec<Option<ArrayViewMut2<'_, i32>>> = match lag.as_mut() {
+            Some(lag) => lag.axis_chunks_iter_mut(Axis(0), BLOCK_SIZE).map(Some).collect(),
+            None => (0..n_blocks).map(|_| None).collect(),
+        };
+
+        rho.axis_chunks_iter_mut(Axis(0), BLOCK_SIZE)
+            .into_par_iter()
+            .zip(lag_blocks.par_iter_mut())
+            .enumerate()
+            .for_each(|(b, (mut rho_b, lag_b))| {
+                let start = b * BLOCK_SIZE;
+                let end = start + rho_b.shape()[0];
+                let corr = xs.slice(s![.., start..end]).t().dot(&ys) / nt;
+
+                match lag_b {
+                    Some(lag_b) => Zip::from(&mut rho_b)
+                        .and(lag_b)
+                        .and(&corr)
+                        .for_each(|r, l, &c| {
+                            let c = c.abs();
+                            if c > *r {
+                                *r = c;
+                                *l = tau as i32;
+                            }
+                        }),
+                    None => Zip::from(&mut rho_b).and(&corr).for_each(|r, &c| {
+                        let c = c.abs();
+                        if c > *r {
+                            *r = c;
+                        }
+                    }),
+                }
+            });
+        progress(1);
+    }
+}
 
-    let taud = (tau_max - tau_min) as usize;
+fn check_lags(t: isize, tau_min: isize, tau_max: isize) {
     assert!(tau_min > 0, "tau_min must be larger than 0");
     assert!(tau_max > tau_min, "tau_max must be larger than tau_min");
     assert!(t > (tau_max + 2), "tau_max + 2 must be smaller than t");
-
-    // Precalc std and means for every ttau
-
-    let mut meanx = Array2::zeros((v, taud));
-    let mut stdx = Array2::zeros((v, taud));
-
-    // Shift y by tau and clip x
-    for (ti, tau) in (tau_min..tau_max).enumerate() {
-        let nt = t - tau;
-
-        for i in 0..v {
-            let xtau = x.slice(s![..-tau, i]);
-            let mx = xtau.mean().unwrap();
-            meanx[[i, ti]] = mx;
-            stdx[[i, ti]] = (xtau.mapv(|x| (x - mx).powi(2)).sum() / nt as f32).sqrt();
-        }
-    }
-
-    let mut rho = Array2::zeros((v, v));
-
-    rho.indexed_iter_mut()
-        .par_bridge()
-        .for_each(|((i, j), val)| {
-            let mut max_rhot = 0.;
-            for (ti, tau) in (tau_min..tau_max).enumerate() {
-                let nt = t - tau;
-
-                let meanxti = meanx[[i, ti]];
-                let meanyti = meanx[[j, ti]];
-
-                let xti = x.slice(s![..-(tau), i]);
-                let yti = x.slice(s![tau.., j]);
-                let cov = Zip::from(xti)
-                    .and(yti)
-                    .fold(0., |acc, a, b| acc + (a - meanxti) * (b - meanyti))
-                    / nt as f32;
-
-                let corr = (cov / (stdx[[i, ti]] * stdx[[j, ti]])).abs();
-                if corr > max_rhot {
-                    max_rhot = corr;
-                }
-            }
-            *val = max_rhot;
-        });
-
-    rho
 }
 
-pub fn lapend_double(
+/// Calculates the Lagged Pearson Correlation between all vertices of x and y and writes the maximum absolute
+/// correlation and (if given) its lag into rho and lag, which may be any strided views (e.g. blocks of larger matrices).
+/// progress is called with the number of finished lags.
+pub fn lapend_double_into(
     x: ArrayView2<'_, f32>,
     y: ArrayView2<'_, f32>,
     tau_min: isize,
     tau_max: isize,
-) -> Array2<f32> {
+    rho: ArrayViewMut2<'_, f32>,
+    lag: Option<ArrayViewMut2<'_, i32>>,
+    progress: &(dyn Fn(usize) + Sync),
+) {
     // Expect the shape of x and y to be (time [t], vertex[v])
     assert_eq!(x.ndim(), 2, "x must have 2 dimensions");
     assert_eq!(y.ndim(), 2, "y must have 2 dimensions");
 
     let t = x.shape()[0] as isize;
     let ty = y.shape()[0] as isize;
-    let vx = x.shape()[1];
-    let vy = y.shape()[1];
     assert_eq!(t, ty, "x and y must have same t-dimension");
+    check_lags(t, tau_min, tau_max);
 
-    let taud = (tau_max - tau_min) as usize;
-    assert!(tau_min > 0, "tau_min must be larger than 0");
-    assert!(tau_max > tau_min, "tau_max must be larger than tau_min");
-    assert!(t > (tau_max + 2), "tau_max + 2 must be smaller than t");
-
-    // Precalc std and means for every ttau
+    lapend_gemm_into(x, y, tau_min, tau_max, rho, lag, progress)
+}
 
-    let mut meanx = Array2::zeros((vx, taud));
-    let mut meany = Array2::zeros((vy, taud));
-    let mut stdx = Array2::zeros((vx, taud));
-    let mut stdy = Array2::zeros((vy, taud));
+#[cfg(test)]
+mod tests {
+    use ndarray::{Array2, ArrayView2};
+    use std::sync::atomic::{AtomicUsize, Ordering};
+
+    use super::lapend_double_into;
+
+    fn lapend_double(
+        x: ArrayView2<'_, f32>,
+        y: ArrayView2<'_, f32>,
+        tau_min: isize,
+        tau_max: isize,
+    ) -> (Array2<f32>, Array2<i32>) {
+        let mut rho = Array2::<f32>::zeros((x.shape()[1], y.shape()[1]));
+        let mut lag = Array2::<i32>::zeros(rho.raw_dim());
+        lapend_double_into(x, y, tau_min, tau_max, rho.view_mut(), Some(lag.view_mut()), &|_| {});
+        (rho, lag)
+    }
 
-    // Shift y by tau and clip x
-    for (ti, tau) in (tau_min..tau_max).enumerate() {
-        let nt = t - tau;
+    #[test]
+    fn it_works() {
+        let x = Array2::zeros((48, 20)) + 1.;
+        let y = Array2::zeros((48, 20)) + 1.;
+        let (z, lag) = lapend_double(x.view(), y.view(), 2, 20);
+        println!("{:?} {:?}", z.sum(), lag.sum());
+    }
 
-        for i in 0..vx {
-            let xtau = x.slice(s![..-tau, i]);
-            let mx = xtau.mean().unwrap();
-            meanx[[i, ti]] = mx;
-            stdx[[i, ti]] = (xtau.mapv(|x| (x - mx).powi(2)).sum() / nt as f32).sqrt();
+    #[test]
+    fn finds_lag() {
+        // y is x shifted by 5 time steps
+        let x = Array2::from_shape_fn((100, 3), |(t, v)| ((t * (v + 1)) as f32 * 0.37).sin());
+        let y = Array2::from_shape_fn((100, 3), |(t, v)| {
+            let t = t.max(5) - 5;
+            ((t * (v + 1)) as f32 * 0.37).sin()
+        });
+        let (z, lag) = lapend_double(x.view(), y.view(), 1, 10);
+        for i in 0..3 {
+            assert!(z[[i, i]] > 0.99);
+            assert_eq!(lag[[i, i]], 5);
         }
+    }
 
-        for j in 0..vy {
-            let ytau = y.slice(s![tau.., j]);
-            let my = ytau.mean().unwrap();
-            meany[[j, ti]] = my;
-            stdy[[j, ti]] = (ytau.mapv(|y| (y - my).powi(2)).sum() / nt as f32).sqrt();
+    #[test]
+    fn writes_into_strided_block() {
+        let x = Array2::from_shape_fn((100, 5), |(t, v)| ((t * (v + 1)) as f32 * 0.29).sin());
+        let (z, lag) = lapend_double(x.view(), x.view(), 1, 10);
+        // Write into blocks of larger buffers, transposed, i.e. with strides in both axes
+        let mut zbuf = Array2::<f32>::zeros((7, 7));
+        let mut lbuf = Array2::<i32>::zeros((7, 7));
+        lapend_double_into(
+            x.view(),
+            x.view(),
+            1,
+            10,
+            zbuf.slice_mut(ndarray::s![1..6, 2..7]).reversed_axes(),
+            Some(lbuf.slice_mut(ndarray::s![1..6, 2..7]).reversed_axes()),
+            &|_| {},
+        );
+        for i in 0..5 {
+            for j in 0..5 {
+                assert_eq!(zbuf[[1 + j, 2 + i]], z[[i, j]]);
+                assert_eq!(lbuf[[1 + j, 2 + i]], lag[[i, j]]);
+            }
         }
     }
 
-    let mut rho = Array2::zeros((vx, vy));
-
-    rho.indexed_iter_mut()
-        .par_bridge()
-        .for_each(|((i, j), val)| {
-            let mut max_rhot = 0.;
-            for (ti, tau) in (tau_min..tau_max).enumerate() {
-                let nt = t - tau;
-
-                let meanxti = meanx[[i, ti]];
-                let meanyti = meany[[j, ti]];
-
-                let xti = x.slice(s![..-(tau), i]);
-                let yti = y.slice(s![tau.., j]);
-                let cov = Zip::from(xti)
-                    .and(yti)
-                    .fold(0., |acc, a, b| acc + (a - meanxti) * (b - meanyti))
-                    / nt as f32;
-
-                let corr = (cov / (stdx[[i, ti]] * stdy[[j, ti]])).abs();
-                if corr > max_rhot {
-                    max_rhot = corr;
-                }
-            }
-            *val = max_rhot;
+    #[test]
+    fn reports_progress_per_lag() {
+        let x = Array2::from_shape_fn((60, 4), |(t, v)| ((t * (v + 1)) as f32 * 0.21).sin());
+        let mut rho = Array2::<f32>::zeros((4, 4));
+        let mut lag = Array2::<i32>::zeros((4, 4));
+        let done = AtomicUsize::new(0);
+        lapend_double_into(x.view(), x.view(), 2, 9, rho.view_mut(), Some(lag.view_mut()), &|n| {
+            done.fetch_add(n, Ordering::Relaxed);
         });
-
-    rho
-}
-
-#[cfg(test)]
-mod tests {
-    use ndarray::Array2;
-
-    use super::lapend_double;
+        assert_eq!(done.into_inner(), 7);
+    }
 
     #[test]
-    fn it_works() {
-        let x = Array2::zeros((48, 20)) + 1.;
-        let y = Array2::zeros((48, 20)) + 1.;
-        let z = lapend_double(x.view(), y.view(), 2, 20);
-        println!("{:?}", z.sum());
+    fn lag_is_optional() {
+        let x = Array2::from_shape_fn((80, 70), |(t, v)| ((t * (v + 1)) as f32 * 0.23).sin());
+        let (z, _) = lapend_double(x.view(), x.view(), 1, 8);
+        let mut rho = Array2::<f32>::zeros((70, 70));
+        lapend_double_into(x.view(), x.view(), 1, 8, rho.view_mut(), None, &|_| {});
+        assert_eq!(rho, z);
     }
 }
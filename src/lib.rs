@@ -1,46 +1,175 @@
-use numpy::{IntoPyArray, PyArray2, PyReadonlyArray2};
+use numpy::ndarray::{ArrayView2, CowArray, Ix2};
+use numpy::{Element, PyArray2, PyReadonlyArray2};
 use pyo3::prelude::*;
+use std::sync::atomic::{AtomicUsize, Ordering};
 
 mod lapend;
 mod mind;
 
+/// A float32 or float64 array of any strides, float64 is converted to float32 for the calculation
+#[derive(FromPyObject)]
+enum PyArrayF<'py> {
+    F32(PyReadonlyArray2<'py, f32>),
+    F64(PyReadonlyArray2<'py, f64>),
+}
+
+/// The view of a `PyArrayF`, which (unlike the Python object) can be sent to the threads without the GIL
+enum ArrayF<'a> {
+    F32(ArrayView2<'a, f32>),
+    F64(ArrayView2<'a, f64>),
+}
+
+impl<'py> PyArrayF<'py> {
+    fn view(&self) -> ArrayF<'_> {
+        match self {
+            PyArrayF::F32(a) => ArrayF::F32(a.as_array()),
+            PyArrayF::F64(a) => ArrayF::F64(a.as_array()),
+        }
+    }
+}
+
+impl<'a> ArrayF<'a> {
+    fn as_f32(&self) -> CowArray<'a, f32, Ix2> {
+        match self {
+            ArrayF::F32(a) => CowArray::from(a.clone()),
+            ArrayF::F64(a) => CowArray::from(a.mapv(|v| v as f32)),
+        }
+    }
+
+    fn shape(&self) -> &[usize] {
+        match self {
+            ArrayF::F32(a) => a.shape(),
+            ArrayF::F64(a) => a.shape(),
+        }
+    }
+}
+
+/// Returns the output buffer or a new one of the given shape
+fn output<'py, T: Element>(py: Python<'py>, out: Option<&'py PyArray2<T>>, shape: (usize, usize)) -> &'py PyArray2<T> {
+    out.unwrap_or_else(|| PyArray2::zeros(py, shape, false))
+}
+
+/// Reports the progress of a kernel as `callback(done, total)` to Python, at most about 100 times per call.
+/// The kernels call `add` from the threads without the GIL, which is only acquired for the callback.
+struct Progress {
+    callback: Option<PyObject>,
+    total: usize,
+    step: usize,
+    done: AtomicUsize,
+}
+
+impl Progress {
+    fn new(callback: Option<PyObject>, total: usize) -> Self {
+        Progress {
+            callback,
+            total,
+            step: (total / 100).max(1),
+            done: AtomicUsize::new(0),
+        }
+    }
+
+    fn add(&self, n: usize) {
+        let Some(callback) = &self.callback else {
+            return;
+        };
+        let before = self.done.fetch_add(n, Ordering::Relaxed);
+        let done = before + n;
+        if done / self.step != before / self.step || done == self.total {
+            Python::with_gil(|py| {
+                if let Err(e) = callback.call1(py, (done, self.total)) {
+                    e.print(py);
+                }
+            });
+        }
+    }
+}
+
 /// A Python module implemented in Rust.
 #[pymodule]
 #[pyo3(name = "rust_chaotic_carbon_networks")]
 fn chaotic_carbon_networks(_py: Python, m: &PyModule) -> PyResult<()> {
     /// Calculates the Mutual Information between every v in x of dimensions [v, t]. If a y is provided calculates the Mutual Information between every vx and vy of x [vx, t] and y [vy, t].
-    #[pyfn(m, signature = (x, y, bins = 64))]
+    /// The value ranges used for binning default to the ranges of x and y, pass xrange and yrange to bin blocks of vertices like the full data.
+    /// x and y may be float32 or float64 with any strides. The GIL is released during the calculation.
+    /// If out is given, the matrix is written into it (e.g. a block of a larger or memory-mapped float32 matrix) and out is returned.
+    /// If progress is given, it is called as progress(done, total) with the number of finished rows of the matrix.
+    #[pyfn(m, signature = (x, y, bins = 64, xrange = None, yrange = None, out = None, progress = None))]
     #[pyo3(name = "mind")]
     fn mind_py<'py>(
         py: Python<'py>,
-        x: PyReadonlyArray2<'py, f32>,
-        y: Option<PyReadonlyArray2<'py, f32>>,
+        x: PyArrayF<'py>,
+        y: Option<PyArrayF<'py>>,
         bins: usize,
-    ) -> &'py PyArray2<f32> {
-        let x = x.as_array();
-        let z = match y {
-            Some(y_arr) => mind::mind_double(x, y_arr.as_array(), bins),
-            None => mind::mind_single(x, bins),
-        };
-        z.into_pyarray(py)
+        xrange: Option<(f32, f32)>,
+        yrange: Option<(f32, f32)>,
+        out: Option<&'py PyArray2<f32>>,
+        progress: Option<PyObject>,
+    ) -> PyResult<&'py PyArray2<f32>> {
+        let x = x.view();
+        let y = y.as_ref().map(|y| y.view());
+        let vx = x.shape()[1];
+        let vy = y.as_ref().map_or(vx, |y| y.shape()[1]);
+
+        let out = output(py, out, (vx, vy));
+        let mut out_rw = out.try_readwrite()?;
+        let out_view = out_rw.as_array_mut();
+        let progress = Progress::new(progress, vx);
+        let tick = |n| progress.add(n);
+        py.allow_threads(|| match y {
+            Some(y) => mind::mind_double_into(x.as_f32().view(), y.as_f32().view(), bins, xrange, yrange, out_view, &tick),
+            None => mind::mind_single_into(x.as_f32().view(), bins, xrange, out_view, &tick),
+        });
+        Ok(out)
     }
 
     /// Calculates the Lagged Pearson Correlation Coefficient between every  v in x of dimensions [v, t]. If a y is provided calculates the Lagged Pearson Correlation Coefficient between every vx and vy of x [vx, t] and y [vy, t].
-    #[pyfn(m)]
+    /// If return_lag is true, additionally returns the lag at which the maximum correlation is reached.
+    /// x and y may be float32 or float64 with any strides. The GIL is released during the calculation.
+    /// If out (and out_lag) are given, the matrices are written into them (e.g. blocks of larger or memory-mapped matrices) and returned.
+    /// The lag matrix is only calculated if return_lag is true or out_lag is given.
+    /// If progress is given, it is called as progress(done, total) with the number of finished lags.
+    #[pyfn(m, signature = (x, tau_min, tau_max, y = None, return_lag = false, out = None, out_lag = None, progress = None))]
     #[pyo3(name = "lapend")]
     fn lapend_py<'py>(
         py: Python<'py>,
-        x: PyReadonlyArray2<'py, f32>,
+        x: PyArrayF<'py>,
         tau_min: isize,
         tau_max: isize,
-        y: Option<PyReadonlyArray2<'py, f32>>,
-    ) -> &'py PyArray2<f32> {
-        let x = x.as_array();
-        let z = match y {
-            Some(y_arr) => lapend::lapend_double(x, y_arr.as_array(), tau_min, tau_max),
-            None => lapend::lapend_single(x, tau_min, tau_max),
+        y: Option<PyArrayF<'py>>,
+        return_lag: bool,
+        out: Option<&'py PyArray2<f32>>,
+        out_lag: Option<&'py PyArray2<i32>>,
+        progress: Option<PyObject>,
+    ) -> PyResult<PyObject> {
+        let x = x.view();
+        let y = y.as_ref().map(|y| y.view());
+        let vx = x.shape()[1];
+        let vy = y.as_ref().map_or(vx, |y| y.shape()[1]);
+
+        let out = output(py, out, (vx, vy));
+        // The lag matrix is only allocated and written if it is returned (or a buffer for it is given)
+        let out_lag = if return_lag || out_lag.is_some() {
+            Some(output(py, out_lag, (vx, vy)))
+        } else {
+            None
         };
-        z.into_pyarray(py)
+        let mut out_rw = out.try_readwrite()?;
+        let mut out_lag_rw = out_lag.map(|a| a.try_readwrite()).transpose()?;
+        let out_view = out_rw.as_array_mut();
+        let out_lag_view = out_lag_rw.as_mut().map(|a| a.as_array_mut());
+        let progress = Progress::new(progress, (tau_max - tau_min).max(0) as usize);
+        let tick = |n| progress.add(n);
+        py.allow_threads(|| {
+            let x = x.as_f32();
+            match y {
+                Some(y) => lapend::lapend_double_into(x.view(), y.as_f32().view(), tau_min, tau_max, out_view, out_lag_view, &tick),
+                None => lapend::lapend_double_into(x.view(), x.view(), tau_min, tau_max, out_view, out_lag_view, &tick),
+            }
+        });
+        match out_lag {
+            Some(out_lag) if return_lag => Ok((out, out_lag).into_py(py)),
+            _ => Ok(out.into_py(py)),
+        }
     }
 
     Ok(())
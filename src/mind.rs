@@ -1,114 +1,141 @@
-use numpy::ndarray::{s, Array1, Array2, ArrayView1, ArrayView2, Axis};
+use numpy::ndarray::{Array2, ArrayView2, ArrayViewMut2, Axis};
 use rayon::prelude::*;
 
-// results in a 2dhist size of 128 * 128 * 32 / 8 Bytes ~ 64kB
-const MAX_BIN_SIZE: usize = 128;
+// Codes are stored as u8, the joint histogram has only bins * bins entries
+const MAX_BIN_SIZE: usize = 256;
 
-fn h1nd(x_idx: ArrayView2<'_, usize>, bins: usize) -> Array1<f32> {
-    let t = x_idx.shape()[0];
-    let _v = x_idx.shape()[1];
-
-    let hd = x_idx.map_axis(Axis(0), |xv_idx| {
-        // Create a vector to store the histogram
-        let mut hist = [0.; MAX_BIN_SIZE];
-
-        // Calculate the histogram of x
-        let p = 1. / t as f32;
-        for &idx in xv_idx {
-            hist[idx] += p;
-        }
+fn value_range(x: ArrayView2<'_, f32>) -> (f32, f32) {
+    let xmin = x.iter().fold(f32::MAX, |a, &b| a.min(b));
+    let xmax = x.iter().fold(f32::MIN, |a, &b| a.max(b));
+    (xmin, xmax)
+}
 
-        // Calculate the normalized entropy
-        let mut h = 0.;
-        for i in 0..bins {
-            let x = hist[i];
-            if x > 0. {
-                h -= x * x.ln();
-            }
-        }
-        h
-    });
+/// Quantizes x of shape (time [t], vertex[v]) into bins codes of shape (vertex[v], time [t]),
+/// so that the codes of every vertex are contiguous.
+fn quantize(x: ArrayView2<'_, f32>, bins: usize, (xmin, xmax): (f32, f32)) -> Array2<u8> {
+    let t = x.shape()[0];
+    let v = x.shape()[1];
+    let deltax = bins as f32 / (xmax - xmin);
 
-    hd
+    Array2::from_shape_fn((v, t), |(i, k)| {
+        let idx = ((x[[k, i]] - xmin) * deltax) as usize;
+        idx.min(bins - 1) as u8
+    })
 }
 
-fn h21d(x_idx: ArrayView1<'_, usize>, y_idx: ArrayView1<'_, usize>, bins: usize) -> f32 {
-    let t = x_idx.shape()[0];
+/// Lookup table of n * ln(n) for every count n in 0..=t
+fn nlogn_table(t: usize) -> Vec<f64> {
+    (0..=t)
+        .map(|n| if n > 0 { n as f64 * (n as f64).ln() } else { 0. })
+        .collect()
+}
 
-    // Calculate the joint entropy of x and y
-    let mut flat_hist = [0.; MAX_BIN_SIZE * MAX_BIN_SIZE];
+/// Sum of n * ln(n) over the histogram of the codes of every vertex.
+/// The entropy of a vertex is ln(t) - sum / t.
+fn nlogn_sums(codes: &Array2<u8>, bins: usize, nlogn: &[f64]) -> Vec<f64> {
+    codes
+        .outer_iter()
+        .map(|xv_codes| {
+            let mut hist = [0u32; MAX_BIN_SIZE];
+            for &c in xv_codes.iter() {
+                hist[c as usize] += 1;
+            }
+            hist[..bins].iter().map(|&n| nlogn[n as usize]).sum::<f64>()
+        })
+        .collect()
+}
 
-    let p = 1. / t as f32;
-    for i in 0..t {
-        let idx = x_idx[i] * bins + y_idx[i];
-        flat_hist[idx] += p;
+/// Sum of n * ln(n) over the joint histogram of the codes x and y.
+/// Only the touched cells are read and reset, so hist is all zeros again afterwards.
+fn joint_nlogn_sum(x_codes: &[u8], y_codes: &[u8], bins: usize, hist: &mut [u32], nlogn: &[f64]) -> f64 {
+    for (&a, &b) in x_codes.iter().zip(y_codes) {
+        hist[a as usize * bins + b as usize] += 1;
     }
 
-    // Calculate the normalized entropy
-    let mut h = 0.;
-    for i in 0..bins * bins {
-        let x = flat_hist[i];
-        if x > 0. {
-            h -= x * x.ln();
+    let mut s = 0.;
+    for (&a, &b) in x_codes.iter().zip(y_codes) {
+        let idx = a as usize * bins + b as usize;
+        let n = hist[idx];
+        if n > 0 {
+            s += nlogn[n as usize];
+            hist[idx] = 0;
         }
     }
-    h
+    s
 }
 
-pub fn mind_single(x: ArrayView2<'_, f32>, bins: usize) -> Array2<f32> {
+/// Calculates the Mutual Information between all vertices of x and writes it into out of shape (vertex[v], vertex[v]),
+/// which may be any strided view (e.g. a block of a larger matrix). progress is called with the number of finished rows.
+pub fn mind_single_into(
+    x: ArrayView2<'_, f32>,
+    bins: usize,
+    xrange: Option<(f32, f32)>,
+    mut out: ArrayViewMut2<'_, f32>,
+    progress: &(dyn Fn(usize) + Sync),
+) {
     // Expect the shape of x and y to be (time [t], vertex[v])
     assert_eq!(x.ndim(), 2, "x must have 2 dimensions");
-    // Expect bins to be less or equal to 64
+    // Expect bins to fit into the u8 codes
     assert!(
         bins <= MAX_BIN_SIZE,
         "bins must be less or equal to {}",
         MAX_BIN_SIZE
     );
 
-    let _t = x.shape()[0];
+    let t = x.shape()[0];
     let v = x.shape()[1];
+    assert_eq!(out.shape(), &[v, v], "out must have the shape (v, v)");
 
-    // Get range of x and y
-    let xmin = x.iter().fold(f32::MAX, |a, &b| a.min(b));
-    let xmax = x.iter().fold(f32::MIN, |a, &b| a.max(b));
-
-    let deltax = bins as f32 / (xmax - xmin);
-
-    // Precalculate x_idx and y_idx
-    let x_idx = x.mapv(|x| {
-        let mut idx = ((x - xmin) * deltax) as usize;
-        idx = idx.min(bins - 1);
-        idx
-    });
+    // Get range of x, unless it is given (e.g. when x is only a block of the vertices)
+    let xrange = xrange.unwrap_or_else(|| value_range(x));
 
-    // Precalculate h for x
-    let hx = h1nd(x_idx.view(), bins);
+    // Precalculate the codes and the (unnormalized) entropy of every vertex
+    let x_codes = quantize(x, bins, xrange);
+    let nlogn = nlogn_table(t);
+    let sx = nlogn_sums(&x_codes, bins, &nlogn);
+    let ln_t = (t as f64).ln();
 
-    // Precalculate slices
-    //let xslices = (0..v).map(|i| x_idx.slice(s![.., i])).collect::<Vec<_>>();
-    //let yslices = (0..v).map(|i| y_idx.slice(s![.., i])).collect::<Vec<_>>();
-
-    // Calculate hxy with rayon par_iter
-    let hxy = (0..v)
+    // MI is symmetric: every rayon job writes the upper triangle (j >= i) of its rows of out with its own histogram
+    out.axis_iter_mut(Axis(0))
         .into_par_iter()
-        .map(|i| {
-            (0..v)
-                .into_iter()
-                .map(|j| h21d(x_idx.slice(s![.., i]), x_idx.slice(s![.., j]), bins))
-                .collect::<Vec<f32>>()
-        })
-        .collect::<Vec<Vec<f32>>>();
-
-    let mi = Array2::from_shape_fn((v, v), |(i, j)| hx[i] + hx[j] - hxy[i][j]);
-
-    mi
+        .enumerate()
+        .for_each_init(
+            || vec![0u32; bins * bins],
+            |hist, (i, mut row)| {
+                let xi = x_codes.row(i);
+                let xi = xi.as_slice().unwrap();
+                for j in i..v {
+                    let xj = x_codes.row(j);
+                    let sxy = joint_nlogn_sum(xi, xj.as_slice().unwrap(), bins, hist, &nlogn);
+                    row[j] = (ln_t - (sx[i] + sx[j] - sxy) / t as f64) as f32;
+                }
+                progress(1);
+            },
+        );
+
+    // Mirror the upper triangle in place
+    for i in 1..v {
+        for j in 0..i {
+            out[[i, j]] = out[[j, i]];
+        }
+    }
 }
 
-pub fn mind_double(x: ArrayView2<'_, f32>, y: ArrayView2<'_, f32>, bins: usize) -> Array2<f32> {
+/// Calculates the Mutual Information between all vertices of x and y and writes it into out of shape (vertex[vx], vertex[vy]),
+/// which may be any strided view (e.g. a block of a larger matrix). progress is called with the number of finished rows.
+pub fn mind_double_into(
+    x: ArrayView2<'_, f32>,
+    y: ArrayView2<'_, f32>,
+    bins: usize,
+    xrange: Option<(f32, f32)>,
+    yrange: Option<(f32, f32)>,
+    mut out: ArrayViewMut2<'_, f32>,
+    progress: &(dyn Fn(usize) + Sync),
+) {
     // Expect the shape of x and y to be (time [t], vertex[v])
     assert_eq!(x.ndim(), 2, "x must have 2 dimensions");
     assert_eq!(y.ndim(), 2, "y must have 2 dimensions");
-    // Expect bins to be less or equal to 64
+    // Expect bins to fit into the u8 codes
     assert!(
         bins <= MAX_BIN_SIZE,
         "bins must be less or equal to {}",
@@ -120,65 +147,111 @@ pub fn mind_double(x: ArrayView2<'_, f32>, y: ArrayView2<'_, f32>, bins: usize)
     let vx = x.shape()[1];
     let vy = y.shape()[1];
     assert_eq!(tx, ty, "x and y must have same t-dimension");
-
-    // Get range of x and y
-    let xmin = x.iter().fold(f32::MAX, |a, &b| a.min(b));
-    let xmax = x.iter().fold(f32::MIN, |a, &b| a.max(b));
-    let ymin = y.iter().fold(f32::MAX, |a, &b| a.min(b));
-    let ymax = y.iter().fold(f32::MIN, |a, &b| a.max(b));
-
-    let deltax = bins as f32 / (xmax - xmin);
-    let deltay = bins as f32 / (ymax - ymin);
-
-    // Precalculate x_idx and y_idx
-    let x_idx = x.mapv(|x| {
-        let mut idx = ((x - xmin) * deltax) as usize;
-        idx = idx.min(bins - 1);
-        idx
-    });
-
-    let y_idx = y.mapv(|y| {
-        let mut idx = ((y - ymin) * deltay) as usize;
-        idx = idx.min(bins - 1);
-        idx
-    });
-
-    // Precalculate h for x
-    let hx = h1nd(x_idx.view(), bins);
-    // Precalculate h for y
-    let hy = h1nd(y_idx.view(), bins);
-
-    // Precalculate slices
-    //let xslices = (0..v).map(|i| x_idx.slice(s![.., i])).collect::<Vec<_>>();
-    //let yslices = (0..v).map(|i| y_idx.slice(s![.., i])).collect::<Vec<_>>();
-
-    // Calculate hxy with rayon par_iter
-    let hxy = (0..vx)
+    assert_eq!(out.shape(), &[vx, vy], "out must have the shape (vx, vy)");
+
+    // Get range of x and y, unless they are given (e.g. when x or y are only a block of the vertices)
+    let xrange = xrange.unwrap_or_else(|| value_range(x));
+    let yrange = yrange.unwrap_or_else(|| value_range(y));
+
+    // Precalculate the codes and the (unnormalized) entropy of every vertex
+    let x_codes = quantize(x, bins, xrange);
+    let y_codes = quantize(y, bins, yrange);
+    let nlogn = nlogn_table(tx);
+    let sx = nlogn_sums(&x_codes, bins, &nlogn);
+    let sy = nlogn_sums(&y_codes, bins, &nlogn);
+    let ln_t = (tx as f64).ln();
+
+    // Calculate the MI with rayon, every job writes its rows of out with its own histogram
+    out.axis_iter_mut(Axis(0))
         .into_par_iter()
-        .map(|i| {
-            (0..vy)
-                .into_iter()
-                .map(|j| h21d(x_idx.slice(s![.., i]), y_idx.slice(s![.., j]), bins))
-                .collect::<Vec<f32>>()
-        })
-        .collect::<Vec<Vec<f32>>>();
-
-    let mi = Array2::from_shape_fn((vx, vy), |(i, j)| hx[i] + hy[j] - hxy[i][j]);
-
-    mi
+        .enumerate()
+        .for_each_init(
+            || vec![0u32; bins * bins],
+            |hist, (i, mut row)| {
+                let xi = x_codes.row(i);
+                let xi = xi.as_slice().unwrap();
+                for j in 0..vy {
+                    let yj = y_codes.row(j);
+                    let sxy = joint_nlogn_sum(xi, yj.as_slice().unwrap(), bins, hist, &nlogn);
+                    row[j] = (ln_t - (sx[i] + sy[j] - sxy) / tx as f64) as f32;
+                }
+                progress(1);
+            },
+        );
 }
 
 #[cfg(test)]
 mod tests {
-    use ndarray::Array2;
+    use ndarray::{Array2, ArrayView2};
+    use std::sync::atomic::{AtomicUsize, Ordering};
+
+    use super::{mind_double_into, mind_single_into};
+
+    fn mind_single(x: ArrayView2<'_, f32>, bins: usize, xrange: Option<(f32, f32)>) -> Array2<f32> {
+        let v = x.shape()[1];
+        let mut mi = Array2::zeros((v, v));
+        mind_single_into(x, bins, xrange, mi.view_mut(), &|_| {});
+        mi
+    }
 
-    use super::mind_double;
+    fn mind_double(
+        x: ArrayView2<'_, f32>,
+        y: ArrayView2<'_, f32>,
+        bins: usize,
+        xrange: Option<(f32, f32)>,
+        yrange: Option<(f32, f32)>,
+    ) -> Array2<f32> {
+        let mut mi = Array2::zeros((x.shape()[1], y.shape()[1]));
+        mind_double_into(x, y, bins, xrange, yrange, mi.view_mut(), &|_| {});
+        mi
+    }
 
     #[test]
     fn it_works() {
         let x = Array2::zeros((48, 20)) + 1.;
         let y = Array2::zeros((48, 20)) + 1.;
-        let z = mind_double(x.view(), y.view(), 64);
+        let z = mind_double(x.view(), y.view(), 64, None, None);
         println!("{:?}", z.sum());
     }
+
+    #[test]
+    fn single_is_symmetric_double() {
+        let x = Array2::from_shape_fn((200, 10), |(t, v)| ((t * (v + 3)) as f32 * 0.11).sin());
+        let s = mind_single(x.view(), 32, None);
+        let d = mind_double(x.view(), x.view(), 32, None, None);
+        for i in 0..10 {
+            for j in 0..10 {
+                assert!((s[[i, j]] - d[[i, j]]).abs() < 1e-5);
+                assert!((s[[i, j]] - s[[j, i]]).abs() < 1e-6);
+            }
+        }
+    }
+
+    #[test]
+    fn writes_into_strided_block() {
+        let x = Array2::from_shape_fn((200, 6), |(t, v)| ((t * (v + 2)) as f32 * 0.13).cos());
+        // Use a strided view of the last 4 vertices as input
+        let xb = x.slice(ndarray::s![.., 2..]);
+        let d = mind_double(xb.to_owned().view(), xb.to_owned().view(), 16, None, None);
+        // Write the matrix into a block of a larger buffer, transposed, i.e. with strides in both axes
+        let mut buf = Array2::<f32>::zeros((8, 8));
+        let block = buf.slice_mut(ndarray::s![1..5, 2..6]).reversed_axes();
+        mind_double_into(xb, xb, 16, None, None, block, &|_| {});
+        for i in 0..4 {
+            for j in 0..4 {
+                assert!((buf[[1 + j, 2 + i]] - d[[i, j]]).abs() < 1e-6);
+            }
+        }
+    }
+
+    #[test]
+    fn reports_progress_per_row() {
+        let x = Array2::from_shape_fn((50, 7), |(t, v)| ((t * (v + 1)) as f32 * 0.17).sin());
+        let mut mi = Array2::zeros((7, 7));
+        let done = AtomicUsize::new(0);
+        mind_single_into(x.view(), 8, None, mi.view_mut(), &|n| {
+            done.fetch_add(n, Ordering::Relaxed);
+        });
+        assert_eq!(done.into_inner(), 7);
+    }
 }
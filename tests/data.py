@@ -0,0 +1,27 @@
+"""Small synthetic datasets of the tests"""
+
+import numpy as np
+import xarray as xr
+import h3
+
+
+def hex_vertices(n: int, res=1) -> list[int]:
+    """The first n hexes (as integer ids) of a coarse lat/lon raster"""
+    ids = sorted({int(h3.geo_to_h3(lat, lon, res), 16) for lat in np.arange(-60, 61, 15.0) for lon in np.arange(-170, 171, 20.0)})
+    assert len(ids) >= n, f"only {len(ids)} hexes at resolution {res}"
+    return ids[:n]
+
+
+def hex_data(v=20, t=200, groups=3, seed=0) -> xr.DataArray:
+    """Time series [t, v] on a hexgrid, vertices of the same group share a common signal so that there are links"""
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(t, groups))
+    values = base[:, rng.integers(0, groups, v)] + rng.normal(size=(t, v))
+    x = xr.DataArray(
+        values.astype(np.float32),
+        dims=("time", "vertex"),
+        coords={"time": np.arange(t), "vertex": hex_vertices(v)},
+        attrs={"long_name": "Test Data"},
+    )
+    x.coords["vertex"].attrs["hex_res"] = 1
+    return x
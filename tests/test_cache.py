@@ -0,0 +1,85 @@
+"""Tests of the Zarr caches, run with `python -m pytest tests`"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from chaotic_carbon_networks.cache import save_cache, open_cached_dataarray, open_cached_dataset
+from tests.data import hex_data
+
+
+def grid_data(t=30) -> xr.DataArray:
+    rng = np.random.default_rng(0)
+    lats = np.arange(-60, 60, 10.0)
+    lons = np.arange(-180, 180, 20.0)
+    values = rng.normal(size=(t, len(lats), len(lons)))
+    values[:, 0] = np.nan
+    return xr.DataArray(
+        values,
+        dims=("time", "lat", "lon"),
+        coords={"time": pd.date_range("2020-01-01", periods=t), "lat": lats, "lon": lons},
+        attrs={"long_name": "Test Grid", "units": "kgC"},
+        name="grid",
+    )
+
+
+class SaveCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "cache.zarr"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_round_trip(self, da: xr.DataArray, cached: xr.DataArray, dtype=np.float32):
+        self.assertEqual(cached.dtype, dtype)
+        self.assertEqual(set(cached.dims), set(da.dims))
+        cached = cached.transpose(*da.dims)
+        np.testing.assert_array_equal(cached.values, da.values.astype(dtype))
+        for name in da.coords:
+            np.testing.assert_array_equal(cached[name].values, da[name].values)
+        self.assertEqual(cached.attrs, da.attrs)
+
+    def test_hexgrid(self):
+        x = hex_data(v=20, t=50).astype(np.float64)
+        save_cache(x, self.path, vertex_chunk=8)
+        cached = open_cached_dataarray(self.path)
+        self.assert_round_trip(x, cached)
+        self.assertEqual(cached.vertex.attrs["hex_res"], 1)
+        # Chunks of vertex blocks with all their time steps
+        self.assertEqual(cached.chunks, ((50,), (8, 8, 4)))
+
+    def test_grid_keeps_lat_lon_whole(self):
+        x = grid_data()
+        save_cache(x, self.path)
+        cached = open_cached_dataarray(self.path)
+        self.assert_round_trip(x, cached)
+        self.assertEqual(cached.chunks[1:], ((len(x.lat),), (len(x.lon),)))
+
+    def test_dask_backed_data_and_overwrite(self):
+        x = grid_data().chunk({"time": 7})
+        save_cache(x * 2, self.path)
+        save_cache(x, self.path)
+        self.assert_round_trip(x.compute(), open_cached_dataarray(self.path))
+        self.assertEqual([p.name for p in Path(self.tmp.name).iterdir()], ["cache.zarr"])
+
+    def test_keeps_float64(self):
+        x = grid_data()
+        save_cache(x, self.path, float32=False)
+        self.assert_round_trip(x, open_cached_dataarray(self.path), np.float64)
+
+    def test_dataset_and_integers(self):
+        x = hex_data(v=20, t=50)
+        ds = xr.Dataset({"a": x, "count": (x > 0).astype(np.int32)})
+        save_cache(ds, self.path)
+        cached = open_cached_dataset(self.path)
+        self.assert_round_trip(ds["a"], cached["a"])
+        self.assert_round_trip(ds["count"], cached["count"], np.int32)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""Tests of the downloader against a local HTTP server with Range support, run with `python -m pytest tests`"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+import tempfile
+import unittest
+import os
+
+import requests
+
+from chaotic_carbon_networks.download import Manifest, download, download_all, create_session
+
+FILES = {f"granule{i}.nc": os.urandom(300_000 + i) for i in range(3)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves FILES with Range requests, the first `break_after` bytes of a response are sent before the connection
+    is dropped once per file in `broken`"""
+
+    broken: set = set()
+    break_after = 100_000
+    requests: list = []
+
+    def do_GET(self):
+        name = self.path.lstrip("/")
+        self.requests.append((name, self.headers.get("Range")))
+        if name not in FILES:
+            self.send_error(404)
+            return
+        data = FILES[name]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if name in self.broken:
+            self.broken.discard(name)
+            self.wfile.write(data[start : start + self.break_after])
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.raw_dir = Path(self.tmp.name)
+        Handler.requests = []
+        Handler.broken = set()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def urls(self):
+        return [f"{self.url}/{name}" for name in FILES]
+
+    def test_downloads_and_skips_complete_files(self):
+        paths = download_all(self.urls(), self.raw_dir, workers=2, backoff=0)
+        self.assertEqual([p.read_bytes() for p in paths], list(FILES.values()))
+        self.assertEqual(len(Handler.requests), len(FILES))
+
+        download_all(self.urls(), self.raw_dir, workers=2, backoff=0)
+        self.assertEqual(len(Handler.requests), len(FILES))
+
+    def test_resumes_broken_transfers(self):
+        Handler.broken = set(FILES)
+        paths = download_all(self.urls(), self.raw_dir, workers=2, backoff=0)
+        self.assertEqual([p.read_bytes() for p in paths], list(FILES.values()))
+        # Every file is resumed after the bytes received before the break
+        resumed = {name: int(range[6:-1]) for name, range in Handler.requests if range}
+        self.assertEqual(sorted(resumed), sorted(FILES))
+        self.assertTrue(all(0 < offset <= Handler.break_after for offset in resumed.values()))
+
+    def test_redownloads_corrupt_files(self):
+        name = next(iter(FILES))
+        paths = download_all(self.urls(), self.raw_dir, workers=2, backoff=0)
+        paths[0].write_bytes(b"corrupt" + FILES[name][7:])
+        download_all(self.urls(), self.raw_dir, workers=2, backoff=0, verify=True)
+        self.assertEqual(paths[0].read_bytes(), FILES[name])
+
+    def test_accepts_complete_partial_file(self):
+        name = next(iter(FILES))
+        (self.raw_dir / f"{name}.part").write_bytes(FILES[name])
+        path = download(f"{self.url}/{name}", self.raw_dir, backoff=0)
+        self.assertEqual(path.read_bytes(), FILES[name])
+        self.assertEqual(Handler.requests, [(name, f"bytes={len(FILES[name])}-")])
+
+    def test_discards_oversized_partial_file(self):
+        name = next(iter(FILES))
+        (self.raw_dir / f"{name}.part").write_bytes(FILES[name] + b"garbage")
+        path = download(f"{self.url}/{name}", self.raw_dir, backoff=0)
+        self.assertEqual(path.read_bytes(), FILES[name])
+        self.assertTrue(Manifest(self.raw_dir / "manifest.json").is_complete(path, verify=True))
+
+    def test_missing_file_fails(self):
+        with self.assertRaises(requests.HTTPError):
+            download(f"{self.url}/missing.nc", self.raw_dir, session=create_session(retries=0), backoff=0)
+        with self.assertRaises(RuntimeError):
+            download_all([f"{self.url}/missing.nc"], self.raw_dir, backoff=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
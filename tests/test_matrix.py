@@ -0,0 +1,93 @@
+"""Tests of the tiled and streamed similarity matrices against the dense ones, run with `python -m pytest tests`"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from tests.data import hex_data
+
+try:
+    from chaotic_carbon_networks.matrix import (
+        adjacency_matrix,
+        mutual_information_matrix,
+        pearson_similarity_matrix,
+        laged_pearson_similarity_matrix,
+        degrees,
+        average_link_length,
+        threshold_sweep,
+        node_measures,
+    )
+except ImportError as e:  # The Rust extension is not built
+    raise unittest.SkipTest(str(e))
+
+
+class TiledMatrixTest(unittest.TestCase):
+    def setUp(self):
+        self.x = hex_data(v=20, t=120)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_independent_of_tile_size(self):
+        y = self.x.isel(vertex=slice(5, 17))
+        for x, y in ((self.x, None), (self.x, y)):
+            m = mutual_information_matrix(x, y, bins=8)
+            for tile_size in (6, 7):
+                np.testing.assert_array_equal(mutual_information_matrix(x, y, bins=8, tile_size=tile_size).values, m.values)
+            m, lag = laged_pearson_similarity_matrix(x, y, tau_min=1, tau_max=4, return_lag=True)
+            for tile_size in (6, 7):
+                mt, lagt = laged_pearson_similarity_matrix(x, y, tau_min=1, tau_max=4, tile_size=tile_size, return_lag=True)
+                np.testing.assert_array_equal(mt.values, m.values)
+                np.testing.assert_array_equal(lagt.values, lag.values)
+
+    def test_store(self):
+        store = Path(self.tmp.name) / "m.npy"
+        m = pearson_similarity_matrix(self.x, tile_size=6)
+        ms = pearson_similarity_matrix(self.x, store=store, tile_size=7)
+        np.testing.assert_array_equal(ms.values, m.values)
+        np.testing.assert_array_equal(np.load(store), m.values)
+
+
+class NodeMeasuresTest(unittest.TestCase):
+    def setUp(self):
+        self.x = hex_data(v=20, t=120)
+
+    def assert_node_measures(self, measures, a):
+        deg, avgll, dego = measures
+        np.testing.assert_array_equal(deg.values, degrees(a).values)
+        np.testing.assert_array_equal(dego.values, degrees(a, dim="vertex").values)
+        np.testing.assert_allclose(avgll.values, average_link_length(a).values, rtol=1e-5)
+
+    def test_equal_to_dense_measures(self):
+        # With all vertices sampled, the threshold is the one of `adjacency_matrix`
+        for method, m in (
+            ("similarity", pearson_similarity_matrix(self.x, tile_size=64)),
+            ("mutual_information", mutual_information_matrix(self.x, bins=8)),
+        ):
+            with self.subTest(method=method):
+                measures = node_measures(self.x, method=method, rr=0.1, bins=8, n_sample=20, block_size=7)
+                self.assert_node_measures(measures, adjacency_matrix(m, 0.1))
+
+    def test_diagonal_like_dense_measures(self):
+        # y of the same size as x is treated like x, as in `xrmatrix_from_func`
+        y = self.x.copy()
+        m = mutual_information_matrix(self.x, y, bins=8)
+        self.assertTrue((np.diag(m.values) == 0).all())
+        measures = node_measures(self.x, y, method="mutual_information", rr=0.1, bins=8, n_sample=20)
+        self.assert_node_measures(measures, adjacency_matrix(m, 0.1))
+
+    def test_threshold_sweep(self):
+        m = mutual_information_matrix(self.x, bins=8)
+        rrs = [0.2, 0.05, 0.1]
+        deg, avgll = threshold_sweep(m, rrs, tile_size=7)
+        for rr in rrs:
+            a = adjacency_matrix(m, rr)
+            np.testing.assert_array_equal(deg.sel(rr=rr).values, degrees(a).values)
+            np.testing.assert_allclose(avgll.sel(rr=rr).values, average_link_length(a).values, rtol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests of the network measures against networkx, run with `python -m pytest tests`"""
+
+import unittest
+
+import networkx as nx
+import numpy as np
+
+from tests.data import hex_data
+
+try:
+    from chaotic_carbon_networks.matrix import (
+        adjacency_matrix,
+        pearson_similarity_matrix,
+        betweenness,
+        clustering,
+        transitivity,
+        closeness,
+        kcore,
+    )
+    from chaotic_carbon_networks.matrix.measures import brandes_batch, network
+except ImportError as e:  # The Rust extension is not built
+    raise unittest.SkipTest(str(e))
+
+
+def graph(a, directed=False) -> nx.Graph:
+    """networkx graph of a dense adjacency DataArray, with the vertex ids as nodes"""
+    g = nx.DiGraph() if directed else nx.Graph()
+    g.add_nodes_from(a.vertex.values.tolist())
+    g.add_nodes_from(a.vertex_other.values.tolist())
+    rows, cols = np.nonzero(a.values)
+    g.add_edges_from(
+        (u, v) for u, v in zip(a.vertex.values[rows].tolist(), a.vertex_other.values[cols].tolist()) if u != v
+    )
+    return g
+
+
+class NetworkMeasuresTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        x = hex_data(v=20, t=120)
+        m = pearson_similarity_matrix(x, tile_size=64)
+        cls.a = adjacency_matrix(m, 0.15)
+        cls.sparse = pearson_similarity_matrix(x, rr=0.15)
+        cls.g = graph(cls.a)
+        # A directed network of two overlapping sets of vertices
+        cls.directed = adjacency_matrix(pearson_similarity_matrix(x, tile_size=64).isel(vertex=slice(0, 14), vertex_other=slice(6, 20)), 0.2)
+        cls.dg = graph(cls.directed, directed=True)
+
+    def assert_nodes_close(self, d, expected: dict):
+        self.assertEqual(sorted(d.vertex.values.tolist()), sorted(expected))
+        np.testing.assert_allclose(d.values, [expected[v] for v in d.vertex.values.tolist()], atol=1e-12)
+
+    def test_network_is_symmetric_without_self_links(self):
+        nodes, A, hex_res = network(self.a)
+        self.assertEqual(hex_res, 1)
+        self.assertEqual((A != A.T).nnz, 0)
+        self.assertEqual(A.diagonal().sum(), 0)
+        self.assertEqual(A.nnz, 2 * self.g.number_of_edges())
+
+    def test_betweenness(self):
+        expected = nx.betweenness_centrality(self.g)
+        for m in (self.a, self.sparse):
+            self.assert_nodes_close(betweenness(m, k=None, workers=1), expected)
+        # Batches and worker processes only change the order of the sums
+        self.assert_nodes_close(betweenness(self.a, k=None, batch_size=3, workers=2), expected)
+
+    def test_betweenness_directed(self):
+        self.assert_nodes_close(betweenness(self.directed, k=None, workers=1), nx.betweenness_centrality(self.dg))
+
+    def test_brandes_batch_sums_single_sources(self):
+        _, A, _ = network(self.a)
+        sources = np.array([0, 3, 7, 11])
+        single = sum(brandes_batch(A, np.array([s])) for s in sources)
+        np.testing.assert_allclose(brandes_batch(A, sources), single)
+
+    def test_clustering_and_transitivity(self):
+        for m in (self.a, self.sparse):
+            self.assert_nodes_close(clustering(m), nx.clustering(self.g))
+            self.assertAlmostEqual(transitivity(m).item(), nx.transitivity(self.g))
+
+    def test_closeness(self):
+        for m in (self.a, self.sparse):
+            self.assert_nodes_close(closeness(m, batch_size=4, workers=1), nx.closeness_centrality(self.g))
+        self.assert_nodes_close(closeness(self.directed, workers=1), nx.closeness_centrality(self.dg))
+
+    def test_kcore(self):
+        for m in (self.a, self.sparse):
+            self.assert_nodes_close(kcore(m), nx.core_number(self.g))
+
+
+if __name__ == "__main__":
+    unittest.main()
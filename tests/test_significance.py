@@ -0,0 +1,43 @@
+"""Tests of the surrogate significance of links, run with `python -m pytest tests`"""
+
+import unittest
+
+import numpy as np
+
+from tests.data import hex_data
+
+try:
+    from chaotic_carbon_networks.matrix.significance import significance_matrix
+except ImportError as e:  # The Rust extension is not built
+    raise unittest.SkipTest(str(e))
+
+
+class SignificanceTest(unittest.TestCase):
+    def setUp(self):
+        self.x = hex_data(v=20, t=120)
+
+    def test_independent_of_tile_size(self):
+        for method in ("similarity", "mutual_information", "lagged_similarity"):
+            with self.subTest(method=method):
+                kwargs = dict(method=method, n_surrogates=19, bins=8, tau_min=1, tau_max=4, seed=3, batch_size=7)
+                p = significance_matrix(self.x, tile_size=20, **kwargs).values
+                for tile_size in (6, 7):
+                    np.testing.assert_array_equal(significance_matrix(self.x, tile_size=tile_size, **kwargs).values, p)
+
+    def test_symmetric_for_single_dataset(self):
+        p = significance_matrix(self.x, n_surrogates=19, tile_size=6).values
+        np.testing.assert_array_equal(p, p.T)
+        np.testing.assert_array_equal(np.diag(p), 1)
+
+    def test_nan_for_constant_vertices(self):
+        x = self.x.copy()
+        x[:, 0] = 1
+        p = significance_matrix(x, n_surrogates=9, tile_size=6).values
+        self.assertTrue(np.isnan(p[0, 1:]).all() and np.isnan(p[1:, 0]).all())
+        self.assertFalse(np.isnan(p[1:, 1:]).any())
+        a = significance_matrix(x, n_surrogates=9, alpha=0.1, tile_size=6).values
+        self.assertEqual(a[0].sum(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests of the sparse adjacency matrices emitted directly by the similarity kernels, run with `python -m pytest tests`"""
+
+import itertools
+import unittest
+
+import numpy as np
+
+from tests.data import hex_data
+
+try:
+    from chaotic_carbon_networks.matrix import (
+        adjacency_matrix,
+        mutual_information_matrix,
+        pearson_similarity_matrix,
+        laged_pearson_similarity_matrix,
+    )
+    from chaotic_carbon_networks.matrix.gen import sparsematrix_from_func, pearson_correlation
+except ImportError as e:  # The Rust extension is not built
+    raise unittest.SkipTest(str(e))
+
+
+class SparseAdjacencyTest(unittest.TestCase):
+    def setUp(self):
+        self.x = hex_data(v=20, t=120)
+
+    def assert_same_adjacency(self, sparse, dense):
+        a = sparse.to_dataarray()
+        self.assertEqual(a.dims, dense.dims)
+        np.testing.assert_array_equal(a.values, dense.values)
+
+    def test_rr_equals_dense_adjacency(self):
+        cases = {
+            # The untiled dense matrix uses np.corrcoef, the tiles the same kernel as the sparse matrix
+            "similarity": (pearson_similarity_matrix, dict(tile_size=64), dict()),
+            "mutual_information": (mutual_information_matrix, dict(), dict(bins=8)),
+            "lagged_similarity": (laged_pearson_similarity_matrix, dict(), dict(tau_min=1, tau_max=4)),
+        }
+        for (name, (matrix, dense_kwargs, kwargs)), v in itertools.product(cases.items(), (14, 15, 20)):
+            x = hex_data(v=v, t=120)
+            m = matrix(x, **dense_kwargs, **kwargs)
+            for rr in (0.05, 0.1, 0.23):
+                with self.subTest(method=name, v=v, rr=rr):
+                    a = adjacency_matrix(m, rr)
+                    s = matrix(x, rr=rr, **kwargs)
+                    self.assert_same_adjacency(s, a)
+                    if name != "lagged_similarity":
+                        # Symmetric links are kept in pairs
+                        np.testing.assert_array_equal(s.data.toarray(), s.data.toarray().T)
+
+    def test_rr_is_independent_of_block_size(self):
+        s = sparsematrix_from_func(self.x, self.x, pearson_correlation, rr=0.1, diagonal=False, block_size=20)
+        for block_size in (1, 3, 7):
+            t = sparsematrix_from_func(self.x, self.x, pearson_correlation, rr=0.1, diagonal=False, block_size=block_size)
+            np.testing.assert_array_equal(t.data.toarray(), s.data.toarray())
+
+    def test_rr_ignores_nan(self):
+        x = self.x.copy()
+        x[:, 3] = np.nan
+        m = pearson_similarity_matrix(x, tile_size=64)
+        np.testing.assert_array_equal(pearson_similarity_matrix(x, rr=0.1).to_dataarray().values, adjacency_matrix(m, 0.1).values)
+
+    def test_k_strongest_links(self):
+        m = pearson_similarity_matrix(self.x, tile_size=64).values
+        s = pearson_similarity_matrix(self.x, k=3).data.toarray()
+        np.testing.assert_array_equal(s.sum(axis=1), 3)
+        self.assertEqual(np.diag(s).sum(), 0)
+        np.fill_diagonal(m, -np.inf)
+        for i in range(len(m)):
+            self.assertGreaterEqual(m[i, s[i] == 1].min(), m[i, s[i] == 0].max())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Tests of the sliding-window networks and the appendable network state, run with `python -m pytest tests`"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from tests.data import hex_data
+
+try:
+    from chaotic_carbon_networks.matrix import (
+        adjacency_matrix,
+        degrees,
+        average_link_length,
+        mutual_information_matrix,
+        pearson_similarity_matrix,
+        laged_pearson_similarity_matrix,
+        windowed_networks,
+        NetworkState,
+    )
+    from chaotic_carbon_networks.matrix.gen import matrix_dataarray, stack_vertices
+    from chaotic_carbon_networks.matrix.moments import LaggedMoments
+except ImportError as e:  # The Rust extension is not built
+    raise unittest.SkipTest(str(e))
+
+
+def data(v=20, t=160):
+    x = hex_data(v=v, t=t)
+    return x.assign_coords(time=pd.date_range("2020-01-01", periods=t))
+
+
+class WindowedNetworksTest(unittest.TestCase):
+    def test_equal_to_networks_of_every_window(self):
+        x = data()
+        window, step = 60, 25
+        for lagged, lags in ((True, np.arange(2, 6)), (False, np.arange(1))):
+            results = list(windowed_networks(x, window=window, step=step, tau_min=2, tau_max=6, lagged=lagged, rr=0.1))
+            self.assertEqual(len(results), (len(x.time) - window) // step + 1)
+            for k, (t, deg, avgll) in enumerate(results):
+                with self.subTest(lagged=lagged, window=k):
+                    xw = x.isel(time=slice(k * step, k * step + window))
+                    self.assertEqual(t, xw.time.values[-1])
+                    # The moments of the window from scratch, like the kernels but in float64
+                    xv = xw.values - x.values[:window].mean(axis=0)
+                    moments = LaggedMoments(xv.shape[1], xv.shape[1], lags)
+                    moments.update_range(xv, xv, 0, window)
+                    rho = moments.similarity()
+                    np.fill_diagonal(rho, 0)
+                    if lagged:
+                        ref = laged_pearson_similarity_matrix(xw, tau_min=2, tau_max=6).values
+                    else:
+                        ref = pearson_similarity_matrix(xw).values
+                    np.testing.assert_allclose(rho, ref, atol=1e-5)
+
+                    a = adjacency_matrix(matrix_dataarray(rho, *stack_vertices(xw), *stack_vertices(xw)), 0.1)
+                    np.testing.assert_array_equal(deg.values, degrees(a).values)
+                    np.testing.assert_allclose(avgll.values, average_link_length(a).values)
+
+    def test_default_lags_exclude_zero(self):
+        x = data()
+        with self.assertRaises(AssertionError):
+            next(windowed_networks(x, window=15))
+        # An explicit tau_min=0 is kept
+        next(windowed_networks(x, window=30, tau_min=0, tau_max=3))
+
+
+class NetworkStateTest(unittest.TestCase):
+    def setUp(self):
+        self.x = data()
+        # The bin ranges of "mutual_information" are fixed by the first time steps, so they hold the extremes
+        self.x[0, 5] = self.x.min() - 1
+        self.x[1, 5] = self.x.max() + 1
+        self.y = self.x.isel(vertex=slice(4, 16)) * 2 + 1
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def appended(self, x, y, splits=(70, 71), **kwargs) -> NetworkState:
+        """A state of the first time steps, appended in parts and stored and restored in between"""
+        part = lambda da, start, stop: None if da is None else da.isel(time=slice(start, stop))
+        bounds = [0, *splits, len(x.time)]
+        state = NetworkState.from_data(part(x, 0, bounds[1]), part(y, 0, bounds[1]), **kwargs)
+        for start, stop in zip(bounds[1:-1], bounds[2:]):
+            path = Path(self.tmp.name) / "state.npz"
+            state.save(path)
+            state = NetworkState.load(path)
+            state.append(part(x, start, stop), part(y, start, stop))
+        return state
+
+    def test_appends_equal_full_data(self):
+        for y in (None, self.y):
+            with self.subTest(single=y is None):
+                m = self.appended(self.x, y, method="lagged_similarity", tau_min=2, tau_max=6).similarity()
+                np.testing.assert_allclose(m.values, laged_pearson_similarity_matrix(self.x, y, tau_min=2, tau_max=6).values, atol=1e-5)
+
+                m = self.appended(self.x, y, method="mutual_information", bins=8).similarity()
+                np.testing.assert_allclose(m.values, mutual_information_matrix(self.x, y, bins=8).values, atol=1e-5)
+
+        m = self.appended(self.x, None, method="similarity").similarity()
+        np.testing.assert_allclose(m.values, pearson_similarity_matrix(self.x).values, atol=1e-5)
+
+    def test_mutual_information_skips_nan(self):
+        x = self.x.copy()
+        x[10:30, 3] = np.nan
+        m = self.appended(x, None, method="mutual_information", bins=8).similarity().values
+        # The pairs of vertex 3 only count the time steps where it is not NaN, all others every time step
+        valid = ~np.isnan(x.values[:, 3])
+        np.testing.assert_allclose(m[3], mutual_information_matrix(x.isel(time=valid), bins=8).values[3], atol=1e-5)
+        others = np.arange(20) != 3
+        ref = mutual_information_matrix(self.x, bins=8).values
+        np.testing.assert_allclose(m[np.ix_(others, others)], ref[np.ix_(others, others)], atol=1e-5)
+
+    def test_size_guard(self):
+        for method in ("lagged_similarity", "mutual_information"):
+            with self.assertRaises(AssertionError):
+                NetworkState.from_data(self.x, method=method, tau_min=2, tau_max=6, bins=8, max_bytes=10_000)
+
+
+if __name__ == "__main__":
+    unittest.main()